@@ -1,3 +1,13 @@
 from .proxypool import ProxyPool
-from .providers import ProxyProvider
+from .asyncpool import AsyncProxyPool
+from .providers import ProxyProvider, ScrapingProvider
 from .threadpool import ThreadPool
+from .validation import ProxyValidator
+from .metrics import Metrics
+from .policies import SelectionPolicy, InverseLatency, PowerOfTwoChoices, ThompsonSampling
+from .ratelimit import RateLimiter
+from .reputation import ReputationStore
+from .cache import ResponseCache
+from .server import PoolServer, PoolClient
+from .trace import TraceRecorder, read_trace
+from .simulation import Simulator
@@ -0,0 +1,333 @@
+import asyncio
+import itertools
+import logging
+import time
+from urllib.parse import urlparse
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Raised by aiohttp >= 3.10 when connecting times out
+_ConnectTimeout = getattr(aiohttp, 'ConnectionTimeoutError', ())
+
+from .proxypool import ProxyPool, SUCCESS, FAILURE, SATURATED
+
+logger = logging.getLogger(__name__)
+
+
+class _NullLock(object):
+    """
+    Stands in for the pool lock. The pool state of an AsyncProxyPool is only
+    touched from the event loop thread, and never across an await.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def acquire(self, blocking=True, timeout=-1):
+        return True
+
+    def release(self):
+        pass
+
+
+class AsyncProxyPool(ProxyPool):
+    """
+    asyncio counterpart of ProxyPool, built on aiohttp. Proxies are sampled,
+    scored, cooled down and marked down exactly like in ProxyPool, but requests
+    are awaitable and run on a single event loop instead of one thread each.
+
+    Only http proxies are supported by aiohttp, other proxies are marked down
+    when sampled. get_many() and stream() are not supported, gather() and
+    as_completed() request many urls concurrently.
+    """
+
+    def __init__(self, providers, max_requests=100, **kwargs):
+        """
+        :providers: List of ProxyProvider instances that are used for providing proxies
+        :max_requests: Maximum number of requests in flight in total, see
+            max_concurrency for the maximum through each proxy
+        Other arguments are passed on to ProxyPool
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncProxyPool requires aiohttp")
+        ProxyPool.__init__(self, providers, **kwargs)
+        self.lock = _NullLock()
+        self.stripes = [self.lock]
+        self.refreshed = None
+        self.released = None
+        self.release_event = None
+        self.max_requests = max_requests
+        self.semaphore = None
+        self.session = None
+        self.refresh_task = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """
+        Closes all proxy connections
+        """
+        if self.reprober is not None:
+            self.reprober.cancel()
+            self.reprober = None
+        if self.checkpointer is not None:
+            self.checkpointer.cancel()
+            self.checkpointer = None
+        if self.reputation is not None:
+            self.checkpoint()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def __session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_requests),
+                cookie_jar=aiohttp.DummyCookieJar())
+        return self.session
+
+    def __semaphore(self):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_requests)
+        return self.semaphore
+
+    async def __refresh(self):
+        self.refreshing = True
+        try:
+            known = set(p.url for p in self.proxies)
+            loop = asyncio.get_event_loop()
+            # Providers and validation are blocking, keep them off the loop
+            urls, latencies, saved = await loop.run_in_executor(None, self._fetch, known)
+            self._install(urls, latencies, saved)
+        finally:
+            self.refreshing = False
+            self.refresh_task = None
+
+    async def refresh(self):
+        """
+        Fetches proxies from the providers and swaps them into the pool. If a
+        refresh already is in progress, waits for it to finish instead.
+        """
+        if self.refresh_task is None:
+            self.refresh_task = asyncio.ensure_future(self.__refresh())
+        await asyncio.shield(self.refresh_task)
+
+    def _refresh_in_background(self):
+        def done(task):
+            if not task.cancelled() and task.exception() is not None:
+                logger.error("Background refresh failed: %s", task.exception())
+
+        asyncio.ensure_future(self.refresh()).add_done_callback(done)
+
+    def _start_reprobing(self):
+        async def run():
+            loop = asyncio.get_event_loop()
+            while True:
+                await asyncio.sleep(self.reprobe_interval)
+                try:
+                    down = self._rehabilitation_candidates()
+                    if self.validator is not None and down:
+                        latencies = await loop.run_in_executor(
+                            None, self.validator.validate, [p.url for p in down])
+                        self._revive(down, latencies)
+                except Exception as e:
+                    logger.error("Rehabilitation failed: %s", e)
+
+        return asyncio.ensure_future(run())
+
+    def _start_checkpointing(self):
+        async def run():
+            loop = asyncio.get_event_loop()
+            while True:
+                await asyncio.sleep(self.checkpoint_interval)
+                try:
+                    # The entries are taken on the loop, only saving blocks
+                    await loop.run_in_executor(
+                        None, self.reputation.save, self._checkpoint_entries())
+                except Exception as e:
+                    logger.error("Checkpoint failed: %s", e)
+
+        return asyncio.ensure_future(run())
+
+    def _released(self):
+        self.releases += 1
+        if self.release_event is not None:
+            # Wakes up all waiters, later ones wait for the next release
+            self.release_event.set()
+            self.release_event = None
+
+    async def get_proxy(self, host=None, lease=False, timeout=None, expires=None):
+        """
+        Sample a good proxy. If host is given, proxies cooling down for that host
+        are skipped, waiting for the first one to resume if all are cooling down.
+        See ProxyPool.get_proxy for lease, timeout and expires.
+        """
+        t0 = time.time()
+        if timeout is None:
+            timeout = self.lease_timeout
+        while True:
+            p, delay = self._try_get_proxy(host, lease)
+            if p is not None:
+                if self.metrics is not None:
+                    self.metrics.observe('proxypool_selection_wait_seconds', time.time() - t0)
+                return p
+            if delay is None:
+                await self.refresh()
+            elif delay is SATURATED:
+                remaining = None
+                if timeout is not None:
+                    remaining = t0 + timeout - time.time()
+                    if remaining <= 0:
+                        raise Exception("All proxies are saturated, waited %.1f sec" % timeout)
+                if self.release_event is None:
+                    self.release_event = asyncio.Event()
+                try:
+                    await asyncio.wait_for(self.release_event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                delay = self._resume_delay(host, delay, expires)
+                logger.info("All proxies cooling down or rate limited for %s, waiting %.1f sec",
+                            host, delay)
+                await asyncio.sleep(delay)
+
+    async def request(self, method, url, deadline=None, **kwargs):
+        """
+        Performs a request through a sampled proxy, failing over to other
+        proxies like ProxyPool. Returns an aiohttp response with its body read.
+
+        :deadline: Seconds the request may take in total, across all attempts
+        A 'timeout' argument is taken as bounds of the timeouts, see
+        ProxyPool.timeouts
+        """
+        host = urlparse(url).netloc.lower()
+        failures = 0
+        expires = time.time() + deadline if deadline is not None else None
+        async with self.__semaphore():
+            while True:
+                delay = self._throttle_delay(host, expires)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                timeout = None
+                if expires is not None:
+                    timeout = max(0.0, expires - time.time())
+                p = await self.get_proxy(host, lease=True, timeout=timeout, expires=expires)
+                try:
+                    outcome, r = await self.__attempt(p, host, method, url, kwargs, expires)
+                finally:
+                    p.release()
+                if outcome == SUCCESS:
+                    return r
+                elif outcome == FAILURE:
+                    failures += 1
+
+                if failures > self.max_proxy_attempts:
+                    raise Exception(
+                        "Too many failures, probably bad request (%s %s)" %
+                        (method, url))
+
+    async def __attempt(self, p, host, method, url, kwargs, expires):
+        """
+        Performs a request through proxy p and accounts for the outcome.
+        Returns the outcome and the response, if any.
+        """
+        logger.info("Using %s", p)
+        proxy = p.as_dict()['http']
+        if not proxy.startswith('http://'):
+            logger.debug("%s: Not supported by aiohttp", p.url)
+            p.set_down()
+            return None, None
+        if self.metrics is not None:
+            self.metrics.emit('attempt', proxy=p, host=host)
+        connect, read = self.timeouts(p, kwargs.get('timeout'), expires)
+        total = expires - time.time() if expires is not None else None
+        kwargs = dict(kwargs, proxy=proxy,
+                      timeout=aiohttp.ClientTimeout(total=total, sock_connect=connect,
+                                                    sock_read=read))
+        t0 = time.time()
+        try:
+            r = await self.__session().request(method, url, **kwargs)
+            latency = time.time() - t0
+            await r.read()
+        except _ConnectTimeout as e:
+            # The proxy didn't accept the connection, regardless of the host
+            self._handle_error(p, None, e, time.time() - t0)
+            return FAILURE, None
+        except (aiohttp.ClientConnectionError,
+                aiohttp.ClientPayloadError,
+                asyncio.TimeoutError) as e:
+            self._handle_error(p, host, e, time.time() - t0)
+            return FAILURE, None
+        return self._handle_response(p, host, r.status, r.headers, latency), r
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def options(self, url, **kwargs):
+        return await self.request('OPTIONS', url, **kwargs)
+
+    async def head(self, url, **kwargs):
+        return await self.request('HEAD', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request('PUT', url, **kwargs)
+
+    async def patch(self, url, **kwargs):
+        return await self.request('PATCH', url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request('DELETE', url, **kwargs)
+
+    def get_many(self, *args, **kwargs):
+        raise NotImplementedError("AsyncProxyPool doesn't support get_many(), "
+                                  "use gather() or as_completed()")
+
+    def stream(self, *args, **kwargs):
+        raise NotImplementedError("AsyncProxyPool doesn't support stream()")
+
+    async def gather(self, urls, method='GET', return_exceptions=False, **kwargs):
+        """
+        Requests all urls concurrently, bounded by max_requests, and returns
+        the responses in the order of urls.
+        """
+        return await asyncio.gather(*[self.request(method, url, **kwargs) for url in urls],
+                                    return_exceptions=return_exceptions)
+
+    async def as_completed(self, urls, method='GET', **kwargs):
+        """
+        Requests urls concurrently and yields (url, response or exception) as
+        the requests complete. urls are consumed lazily, so that at most
+        max_requests requests exist at any time.
+        """
+        async def fetch(url):
+            try:
+                return url, await self.request(method, url, **kwargs)
+            except Exception as e:
+                return url, e
+
+        urls = iter(urls)
+        pending = set(asyncio.ensure_future(fetch(url))
+                      for url in itertools.islice(urls, self.max_requests))
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for url in itertools.islice(urls, len(done)):
+                    pending.add(asyncio.ensure_future(fetch(url)))
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
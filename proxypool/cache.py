@@ -0,0 +1,454 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from email.utils import parsedate_tz, mktime_tz
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    meta TEXT NOT NULL,
+    content BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+"""
+
+# Status codes of responses that are stored
+CACHEABLE_STATUS = [200, 203]
+
+# Request arguments with which the cache is bypassed, as they carry a body
+# or credentials
+UNCACHEABLE_ARGS = ['data', 'json', 'files', 'auth', 'cookies', 'cert']
+
+# Request arguments changing the response, which are part of the cache key
+KEY_ARGS = ['allow_redirects', 'verify']
+
+# Request headers carrying credentials, with which responses are only stored
+# if public
+CREDENTIAL_HEADERS = ['Authorization', 'Proxy-Authorization', 'Cookie']
+
+# Request headers with which the cache is bypassed, as the caller handles
+# validation or partial content itself
+UNCACHEABLE_HEADERS = ['If-None-Match', 'If-Modified-Since', 'If-Range', 'Range']
+
+
+def _cache_control(value):
+    """
+    Parses a Cache-Control header value into a dict of directive -> argument,
+    None for directives without an argument
+    """
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"') if arg else None
+    return directives
+
+
+def _parse_date(value):
+    parsed = parsedate_tz(value) if value else None
+    return mktime_tz(parsed) if parsed is not None else None
+
+
+def _freshness(headers, now):
+    """
+    Returns the seconds a response with headers stays fresh, which is 0 or
+    less if it has to be revalidated before use, or None if it may not be
+    stored at all
+    """
+    cc = _cache_control(headers.get('Cache-Control'))
+    if 'no-store' in cc:
+        return None
+    if 'no-cache' in cc:
+        return 0
+    if 'max-age' in cc:
+        try:
+            lifetime = int(cc['max-age'])
+        except (TypeError, ValueError):
+            return 0
+    elif 'Expires' in headers:
+        expires = _parse_date(headers['Expires'])
+        if expires is None:
+            return 0
+        date = _parse_date(headers.get('Date'))
+        lifetime = expires - (date if date is not None else now)
+    else:
+        return 0
+    try:
+        age = int(headers.get('Age', 0))
+    except ValueError:
+        age = 0
+    return lifetime - age
+
+
+class CachedResponse(object):
+    """
+    Body and metadata of a stored response. A new requests.Response is built
+    for each use, so that callers don't share mutable responses.
+    """
+    __slots__ = ('key', 'status_code', 'reason', 'headers', 'content', 'url',
+                 'vary', 'expires', 'size')
+
+    def __init__(self, key, status_code, reason, headers, content, url, vary, expires):
+        """
+        :headers: List of (name, value) pairs
+        :vary: Dict of name -> value of the request headers the response varies on
+        :expires: Point in time the response has to be revalidated after
+        """
+        self.key = key
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+        self.url = url
+        self.vary = vary
+        self.expires = expires
+        self.size = len(content) + sum(len(k) + len(v) for k, v in headers)
+
+    @classmethod
+    def from_response(cls, key, r, request_headers, now):
+        headers = list(r.headers.items())
+        lifetime = _freshness(r.headers, now)
+        vary = {}
+        for name in r.headers.get('Vary', '').split(','):
+            name = name.strip()
+            if name:
+                vary[name.lower()] = request_headers.get(name)
+        return cls(key, r.status_code, r.reason, headers, r.content, r.url, vary,
+                   now + (lifetime or 0))
+
+    def storable(self):
+        """
+        Returns True if the response may be stored, ie. it is cacheable and
+        either fresh or revalidatable
+        """
+        headers = CaseInsensitiveDict(self.headers)
+        if self.status_code not in CACHEABLE_STATUS or '*' in self.vary:
+            return False
+        if _freshness(headers, time.time()) is None:
+            return False
+        return self.expires > time.time() or self.validators() != {}
+
+    def shareable(self, request_headers):
+        """
+        Returns True if the response may be served to other requests than the
+        one it answered, which responses to requests with credentials only
+        may if they are public
+        """
+        if not any(name in request_headers for name in CREDENTIAL_HEADERS):
+            return True
+        return 'public' in _cache_control(CaseInsensitiveDict(self.headers).get('Cache-Control'))
+
+    def matches(self, request_headers):
+        return all(request_headers.get(name) == value for name, value in self.vary.items())
+
+    def validators(self):
+        """
+        Returns the conditional request headers revalidating the response
+        """
+        headers = CaseInsensitiveDict(self.headers)
+        validators = {}
+        if headers.get('ETag'):
+            validators['If-None-Match'] = headers['ETag']
+        if headers.get('Last-Modified'):
+            validators['If-Modified-Since'] = headers['Last-Modified']
+        return validators
+
+    def revalidated(self, r, now):
+        """
+        Returns a copy updated with the headers of a 304 response r
+        """
+        headers = CaseInsensitiveDict(self.headers)
+        for name, value in r.headers.items():
+            if name.lower() not in ['content-length', 'content-encoding', 'transfer-encoding']:
+                headers[name] = value
+        lifetime = _freshness(headers, now)
+        return CachedResponse(self.key, self.status_code, self.reason, list(headers.items()),
+                              self.content, self.url, self.vary, now + (lifetime or 0))
+
+    def response(self, from_cache=True):
+        r = requests.Response()
+        r.status_code = self.status_code
+        r.reason = self.reason
+        r.headers = CaseInsensitiveDict(self.headers)
+        r._content = self.content
+        r.url = self.url
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        r.elapsed = timedelta(0)
+        r.from_cache = from_cache
+        return r
+
+    def to_meta(self):
+        return json.dumps({'status_code': self.status_code, 'reason': self.reason,
+                           'headers': self.headers, 'url': self.url, 'vary': self.vary,
+                           'expires': self.expires})
+
+    @classmethod
+    def from_meta(cls, key, meta, content):
+        meta = json.loads(meta)
+        return cls(key, meta['status_code'], meta['reason'],
+                   [tuple(h) for h in meta['headers']], bytes(content), meta['url'],
+                   meta['vary'], meta['expires'])
+
+
+class _Flight(object):
+    """
+    A request in flight, whose outcome is shared with identical requests
+    """
+    __slots__ = ('done', 'entry', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+        self.error = None
+
+
+class DiskCache(object):
+    """
+    Stores responses in an SQLite database, evicting the least recently used
+    ones above max_bytes. May be shared by several processes on the same host.
+    """
+
+    def __init__(self, path, max_bytes=1024 ** 3, timeout=10.0):
+        """
+        :path: Path of the database file, created if missing
+        :max_bytes: Maximum size of the stored bodies and headers
+        :timeout: Seconds to wait for another process holding the database lock
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.executescript(SCHEMA)
+            self.db.commit()
+            self.bytes = self.db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT meta, content FROM responses WHERE key = ?',
+                                  (key,)).fetchone()
+            if row is None:
+                return None
+            with self.db:
+                self.db.execute('UPDATE responses SET accessed = ? WHERE key = ?',
+                                (time.time(), key))
+        return CachedResponse.from_meta(key, row[0], row[1])
+
+    def put(self, entry):
+        with self.lock:
+            with self.db:
+                row = self.db.execute('SELECT size FROM responses WHERE key = ?',
+                                      (entry.key,)).fetchone()
+                if row is not None:
+                    self.bytes -= row[0]
+                self.db.execute('INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?)',
+                                (entry.key, entry.to_meta(), sqlite3.Binary(entry.content),
+                                 entry.size, time.time()))
+                self.bytes += entry.size
+                while self.bytes > self.max_bytes:
+                    row = self.db.execute('SELECT key, size FROM responses '
+                                          'ORDER BY accessed LIMIT 1').fetchone()
+                    if row is None:
+                        break
+                    self.db.execute('DELETE FROM responses WHERE key = ?', (row[0],))
+                    self.bytes -= row[1]
+
+    def delete(self, key):
+        with self.lock:
+            with self.db:
+                row = self.db.execute('SELECT size FROM responses WHERE key = ?',
+                                      (key,)).fetchone()
+                if row is not None:
+                    self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    self.bytes -= row[0]
+
+    def clear(self):
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM responses')
+            self.bytes = 0
+
+
+class ResponseCache(object):
+    """
+    HTTP cache in front of the GET and HEAD requests of a ProxyPool, so that
+    repeated requests don't use up proxy attempts.
+
+    Responses are kept in memory, evicting the least recently used ones above
+    max_entries or max_bytes, and optionally in a DiskCache behind the memory.
+    Cache-Control and Expires of the responses are respected, and stale
+    responses are revalidated with If-None-Match or If-Modified-Since.
+    Identical requests made while one of them is in flight wait for its
+    outcome instead of making requests of their own.
+
+    Streamed requests, requests with a body, auth, cookies or a client
+    certificate and conditional or range requests bypass the cache. Responses
+    to requests with an Authorization, Proxy-Authorization or Cookie header
+    are only stored if public. Responses from the cache have from_cache set.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, path=None,
+                 max_disk_bytes=1024 ** 3):
+        """
+        :max_entries: Maximum number of responses kept in memory
+        :max_bytes: Maximum size of the responses kept in memory
+        :path: Optional path of a database file storing responses on disk
+        :max_disk_bytes: Maximum size of the responses stored on disk
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk = DiskCache(path, max_disk_bytes) if path is not None else None
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> CachedResponse, least recently used first
+        self.bytes = 0
+        self.flights = {}  # (key, request headers) -> _Flight
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+        if self.disk is not None:
+            self.disk.clear()
+
+    def __remember(self, entry):
+        """
+        Must be called inside lock
+        """
+        old = self.entries.pop(entry.key, None)
+        if old is not None:
+            self.bytes -= old.size
+        if entry.size > self.max_bytes:
+            return
+        self.entries[entry.key] = entry
+        self.bytes += entry.size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.size
+
+    def __lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        if self.disk is None:
+            return None
+        entry = self.disk.get(key)
+        if entry is not None:
+            with self.lock:
+                self.__remember(entry)
+        return entry
+
+    def __store(self, entry):
+        with self.lock:
+            self.__remember(entry)
+        if self.disk is not None:
+            self.disk.put(entry)
+
+    def __forget(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry.size
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def request(self, method, url, kwargs, send):
+        """
+        Returns the response to a request, from the cache if possible
+
+        :kwargs: Arguments of the request
+        :send: Function making the request through the pool, called with the
+            arguments of the request
+        """
+        headers = CaseInsensitiveDict(kwargs.get('headers') or {})
+        request_cc = _cache_control(headers.get('Cache-Control'))
+        if (kwargs.get('stream') or 'no-store' in request_cc or
+                any(kwargs.get(name) is not None for name in UNCACHEABLE_ARGS) or
+                any(name in headers for name in UNCACHEABLE_HEADERS)):
+            return send(kwargs)
+
+        url = requests.Request(method, url, params=kwargs.get('params')).prepare().url
+        key = ' '.join([method, url] + ['%s=%r' % (name, kwargs[name])
+                                        for name in KEY_ARGS if name in kwargs])
+        entry = self.__lookup(key)
+        if entry is not None and not entry.matches(headers):
+            entry = None
+        revalidate = 'no-cache' in request_cc or request_cc.get('max-age') == '0'
+        if entry is not None and not revalidate and entry.expires > time.time():
+            with self.lock:
+                self.hits += 1
+            return entry.response()
+
+        flight_key = (key, tuple(sorted((k.lower(), v) for k, v in headers.items())))
+        with self.lock:
+            flight = self.flights.get(flight_key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[flight_key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.entry.response(from_cache=False)
+
+        try:
+            validators = entry.validators() if entry is not None else {}
+            if validators:
+                kwargs = dict(kwargs, headers=dict(headers, **validators))
+            r = send(kwargs)
+            now = time.time()
+            if r.status_code == 304 and validators:
+                logger.debug("%s revalidated", url)
+                with self.lock:
+                    self.revalidations += 1
+                r.close()
+                flight.entry = entry.revalidated(r, now)
+                self.__store(flight.entry)
+                return flight.entry.response()
+            flight.entry = CachedResponse.from_response(key, r, headers, now)
+            if flight.entry.storable() and flight.entry.shareable(headers):
+                self.__store(flight.entry)
+            elif entry is not None:
+                self.__forget(key)
+            r.from_cache = False
+            return r
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[flight_key]
+            flight.done.set()
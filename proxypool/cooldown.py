@@ -0,0 +1,102 @@
+import heapq
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+
+def parse_retry_after(value, now=None):
+    """
+    Parses a Retry-After header value, given either as delta-seconds or as an
+    HTTP-date. Returns the delay in seconds, or None if the value is missing or
+    malformed.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    if now is None:
+        now = time.time()
+    return max(0.0, mktime_tz(parsed) - now)
+
+
+class CooldownScheduler(object):
+    """
+    Keeps track of keys, typically (proxy url, target host) pairs, that should
+    not be used until a point in time. Keys are penalized with an explicit delay
+    (eg. from Retry-After), or with an exponential backoff on repeated penalties.
+
+    Not thread safe, the owner is expected to serialize access.
+    """
+
+    def __init__(self, base_delay=2.0, max_delay=300.0, clock=time.time):
+        """
+        :base_delay: Backoff in seconds after the first penalty without explicit delay
+        :max_delay: Upper limit of the exponential backoff
+        :clock: Function returning the current time in seconds
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.heap = []  # (resume time, key), may contain superseded entries
+        self.resume = {}  # key -> resume time
+        self.strikes = {}  # key -> number of consecutive penalties
+
+    def __len__(self):
+        return len(self.resume)
+
+    def penalize(self, key, delay=None):
+        """
+        Cools down key for delay seconds, or for an exponential backoff if delay
+        is None. Returns the applied delay.
+        """
+        strikes = self.strikes.get(key, 0) + 1
+        self.strikes[key] = strikes
+        if delay is None:
+            delay = min(self.max_delay, self.base_delay * 2 ** (strikes - 1))
+        t = self.clock() + delay
+        if t > self.resume.get(key, 0):
+            self.resume[key] = t
+            heapq.heappush(self.heap, (t, key))
+        return delay
+
+    def restore(self, key, resume, strikes):
+        """
+        Cools down key until the point in time resume, with a backoff history
+        of strikes penalties, eg. when loading saved state
+        """
+        if strikes:
+            self.strikes[key] = strikes
+        if resume > max(self.clock(), self.resume.get(key, 0)):
+            self.resume[key] = resume
+            heapq.heappush(self.heap, (resume, key))
+
+    def reset(self, key):
+        """
+        Forgets the backoff history of key, eg. after a successful request
+        """
+        self.strikes.pop(key, None)
+
+    def expire(self):
+        """
+        Drops all cooldowns that have passed
+        """
+        now = self.clock()
+        while self.heap and self.heap[0][0] <= now:
+            t, key = heapq.heappop(self.heap)
+            if self.resume.get(key) == t:
+                del self.resume[key]
+
+    def cooling(self, key):
+        t = self.resume.get(key)
+        return t is not None and t > self.clock()
+
+    def next_resume(self, match=lambda key: True):
+        """
+        Returns the earliest resume time of the cooling keys accepted by match,
+        or None if there are none.
+        """
+        times = [t for key, t in self.resume.items() if match(key)]
+        return min(times) if times else None
@@ -0,0 +1,75 @@
+class FenwickTree(object):
+    """
+    Binary indexed tree over non-negative weights. Supports point updates and
+    weighted sampling (finding the index a cumulative weight falls into) in
+    O(log n), instead of recomputing and walking every weight on each sample.
+    """
+
+    def __init__(self, weights=()):
+        self.rebuild(weights)
+
+    def __len__(self):
+        return len(self.weights)
+
+    def rebuild(self, weights):
+        """
+        (Re)builds the tree from a sequence of weights in O(n). Also used to
+        get rid of accumulated floating point drift from incremental updates.
+        """
+        self.weights = [float(w) for w in weights]
+        n = len(self.weights)
+        tree = [0.0] + self.weights
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        self.tree = tree
+        self.updates = 0
+        self.top = 1 << (n.bit_length() - 1) if n else 0
+
+    def update(self, i, w):
+        """
+        Sets the weight at index i to w
+        """
+        w = float(w)
+        delta = w - self.weights[i]
+        if delta == 0.0:
+            return
+        self.weights[i] = w
+        n = len(self.weights)
+        i += 1
+        while i <= n:
+            self.tree[i] += delta
+            i += i & -i
+        self.updates += 1
+        if self.updates > max(n, 1024):
+            self.rebuild(self.weights)
+
+    def prefix_sum(self, i):
+        """
+        Returns the sum of the first i weights
+        """
+        s = 0.0
+        while i > 0:
+            s += self.tree[i]
+            i -= i & -i
+        return s
+
+    def total(self):
+        return self.prefix_sum(len(self.weights))
+
+    def find(self, r):
+        """
+        Returns the smallest index i such that sum(weights[:i + 1]) > r, ie. the
+        index selected by a uniform sample r in [0, total()).
+        """
+        n = len(self.weights)
+        pos = 0
+        bit = self.top
+        while bit:
+            nxt = pos + bit
+            if nxt <= n and self.tree[nxt] <= r:
+                pos = nxt
+                r -= self.tree[nxt]
+            bit >>= 1
+        return min(pos, n - 1)
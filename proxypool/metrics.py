@@ -0,0 +1,142 @@
+import bisect
+import threading
+from collections import defaultdict
+
+# Upper bounds in seconds of the histogram buckets
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    """
+    Counts observations in fixed buckets, like a Prometheus histogram
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Returns (upper bound, number of observations <= upper bound) pairs
+        """
+        total = 0
+        pairs = []
+        for le, n in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            pairs.append((le, total))
+        return pairs
+
+
+class Metrics(object):
+    """
+    Counters, histograms and event hooks of a ProxyPool. Metrics are only
+    collected if an instance is passed to the pool, otherwise the cost is a
+    single check per event.
+
+    Events, with the keyword arguments passed to hooks:
+        attempt (proxy, host), success (proxy, host, latency),
+        failure (proxy, host, error), status (proxy, host, status_code),
+        down (proxy, host), cooldown (proxy, host, delay),
+        refresh (proxies)
+    """
+
+    COUNTERS = {
+        'attempt': 'proxypool_attempts_total',
+        'success': 'proxypool_successes_total',
+        'failure': 'proxypool_failures_total',
+        'status': 'proxypool_responses_total',
+        'down': 'proxypool_downs_total',
+        'cooldown': 'proxypool_cooldowns_total',
+        'refresh': 'proxypool_refreshes_total',
+    }
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counters = defaultdict(int)  # (name, labels) -> count
+        self.histograms = {}  # name -> Histogram
+        self.hooks = defaultdict(list)  # event -> callbacks
+
+    def add_hook(self, event, callback):
+        """
+        Calls callback(event, **info) whenever event occurs
+        """
+        self.hooks[event].append(callback)
+
+    def inc(self, name, labels=(), n=1):
+        """
+        :labels: Tuple of (label, value) pairs
+        """
+        with self.lock:
+            self.counters[(name, labels)] += n
+
+    def observe(self, name, value):
+        with self.lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = Histogram(self.buckets)
+            h.observe(value)
+
+    def emit(self, event, **info):
+        """
+        Counts event and calls its hooks
+        """
+        labels = ()
+        if event == 'failure':
+            labels = (('error', info['error'].__class__.__name__),)
+        elif event == 'status':
+            labels = (('code', str(info['status_code'])),)
+        self.inc(self.COUNTERS[event], labels)
+        if event == 'success':
+            self.observe('proxypool_request_latency_seconds', info['latency'])
+        for callback in self.hooks.get(event, ()):
+            callback(event, **info)
+
+    def snapshot(self):
+        """
+        Returns a copy of all metrics as plain data
+        """
+        with self.lock:
+            return {
+                'counters': dict(('%s%s' % (name, _format_labels(labels)), n)
+                                 for (name, labels), n in self.counters.items()),
+                'histograms': dict((name, {'buckets': h.cumulative(),
+                                           'sum': h.sum,
+                                           'count': h.count})
+                                   for name, h in self.histograms.items()),
+            }
+
+    def to_prometheus(self):
+        """
+        Returns all metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            names = sorted(set(name for name, _ in self.counters))
+            for name in names:
+                lines.append('# TYPE %s counter' % name)
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append('%s%s %d' % (name, _format_labels(labels), value))
+            for name, h in sorted(self.histograms.items()):
+                lines.append('# TYPE %s histogram' % name)
+                for le, count in h.cumulative():
+                    le = '+Inf' if le == float('inf') else repr(le)
+                    lines.append('%s_bucket{le="%s"} %d' % (name, le, count))
+                lines.append('%s_sum %r' % (name, h.sum))
+                lines.append('%s_count %d' % (name, h.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, v) for k, v in labels)
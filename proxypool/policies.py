@@ -0,0 +1,145 @@
+import math
+import random
+
+from .stats import decay_factor
+
+
+class SelectionPolicy(object):
+    """
+    Decides how a ProxyPool samples proxies. The pool keeps an index of the
+    sampling weights of its proxies, from which it draws candidates in
+    O(log n), and the policy chooses among the candidates. Proxies with a
+    weight of 0 are considered excluded from the pool.
+
+    Metrics are read from the StatsStore of the pool. Policies keeping their
+    own state can override on_outcome().
+    """
+
+    # Number of candidates drawn by weight from the index per sample
+    candidates = 1
+    # Number of candidates drawn uniformly among the proxies not excluded
+    explore_candidates = 0
+
+    def weight(self, pool, stats, i, now):
+        """
+        Returns the sampling weight of row i of stats
+        """
+        raise NotImplementedError
+
+    def weights(self, pool, stats, now):
+        """
+        Returns the sampling weights of all rows of stats
+        """
+        return [self.weight(pool, stats, i, now) for i in range(len(stats))]
+
+    def choose(self, pool, candidates, host):
+        """
+        Returns one of the candidates drawn for a request to host
+        """
+        return candidates[0]
+
+    def on_outcome(self, p, host, failed):
+        """
+        Called when a request through proxy p to host succeeded or failed
+        """
+        pass
+
+
+class InverseLatency(SelectionPolicy):
+    """
+    Samples proxies with a probability proportional to 1 / smoothed latency,
+    excluding proxies above the failrate limit of the pool. New proxies get
+    an optimistic latency, so that they are tried quickly.
+    """
+
+    def weight(self, pool, stats, i, now):
+        return stats.weight(i, pool.max_proxy_failrate, now, pool.failure_half_life)
+
+    def weights(self, pool, stats, now):
+        # Vectorized if numpy is available
+        return stats.weights(pool.max_proxy_failrate, now, pool.failure_half_life)
+
+
+def _success_probability(stats, i, now, half_life):
+    """
+    Posterior mean of the success probability of row i, with a uniform prior
+    """
+    k = decay_factor(now - stats.updated[i], half_life)
+    return (stats.recent_successes[i] * k + 1.0) / \
+        ((stats.recent_successes[i] + stats.recent_failures[i]) * k + 2.0)
+
+
+class PowerOfTwoChoices(SelectionPolicy):
+    """
+    Draws two proxies uniformly at random, and uses the one with the highest
+    expected throughput of successful requests (success probability divided
+    by latency). Spreads load more evenly than InverseLatency, while still
+    avoiding slow and failing proxies.
+    """
+
+    candidates = 0
+    explore_candidates = 2
+
+    def weight(self, pool, stats, i, now):
+        if stats.excluded(i, pool.max_proxy_failrate, now, pool.failure_half_life):
+            return 0.0
+        return 1.0
+
+    def choose(self, pool, candidates, host):
+        now = pool.clock()
+        return max(candidates, key=lambda p: _success_probability(
+            p.store, p.index, now, pool.failure_half_life) / p.t)
+
+
+class ThompsonSampling(SelectionPolicy):
+    """
+    Bandit maximizing the expected throughput of successful requests, ie.
+    success probability divided by latency.
+
+    Candidates are drawn from the index by their posterior mean throughput,
+    and uniformly among all proxies for exploration. The candidate with the
+    highest throughput drawn from its posterior is used: a Beta distribution
+    of the recent outcomes for the success probability, and a log-normal
+    distribution around the smoothed latency that narrows as latency samples
+    accumulate. Proxies without latency samples are assumed to have the median
+    latency of the pool instead of an optimistic latency, so that they are
+    explored without soaking up traffic before they have been measured.
+    """
+
+    def __init__(self, candidates=2, explore_candidates=2, prior_latency=1.0):
+        """
+        :candidates: Number of candidates drawn by posterior mean per sample
+        :explore_candidates: Number of candidates drawn uniformly per sample
+        :prior_latency: Latency in seconds assumed for proxies without samples
+            before the pool has measured any latencies
+        """
+        self.candidates = candidates
+        self.explore_candidates = explore_candidates
+        self.prior_latency = prior_latency
+
+    def __latency(self, pool, stats, i):
+        if stats.window_len[i]:
+            return stats.t[i]
+        median = pool.latencies.quantile(0.5)
+        return median if median is not None else self.prior_latency
+
+    def weight(self, pool, stats, i, now):
+        if stats.excluded(i, pool.max_proxy_failrate, now, pool.failure_half_life):
+            return 0.0
+        return _success_probability(stats, i, now, pool.failure_half_life) / \
+            self.__latency(pool, stats, i)
+
+    def choose(self, pool, candidates, host):
+        now = pool.clock()
+        best = None
+        for p in candidates:
+            stats, i = p.store, p.index
+            k = decay_factor(now - stats.updated[i], pool.failure_half_life)
+            success = random.betavariate(stats.recent_successes[i] * k + 1.0,
+                                         stats.recent_failures[i] * k + 1.0)
+            latency = self.__latency(pool, stats, i) * random.lognormvariate(
+                0.0, 1.0 / math.sqrt(stats.window_len[i] + 1))
+            score = success / latency
+            if best is None or score > best[0]:
+                best = (score, p)
+        return best[1]
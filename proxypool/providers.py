@@ -1,69 +1,280 @@
+import codecs
+import hashlib
+import logging
 import re
+import time
 
 import requests
 
+from .threadpool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+IPV4 = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
+
+PROTOCOLS = ["http", "https", "socks4", "socks5"]
+
+
+def normalize_proxy_url(url):
+    """
+    Returns url in a canonical form, so that a proxy provided with different
+    spellings is only used once, eg. "HTTP://010.0.0.1:080/" -> "http://10.0.0.1:80"
+    """
+    scheme, sep, rest = url.strip().partition('://')
+    if not sep:
+        return url.strip()
+    userinfo, at, hostport = rest.rstrip('/').rpartition('@')
+    host, colon, port = hostport.rpartition(':')
+    if not colon or not port.isdigit():
+        host, port = hostport, None
+    host = host.lower()
+    if IPV4.match(host):
+        host = '.'.join(str(int(octet)) for octet in host.split('.'))
+    if port is not None:
+        host = '%s:%d' % (host, int(port))
+    return '%s://%s%s%s' % (scheme.lower(), userinfo, at, host)
+
+
+def proxy_dict(url):
+    """
+    Returns the proxies argument of requests using the proxy url for both http
+    and https targets. Assumes that HTTP proxies also can handle HTTPS.
+    """
+    return {'http': url.replace('https://', 'http://'),
+            'https': url.replace('http://', 'https://')}
+
+
+def _scan(pattern, text, overlap, final):
+    """
+    Returns the matches of pattern in text that the next chunk of a streamed
+    page can't change, and the rest of text to scan again with the next chunk
+    """
+    matches = []
+    keep = max(0, len(text) - overlap)
+    for m in pattern.finditer(text):
+        if not final and m.end() > len(text) - overlap:
+            # May be cut off by the end of the chunk
+            keep = m.start()
+            break
+        matches.append(m)
+        keep = max(keep, m.end())
+    return matches, '' if final else text[keep:]
+
+
+class ProviderStats(object):
+    """
+    Outcome of the last update of a provider
+    """
+
+    def __init__(self):
+        self.pages = 0  # Pages requested
+        self.not_modified = 0  # Pages skipped as not modified per ETag or Last-Modified
+        self.unchanged = 0  # Pages with the same content hash as in the previous update
+        self.bytes = 0  # Bytes downloaded
+        self.parse_time = 0.0  # Seconds spent parsing
+        self.duration = 0.0  # Seconds the update took
+        self.proxies = 0  # Number of proxies provided
+
 
 class ProxyProvider(object):
     """
     Provides proxies, eg. "socks5://1.1.1.1:5000"
     """
 
+    # ProviderStats of the last update, if the provider keeps them
+    stats = None
+
     def update(self):
         raise NotImplementedError
 
 
-class SocksProxy(ProxyProvider):
+class _Page(object):
+    """
+    State of a scraped page from the previous update
+    """
+    __slots__ = ('validators', 'digest', 'proxies')
 
-    def update(self):
-        r = requests.get('https://www.socks-proxy.net/')
-        t = r.text
+    def __init__(self, validators, digest, proxies):
+        self.validators = validators
+        self.digest = digest
+        self.proxies = proxies
 
-        ps = set()
-        for m in re.findall(
-            r"<tr><td>(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})<\/td><td>(\d+)<\/td><td>.*?<\/td><td class='hm'>.*?<\/td><td>(\w+?)<\/td>",
-                t):
-            ip = m[0]
-            port = m[1]
-            prot = m[2].lower()
-            assert prot in ["http", "https", "socks4", "socks5"]
-            ps.add("%s://%s:%s" % (prot, ip, port))
-        return ps
 
+class ScrapingProvider(ProxyProvider):
+    """
+    Base class of providers scraping proxy lists from web pages. The pages are
+    fetched concurrently, and parsed with the pattern of the class while they
+    are downloaded. Pages are requested with If-None-Match or If-Modified-Since
+    after the first update, and not parsed again if the server answers that
+    they weren't modified. Pages fetched before are downloaded in full and
+    hashed before they are parsed, and keep their previous proxies without
+    being parsed again if their content hash didn't change.
+
+    Subclasses set pattern, a compiled regular expression, and url or pages(),
+    and implement proxy().
+    """
+
+    pattern = None
+    url = None
+    # Characters kept between chunks, at least the length of a match
+    overlap = 4096
+    chunk_size = 16 * 1024
+
+    def __init__(self, parallelism=4, timeout=30.0):
+        """
+        :parallelism: Maximum number of pages fetched concurrently
+        :timeout: Timeout of a page request in seconds
+        """
+        self.parallelism = parallelism
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.state = {}  # page -> _Page
+        self.stats = ProviderStats()
+
+    def pages(self):
+        """
+        Returns the pages to scrape, as (method, url, form data items) tuples
+        """
+        return [('GET', self.url, None)]
+
+    def proxy(self, m):
+        """
+        Returns the proxy url of match m of pattern, or None to skip it
+        """
+        raise NotImplementedError
+
+    def __parse(self, chunks, encoding):
+        """
+        Returns the proxies in the chunks of a page, and the seconds spent
+        parsing them
+        """
+        decoder = codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+        proxies = set()
+        parse_time = 0.0
+        text = ''
+        while True:
+            chunk = next(chunks, None)
+            final = chunk is None
+            t0 = time.time()
+            text += decoder.decode(chunk or b'', final)
+            matches, text = _scan(self.pattern, text, self.overlap, final)
+            for m in matches:
+                proxy = self.proxy(m)
+                if proxy is not None:
+                    proxies.add(proxy)
+            parse_time += time.time() - t0
+            if final:
+                return proxies, parse_time
+
+    def __fetch(self, page):
+        """
+        Returns the proxies of page, the number of bytes downloaded, the
+        seconds spent parsing and whether the page was 'not_modified',
+        'unchanged' or None
+        """
+        method, url, data = page
+        previous = self.state.get(page)
+        headers = previous.validators if previous is not None else {}
+        r = self.session.request(method, url, data=dict(data) if data else None,
+                                 headers=headers, stream=True, timeout=self.timeout)
+        try:
+            if r.status_code == 304 and previous is not None:
+                return previous.proxies, 0, 0.0, 'not_modified'
+            r.raise_for_status()
+            digest = hashlib.sha1()
+            sizes = []
+
+            def read():
+                for chunk in r.iter_content(self.chunk_size):
+                    digest.update(chunk)
+                    sizes.append(len(chunk))
+                    yield chunk
+
+            if previous is None:
+                proxies, parse_time = self.__parse(read(), r.encoding)
+                unchanged = False
+            else:
+                # Download and hash the page before parsing it, so that an
+                # unchanged page isn't parsed again
+                chunks = list(read())
+                unchanged = digest.hexdigest() == previous.digest
+                proxies, parse_time = previous.proxies, 0.0
+                if not unchanged:
+                    proxies, parse_time = self.__parse(iter(chunks), r.encoding)
+        finally:
+            r.close()
 
-class SslProxies(ProxyProvider):
+        validators = {}
+        if r.headers.get('ETag'):
+            validators['If-None-Match'] = r.headers['ETag']
+        if r.headers.get('Last-Modified'):
+            validators['If-Modified-Since'] = r.headers['Last-Modified']
+        self.state[page] = _Page(validators, digest.hexdigest(), proxies)
+        return proxies, sum(sizes), parse_time, 'unchanged' if unchanged else None
 
     def update(self):
-        r = requests.get('https://www.sslproxies.org/')
-        t = r.text
+        t0 = time.time()
+        pages = self.pages()
+        if len(pages) == 1:
+            results = [self.__fetch(pages[0])]
+        else:
+            with ThreadPool(min(self.parallelism, len(pages)), queue_size=0) as tp:
+                results = [f.result() for f in
+                           tp.map(self.__fetch, [((page,), {}) for page in pages])]
 
+        stats = ProviderStats()
         ps = set()
-        for m in re.findall(
-            r"<tr><td>(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})<\/td><td>(\d+)<\/td>",
-                t):
-            ip = m[0]
-            port = m[1]
-            prot = "https"
-            assert prot in ["http", "https", "socks4", "socks5"]
-            ps.add("%s://%s:%s" % (prot, ip, port))
+        for proxies, size, parse_time, status in results:
+            ps.update(proxies)
+            stats.pages += 1
+            stats.bytes += size
+            stats.parse_time += parse_time
+            if status is not None:
+                setattr(stats, status, getattr(stats, status) + 1)
+        stats.proxies = len(ps)
+        stats.duration = time.time() - t0
+        self.stats = stats
+        logger.debug("%s: %d proxies from %d pages (%d not modified, %d unchanged), "
+                     "parsed in %.3f sec", self.__class__.__name__, stats.proxies,
+                     stats.pages, stats.not_modified, stats.unchanged, stats.parse_time)
         return ps
 
 
-class GatherProxy(ProxyProvider):
+class SocksProxy(ScrapingProvider):
 
-    def update(self):
-        ps = set()
-        for i in range(3):
-            r = requests.post(
-                'http://www.gatherproxy.com/proxylist/anonymity/?t=Elite', data={'PageIdx': i + 1,
-                                                                                 'Type': 'Elite',
-                                                                                 'Uptime': 0})
-            t = r.text
-            for m in re.findall(r"<td><script>document\.write\('(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'\)<\/script><\/td>\s*<td><script>document\.write\(gp\.dep\('([0-9A-F]+)'\)\)<\/script><\/td>", t):
-                ip = m[0]
-                port = int(m[1], 16)
-                ps.add('http://%s:%d' % (ip, port))
+    url = 'https://www.socks-proxy.net/'
+    pattern = re.compile(
+        r"<tr><td>(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})<\/td><td>(\d+)<\/td><td>.*?<\/td><td class='hm'>.*?<\/td><td>(\w+?)<\/td>")
 
-        return ps
+    def proxy(self, m):
+        prot = m.group(3).lower()
+        if prot not in PROTOCOLS:
+            return None
+        return "%s://%s:%s" % (prot, m.group(1), m.group(2))
+
+
+class SslProxies(ScrapingProvider):
+
+    url = 'https://www.sslproxies.org/'
+    pattern = re.compile(
+        r"<tr><td>(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})<\/td><td>(\d+)<\/td>")
+
+    def proxy(self, m):
+        return "https://%s:%s" % (m.group(1), m.group(2))
+
+
+class GatherProxy(ScrapingProvider):
+
+    url = 'http://www.gatherproxy.com/proxylist/anonymity/?t=Elite'
+    pattern = re.compile(
+        r"<td><script>document\.write\('(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'\)<\/script><\/td>\s*<td><script>document\.write\(gp\.dep\('([0-9A-F]+)'\)\)<\/script><\/td>")
+
+    def pages(self):
+        return [('POST', self.url, (('PageIdx', i + 1), ('Type', 'Elite'), ('Uptime', 0)))
+                for i in range(3)]
+
+    def proxy(self, m):
+        return 'http://%s:%d' % (m.group(1), int(m.group(2), 16))
 
 
 class Tor(ProxyProvider):
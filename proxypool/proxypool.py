@@ -1,13 +1,86 @@
 #!/usr/bin/env python
+import functools
 import random
 import threading
 import logging
 import time
+from collections import OrderedDict, deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
 
 import requests
 
+from .cooldown import CooldownScheduler, parse_retry_after
+from .fenwick import FenwickTree
+from .policies import InverseLatency
+from .providers import normalize_proxy_url, proxy_dict
+from .sessions import SessionCache
+from .stats import HostStats, LatencyWindow, StatsStore
+from .threadpool import ThreadPool
+
 logger = logging.getLogger(__name__)
 
+# Outcomes of an attempt through a proxy
+SUCCESS = 'success'
+FAILURE = 'failure'
+RATE_LIMITED = 'rate_limited'
+
+# Returned instead of a delay when all usable proxies are at their maximum
+# concurrency
+SATURATED = 'saturated'
+
+# Methods that are safe to send more than once, eg. when hedging
+IDEMPOTENT_METHODS = ['get', 'head', 'options']
+
+
+def _discard_response(future):
+    """
+    Releases the connection of a response nobody is interested in anymore
+    """
+    if not future.cancelled() and future.exception() is None:
+        _, r = future.result()
+        if r is not None:
+            r.close()
+
+
+def _column(name):
+    """
+    Returns a property accessing column name of a ProxyInst's row in its StatsStore
+    """
+    def get(self):
+        return getattr(self.store, name)[self.index]
+
+    def set(self, value):
+        getattr(self.store, name)[self.index] = value
+
+    return property(get, set)
+
+
+def _session_get(pool, session, *args, **kwargs):
+    """
+    Unwrapped get, for attempts made outside of the API wrappers
+    """
+    return session.get(*args, **kwargs)
+
+
+def _target_host(apifunc, args, kwargs):
+    """
+    Returns the host of the url a wrapped API call is made to
+    """
+    url = kwargs.get('url')
+    if url is None:
+        # args are (self, url, ...), or (self, method, url, ...) for request()
+        pos = 2 if apifunc.__name__ == 'request' else 1
+        url = args[pos] if len(args) > pos else ''
+    return urlparse(url).netloc.lower()
+
 
 class ProxyPool(object):
     """
@@ -19,119 +92,257 @@ class ProxyPool(object):
     Proxies are chosen at random, with higher probability of being sampled the lower
     latency the proxy has. Proxies causing a lot of connection failures are excluded
     from the pool if the failrate exceeds a configurable threshold. If all proxies become
-    excluded, an update from the ProxyProviders is performed again.
+    excluded, an update from the ProxyProviders is performed again. Optionally, updates
+    are performed in the background already when the number of good proxies runs low.
+    Proxies still provided after an update keep their metrics.
 
     HTTP errors 503 and 429 are considered as probable rate-limits from the web hosting
-    provider and a backoff of the entire pool is performed before new attempts are made.
+    provider. The proxy is put in a cooldown for the target host, honoring Retry-After
+    or backing off exponentially, and the request is retried through another proxy.
     HTTP error 403 is considered as a blackist of the proxy by the web hosting provider,
-    as the provided url is assumed to be correct. After a configurable amount of failures
+    as the provided url is assumed to be correct, and the proxy is no longer used for
+    that host. Latency and failrate are also tracked per target host, and taken into
+    account when sampling a proxy for a request. If all proxies are banned by or failing
+    for a host, they get a fresh start for it. After a configurable amount of failures
     an exception is thrown to highlight that something might be erroneous with the reqest.  
+
+    Latencies are smoothed, and failrates only consider recent outcomes, so that proxies
+    excluded for failing recover over time. Optionally, proxies marked as down are
+    re-probed in the background and brought back if they respond again. Metrics can
+    be saved to a ReputationStore, from which new pools restore them on startup.
+
+    Requests in flight through each proxy are counted. Busy proxies are less likely to
+    be sampled, and proxies at their maximum concurrency are skipped. Optionally, a
+    RateLimiter paces the requests to each target host, to stay below its rate limits,
+    and a ResponseCache answers repeated GET and HEAD requests without using a proxy.
+    Attempts can be recorded with a TraceRecorder, to tune the parameters of the pool
+    offline with a Simulator.
     """
 
+    # Weight of a new latency sample in the smoothed latency of a proxy
+    LATENCY_SMOOTHING = 0.3
+    # Number of locks shared by the proxies of a pool
+    LOCK_STRIPES = 64
+
     class ProxyInst(object):
         """
-        Represents a proxy combined with its metrics (latency, failrate, etc)
+        Represents a proxy combined with its metrics (latency, failrate, etc).
+        A thin view of a row in the StatsStore of the pool.
         """
+        __slots__ = ('proxypool', 'url', 'store', 'index')
 
-        def __init__(self, ppref, url):
+        def __init__(self, ppref, url, store=None, index=0):
             """
             :url: eg. "{http,https,socks4,socks5}://37.59.8.29:39867"
+            :store: StatsStore holding the metrics of the proxy at row index,
+                a private one if not given
             """
-            self.proxypool = ppref  # Needed to lock pool for concurrency
+            self.proxypool = ppref
             self.url = url
-            # Assume an initially small latency to give the proxy high
-            # probability of being sampled.
-            self.t = 1e-3
-            self.w = 1 / self.t
-            self.failures = 0
-            self.successes = 0
-            self.down = False
-            self.sample_counter = 0
+            self.store = store if store is not None else StatsStore(1, now=ppref.clock())
+            self.index = index  # Also the position in the pool's sampling index
+
+        t = _column('t')
+        successes = _column('successes')
+        failures = _column('failures')
+        down = _column('down')
+        sample_counter = _column('sample_counter')
+        in_flight = _column('in_flight')
+
+        @property
+        def max_concurrency(self):
+            """
+            Maximum number of leased requests in flight through the proxy,
+            the max_concurrency of the pool unless set. 0 means unlimited.
+            """
+            return self.store.max_in_flight[self.index] or self.proxypool.max_concurrency
+
+        @max_concurrency.setter
+        def max_concurrency(self, n):
+            self.store.max_in_flight[self.index] = n
+
+        @property
+        def lock(self):
+            """
+            Lock guarding the metrics of the proxy, shared with a fraction of
+            the other proxies of the pool
+            """
+            stripes = self.proxypool.stripes
+            return stripes[hash(self.url) % len(stripes)]
+
+        @property
+        def hosts(self):
+            """
+            host -> HostStats, for the target hosts the proxy has been used for
+            """
+            hosts = self.store.hosts[self.index]
+            if hosts is None:
+                hosts = self.store.hosts[self.index] = {}
+            return hosts
 
         def __str__(self):
-            return "%s: latency: %f (%d/%d=%.2f failrate)" % (self.url, self.t,
-                                                              self.failures,
-                                                              self.failures + self.successes,
-                                                              self.failrate())
+            return "%s: latency: %f (p95 %f) (%d/%d=%.2f failrate)" % (self.url, self.t,
+                                                                       self.latency_quantile(0.95) or 0,
+                                                                       self.failures,
+                                                                       self.failures + self.successes,
+                                                                       self.failrate())
 
         def as_dict(self):
             """
             Provides a requests friendly representation of the proxy.
             Assumes that HTTP proxies also can handle HTTPS.
             """
-            return {'http': self.url.replace('https://', 'http://'),
-                    'https': self.url.replace('http://', 'https://')}
+            return proxy_dict(self.url)
 
         def failrate(self):
             """
-            Returns the failrate of the proxy in the range [0,1).
+            Returns the recent failrate of the proxy in the range [0,1).
+            """
+            return self.store.failrate(self.index, self.proxypool.clock(), self.proxypool.failure_half_life)
+
+        def latency_quantile(self, q):
+            """
+            Returns the q-quantile of the recent latencies, or None if unknown
             """
-            return self.failures / (self.successes + self.failures + 1e-7)
+            return self.store.latency_quantile(self.index, q)
 
-        def set_latency(self, t):
+        def _add_latency(self, t):
+            """
+            Must be called inside the proxy's lock
+            """
+            self.store.add_latency(self.index, t, ProxyPool.LATENCY_SMOOTHING)
+
+        def weight(self):
+            """
+            Returns the unnormalized sampling weight of the proxy, 0 if it is
+            excluded from the pool.
+            """
+            return self.proxypool.policy.weight(self.proxypool, self.store, self.index, self.proxypool.clock())
+
+        def __host_stats(self, host):
+            """
+            Must be called inside the proxy's lock
+            """
+            hs = self.hosts.get(host)
+            if hs is None:
+                hs = self.hosts[host] = HostStats(self.proxypool.clock())
+            return hs
+
+        def acceptance(self, host):
+            """
+            Returns the probability of using the proxy for host when it has been
+            sampled by its weight: 0 if it is banned by or failing for host, and
+            less than 1 if it is slower towards host than on average.
+            Reads the metrics without the proxy's lock, a concurrent update is
+            picked up by the next sample.
+            """
+            hosts = self.store.hosts[self.index]
+            hs = hosts.get(host) if hosts is not None else None
+            if hs is None:
+                return 1.0
+            if hs.down or (hs.rate(self.proxypool.clock(), self.proxypool.failure_half_life) >=
+                           self.proxypool.max_proxy_failrate):
+                return 0.0
+            if hs.t is None or hs.t <= self.t:
+                return 1.0
+            return self.t / hs.t
+
+        def set_latency(self, t, host=None):
             """
             :t: response time in seconds
+            :host: target host of the request, if known
             """
-            with self.proxypool.lock:
-                self.t = t
+            with self.lock:
+                self._add_latency(t)
+                if host:
+                    self.__host_stats(host).add_latency(t, ProxyPool.LATENCY_SMOOTHING)
+            self.proxypool.latencies.add(t)
+            self.proxypool._invalidate(self)
 
-        def increase_successes(self):
-            with self.proxypool.lock:
-                self.successes += 1
+        def increase_successes(self, host=None):
+            with self.lock:
+                now = self.proxypool.clock()
+                self.store.add_outcome(self.index, False, now, self.proxypool.failure_half_life)
+                if host:
+                    self.__host_stats(host).add_outcome(
+                        False, now, self.proxypool.failure_half_life)
+            self.proxypool._invalidate(self)
+            self.proxypool.policy.on_outcome(self, host, False)
 
-        def increase_failures(self):
-            with self.proxypool.lock:
-                self.failures += 1
+        def increase_failures(self, host=None):
+            with self.lock:
+                now = self.proxypool.clock()
+                self.store.add_outcome(self.index, True, now, self.proxypool.failure_half_life)
+                if host:
+                    self.__host_stats(host).add_outcome(
+                        True, now, self.proxypool.failure_half_life)
+            self.proxypool._invalidate(self)
+            self.proxypool.policy.on_outcome(self, host, True)
 
-        def set_down(self):
-            with self.proxypool.lock:
-                self.down = True
+        def release(self):
+            """
+            Ends a lease of the proxy taken by get_proxy(lease=True)
+            """
+            with self.lock:
+                self.in_flight -= 1
+            self.proxypool._released()
+
+        def set_down(self, host=None):
+            """
+            Stops using the proxy, or only for host if given
+            """
+            if host:
+                with self.lock:
+                    self.__host_stats(host).down = True
+            else:
+                with self.lock:
+                    self.down = 1
+                self.proxypool._invalidate(self)
+                self.proxypool.sessions.evict(self.url)
+            if self.proxypool.metrics is not None:
+                self.proxypool.metrics.emit('down', proxy=self, host=host)
 
     class Decorators(object):
         @classmethod
         def with_proxypool(cls, apifunc):
+            @functools.wraps(apifunc)
             def proxypool_caller(*args, **kwargs):
                 self = args[0]
+                host = _target_host(apifunc, args, kwargs)
                 failures = 0
 
+                method = args[1] if apifunc.__name__ == 'request' and len(args) > 1 else \
+                    kwargs.get('method', apifunc.__name__)
+                hedge = self.max_hedge_ratio > 0 and method.lower() in IDEMPOTENT_METHODS
+                # Total time for the request, across all attempts
+                deadline = kwargs.pop('deadline', None)
+                expires = time.time() + deadline if deadline is not None else None
+                # The first attempt was already admitted by the rate limiter
+                throttled = kwargs.pop('throttled', False)
+
                 while True:
-                    p = self.get_proxy()
-                    logger.info("Using %s" % p)
-                    kwargs['proxies'] = p.as_dict()
-                    kwargs['timeout'] = self.default_timeout
-                    try:
-                        r = apifunc(*args, **kwargs)
-                    except (requests.exceptions.ConnectionError,
-                            requests.exceptions.ChunkedEncodingError,
-                            requests.exceptions.ReadTimeout) as e:
-                        logger.debug("%s: %s" % (p.url, e))
-                        p.increase_failures()
-                        failures += 1
+                    if not throttled:
+                        self.throttle(host, expires)
+                    throttled = False
+                    timeout = None
+                    if expires is not None:
+                        timeout = max(0.0, expires - time.time())
+                    p = self.get_proxy(host, lease=True, timeout=timeout, expires=expires)
+                    if hedge:
+                        # Releases the lease when the attempt is done
+                        outcome, r = self._hedged_attempt(apifunc, p, host, args, kwargs, expires)
                     else:
-                        if r.status_code in [403]:
-                            logger.debug(
-                                "%s: Down due to http status %d" %
-                                (p.url, r.status_code))
-                            # The proxy is assumed to be banned, so mark it as
-                            # down immediately
-                            p.set_down()
-                            failures += 1
-                        elif r.status_code in [429, 503]:
-                            logger.debug(
-                                "%s: Probable rate limit due to http status %d" %
-                                (p.url, r.status_code))
-                            logger.debug(r.headers)
-                            time.sleep(60)
-                            # TODO: penalize only affected proxy and not entire
-                            # pool
-                            # TODO: Handle Retry-After
-                        else:
-                            logger.debug(
-                                "%s: Latency %.2f sec" %
-                                (p.url, r.elapsed.total_seconds()))
-                            p.set_latency(r.elapsed.total_seconds())
-                            p.increase_successes()
-                            return r
+                        try:
+                            outcome, r = self._attempt(apifunc, p, host, args, kwargs, expires)
+                        finally:
+                            p.release()
+                    if outcome == SUCCESS:
+                        return r
+                    elif r is not None:
+                        # The body may be unread if streamed
+                        r.close()
+                    if outcome == FAILURE:
+                        failures += 1
 
                     if failures > self.max_proxy_attempts:
                         raise Exception(
@@ -139,21 +350,140 @@ class ProxyPool(object):
                             kwargs)
             return proxypool_caller
 
-    def __init__(self, providers, connection_retries=30, default_timeout=5.0, max_proxy_failrate=0.1):
+        @classmethod
+        def with_cache(cls, apifunc):
+            @functools.wraps(apifunc)
+            def cache_caller(*args, **kwargs):
+                self = args[0]
+                if self.cache is None or len(args) > 2:
+                    return apifunc(*args, **kwargs)
+                url = kwargs.pop('url') if 'url' in kwargs else args[1]
+                return self.cache.request(apifunc.__name__.upper(), url, kwargs,
+                                          lambda kw: apifunc(self, url, **kw))
+            return cache_caller
+
+    def __init__(self, providers, connection_retries=30, default_timeout=5.0, max_proxy_failrate=0.1,
+                 connect_timeout=None, min_timeout=1.0, timeout_factor=4.0, timeout_quantile=0.95,
+                 max_sessions=256, session_pool_size=10, refresh_watermark=0, min_refresh_interval=60.0,
+                 validator=None, failure_half_life=600.0, reprobe_interval=None,
+                 max_hedge_ratio=0.0, hedge_quantile=0.9, hedge_workers=16, metrics=None,
+                 reputation=None, checkpoint_interval=60.0, policy=None,
+                 max_concurrency=0, lease_timeout=None, rate_limiter=None, cache=None,
+                 trace=None, clock=time.time):
         """
         :providers: List of ProxyProvider instances that are used for providing proxies
         :connection_retries: Number of attempts to get an URL, via different proxies, 
             before raising an exception
-        :default_timeout: Connection timeout, passed to requests as a 'timeout' argument
+        :default_timeout: Upper bound of the read timeout through a proxy, unless the
+            caller passes a 'timeout' argument
+        :connect_timeout: Upper bound of the connect timeout through a proxy,
+            default_timeout if None
+        :min_timeout: Lower bound of the adaptive timeouts
+        :timeout_factor: Timeouts through a proxy are timeout_factor times the
+            timeout_quantile of its recent latencies, within the bounds
+        :timeout_quantile: See timeout_factor
         :max_proxy_failrate: Failure limit of a proxy before considering it bad and stop using it
+        :max_sessions: Number of proxies to keep persistent (keep-alive) sessions for
+        :session_pool_size: Maximum number of connections kept alive per proxy and target host
+        :refresh_watermark: Refresh from the providers in the background when fewer good
+            proxies than this remain
+        :min_refresh_interval: Minimum number of seconds between background refreshes
+        :validator: Optional ProxyValidator probing new proxies before they are admitted
+            to the pool
+        :failure_half_life: Seconds until a failure counts half in the failrate of a proxy.
+            Proxies excluded for their failrate are reconsidered every tenth of it.
+        :reprobe_interval: If set, seconds between background attempts to bring back
+            excluded proxies. Proxies marked as down are only brought back if they
+            pass the validator.
+        :max_hedge_ratio: Maximum fraction of GET/HEAD/OPTIONS attempts that are
+            hedged, ie. also sent through a second proxy when the first one is slow.
+            0 disables hedging.
+        :hedge_quantile: Quantile of the recent latencies of the pool after which an
+            attempt is hedged
+        :hedge_workers: Number of threads sending hedges, the first attempt of a request
+            runs on the calling thread
+        :metrics: Optional Metrics instance collecting counters, histograms and
+            calling event hooks
+        :reputation: Optional ReputationStore the metrics of new proxies are loaded
+            from, and the metrics of the pool are saved to
+        :checkpoint_interval: Seconds between saves to the reputation store
+        :policy: SelectionPolicy deciding how proxies are sampled, InverseLatency
+            by default
+        :max_concurrency: Default maximum number of requests in flight through a
+            proxy, 0 for unlimited. Proxies with requests in flight are less
+            likely to be sampled either way.
+        :lease_timeout: Seconds to wait for a proxy when all are at their maximum
+            concurrency before raising an exception, None to wait indefinitely
+        :rate_limiter: Optional RateLimiter pacing the requests to target hosts
+        :cache: Optional ResponseCache answering GET and HEAD requests
+        :trace: Optional TraceRecorder recording every attempt
+        :clock: Function returning the current time in seconds, that the metrics
+            of the proxies and the cooldowns are kept in, eg. a virtual clock
+            when simulating. Waits and deadlines are in real time regardless.
         """
         self.providers = providers
-        self.proxies = set()
+        self.clock = clock
+        self.metrics = metrics
+        self.policy = policy if policy is not None else InverseLatency()
+        self.proxies = []
+        self.stats = StatsStore(0)
+        self.index = FenwickTree()
+        # Guards the proxy list and the sampling index
         self.lock = threading.Lock()
+        # Guard the metrics of the proxies, so that reporting an outcome
+        # doesn't contend with sampling or with most other reports
+        self.stripes = [threading.Lock() for _ in range(ProxyPool.LOCK_STRIPES)]
+        # Proxies whose metrics changed since the sampling index was updated
+        self.dirty = {}
+        self.max_concurrency = max_concurrency
+        self.lease_timeout = lease_timeout
+        # Number of leases ended, and of threads waiting for one to end
+        self.releases = 0
+        self.lease_waiters = 0
+        self.released = threading.Condition(self.lock)
         self.max_proxy_attempts = connection_retries
         self.default_timeout = default_timeout
+        self.connect_timeout = connect_timeout if connect_timeout is not None else default_timeout
+        self.min_timeout = min_timeout
+        self.timeout_factor = timeout_factor
+        self.timeout_quantile = timeout_quantile
         self.max_proxy_failrate = max_proxy_failrate
         self.provider_updates = 0
+        self.num_good = 0
+        self.refresh_watermark = refresh_watermark
+        self.min_refresh_interval = min_refresh_interval
+        self.last_refresh = 0.0
+        self.refreshing = False
+        self.refreshed = threading.Condition(self.lock)
+        self.validator = validator
+        self.failure_half_life = failure_half_life
+        # Seconds between re-evaluations of the weights of excluded proxies,
+        # which don't report outcomes that would update them
+        self.reconsider_interval = failure_half_life / 10.0
+        self.last_reconsidered = 0.0
+        self.reprobe_interval = reprobe_interval
+        self.reprober = None
+        self.closed = threading.Event()
+        self.sessions = SessionCache(max_sessions=max_sessions,
+                                     pool_maxsize=session_pool_size)
+        self.cooldowns = CooldownScheduler(clock=clock)
+        # Number of tries to sample a proxy not cooling down for the target
+        # host, before falling back to a scan of the entire pool
+        self.max_rejections = 32
+        # Recent latencies of all proxies
+        self.latencies = LatencyWindow(size=256)
+        self.max_hedge_ratio = max_hedge_ratio
+        self.hedge_quantile = hedge_quantile
+        self.hedge_workers = hedge_workers
+        self.hedge_pool = None
+        self.hedgeable = 0
+        self.hedges = 0
+        self.reputation = reputation
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpointer = None
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.trace = trace
 
     def __str__(self):
         with self.lock:
@@ -164,88 +494,1106 @@ class ProxyPool(object):
     def __len__(self):
         return len(self.proxies)
 
-    @staticmethod
-    def __set_weights(gp):
+    @property
+    def good(self):
         """
-        Must be called inside lock
+        Number of proxies currently used for sampling
+        """
+        with self.lock:
+            self.__drain()
+            return self.num_good
+
+    def close(self):
+        """
+        Closes all persistent proxy connections and stops background work
+        """
+        self.closed.set()
+        if self.reputation is not None:
+            self.checkpoint()
+        if self.hedge_pool is not None:
+            self.hedge_pool.shutdown(wait=False)
+        self.sessions.clear()
+
+    def timeouts(self, p, bounds=None, expires=None):
+        """
+        Returns the (connect, read) timeouts of a request through proxy p,
+        adapted to its recent latencies.
+
+        :bounds: Upper bounds of the timeouts, as a scalar or a (connect, read)
+            tuple like the timeout argument of requests. The bounds of the pool
+            are used if None.
+        :expires: Point in time the timeouts may not exceed
+        """
+        if bounds is None:
+            bounds = (self.connect_timeout, self.default_timeout)
+        elif not isinstance(bounds, tuple):
+            bounds = (bounds, bounds)
+        connect, read = bounds
+        q = p.latency_quantile(self.timeout_quantile)
+        if q is not None:
+            t = max(self.min_timeout, self.timeout_factor * q)
+            connect = t if connect is None else min(connect, t)
+            read = t if read is None else min(read, t)
+        if expires is not None:
+            remaining = expires - time.time()
+            if remaining <= 0:
+                raise Exception("Deadline of request exceeded")
+            connect = remaining if connect is None else min(connect, remaining)
+            read = remaining if read is None else min(read, remaining)
+        return connect, read
+
+    def _throttle_delay(self, host, expires=None):
+        """
+        Reserves a request to host with the rate limiter, and returns the
+        seconds to wait before making it
+        """
+        if self.rate_limiter is None or not host:
+            return 0.0
+        delay = self.rate_limiter.reserve(host)
+        if expires is not None and time.time() + delay > expires:
+            self.rate_limiter.cancel(host)
+            raise Exception("Deadline of request exceeded")
+        if delay > 0:
+            logger.debug("Rate limiting %s, waiting %.2f sec", host, delay)
+        if self.metrics is not None:
+            self.metrics.observe('proxypool_throttle_wait_seconds', delay)
+        return delay
+
+    def throttle(self, host, expires=None):
+        """
+        Waits until the rate limiter admits a request to host
+
+        :expires: Point in time the request has to be done by
+        """
+        delay = self._throttle_delay(host, expires)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _attempt(self, apifunc, p, host, args, kwargs, expires=None, defer_success=False):
+        """
+        Calls apifunc through proxy p and accounts for the outcome. Returns the
+        outcome and the response, if any.
+
+        :expires: Point in time the request has to be done by
+        :defer_success: Leave accounting for a successful response to the
+            caller, eg. once a streamed body has been read
+        """
+        logger.info("Using %s", p)
+        if self.metrics is not None:
+            self.metrics.emit('attempt', proxy=p, host=host)
+        kwargs = dict(kwargs, proxies=p.as_dict(),
+                      timeout=self.timeouts(p, kwargs.get('timeout'), expires))
+        t0 = time.time()
+        try:
+            r = apifunc(self, self.sessions.get(p.url), *args[1:], **kwargs)
+        except requests.exceptions.ConnectTimeout as e:
+            # The proxy didn't accept the connection, regardless of the host
+            self._handle_error(p, None, e, time.time() - t0)
+            return FAILURE, None
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.ReadTimeout) as e:
+            self._handle_error(p, host, e, time.time() - t0)
+            return FAILURE, None
+        return self._handle_response(p, host, r.status_code, r.headers,
+                                     r.elapsed.total_seconds(), defer_success), r
+
+    def __hedge_delay(self):
+        """
+        Returns the time to wait for a response before hedging, or None if a
+        request should not be hedged
         """
-        for i in range(len(gp)):
-            gp[i].w = gp[i].t ** -1.0
-        s = sum([x.w for x in gp])
-        for i in range(len(gp)):
-            gp[i].w = gp[i].w / s
+        with self.lock:
+            if self.hedges >= self.max_hedge_ratio * self.hedgeable:
+                return None
+            return self.latencies.quantile(self.hedge_quantile)
+
+    def _hedged_attempt(self, apifunc, p, host, args, kwargs, expires=None):
+        """
+        Like _attempt, but if p hasn't responded within the hedge delay, sends
+        the same request through a second proxy as well. The attempt through p
+        runs on the calling thread, and only the hedge on the hedge workers.
+        The response through p is returned if successful, else the outcome of
+        the hedge once it is done. The response that isn't returned is closed.
+        Both outcomes are accounted for. Releases the lease of p.
+        """
+        with self.lock:
+            self.hedgeable += 1
+        delay = self.__hedge_delay()
+        if delay is None:
+            try:
+                return self._attempt(apifunc, p, host, args, kwargs, expires)
+            finally:
+                p.release()
+
+        if self.hedge_pool is None:
+            with self.lock:
+                if self.hedge_pool is None:
+                    self.hedge_pool = ThreadPool(self.hedge_workers, queue_size=0)
+        state = {'done': False, 'hedge': None}
+        timer = threading.Timer(delay, self.__hedge,
+                                (state, delay, apifunc, p, host, args, kwargs, expires))
+        timer.daemon = True
+        timer.start()
+        try:
+            outcome, r = self._attempt(apifunc, p, host, args, kwargs, expires)
+        except BaseException:
+            self.__discard(self.__stop_hedging(state, timer, p))
+            raise
+        hedge = self.__stop_hedging(state, timer, p)
+        if hedge is None:
+            return outcome, r
+        if outcome == SUCCESS:
+            self.__discard(hedge)
+            return outcome, r
+        if r is not None:
+            r.close()
+        try:
+            return hedge.result()
+        except Exception as e:
+            logger.debug("Hedge of a request to %s failed: %s", host, e)
+            return outcome, None
 
-    def __fetch_proxies(self):
+    def __stop_hedging(self, state, timer, p):
         """
+        Ends the attempt through p, and returns the future of its hedge if one
+        was sent
+        """
+        timer.cancel()
+        p.release()
+        with self.lock:
+            state['done'] = True
+            return state['hedge']
+
+    def __discard(self, hedge):
+        """
+        Cancels a hedge that is no longer needed, or closes its response
+        """
+        if hedge is not None:
+            hedge.cancel()
+            hedge.add_done_callback(_discard_response)
+
+    def __hedge(self, state, delay, apifunc, p, host, args, kwargs, expires):
+        """
+        Sends a hedge of the attempt through p through another proxy, unless
+        the attempt is done or the rate limiter doesn't admit another request
+        to host right away
+        """
+        with self.lock:
+            if state['done']:
+                return
+            p2 = self.__sample(host, exclude=p)
+            if p2 is None:
+                return
+            try:
+                if self._throttle_delay(host, expires) > 0:
+                    # Not worth waiting for, p may have responded by then
+                    self.rate_limiter.cancel(host)
+                    return
+            except Exception as e:
+                logger.debug("Not hedging a request to %s: %s", host, e)
+                return
+            self.__lease(p2)
+            self.__take(p2, host)
+            self.hedges += 1
+            try:
+                state['hedge'] = hedge = self.hedge_pool.put(
+                    self._attempt, (apifunc, p2, host, args, kwargs, expires), {})
+            except Exception as e:
+                # The pool has been closed
+                logger.debug("Hedging with %s failed: %s", p2.url, e)
+                hedge = None
+        if hedge is None:
+            p2.release()
+            return
+        logger.debug("%s: No response within %.2f sec, hedging with %s", p.url, delay, p2.url)
+        hedge.add_done_callback(lambda f: p2.release())
+
+    def _handle_error(self, p, host, e, latency=None):
+        """
+        Accounts for a connection error through proxy p, after latency seconds
+        if known. host is None for errors that don't depend on the target host.
+        """
+        logger.debug("%s: %s", p.url, e)
+        p.increase_failures(host)
+        if self.metrics is not None:
+            self.metrics.emit('failure', proxy=p, host=host, error=e)
+        if self.trace is not None:
+            self.trace.record(self.clock(), p.url, host, FAILURE, 0, latency)
+
+    def _handle_response(self, p, host, status_code, headers, latency, defer_success=False):
+        """
+        Accounts for a response through proxy p, and returns the outcome of the
+        attempt: SUCCESS if the response should be handed to the caller, FAILURE
+        if the proxy failed or RATE_LIMITED if the attempt should be retried.
+        Successful responses are accounted for by _handle_success, called later
+        by the caller if defer_success is set.
+        """
+        if self.metrics is not None:
+            self.metrics.emit('status', proxy=p, host=host, status_code=status_code)
+        if status_code in [403]:
+            logger.debug(
+                "%s: Down for %s due to http status %d",
+                p.url, host, status_code)
+            # The proxy is assumed to be banned by the host, so stop
+            # using it for the host immediately
+            p.set_down(host)
+            outcome = FAILURE
+        elif status_code in [429, 503]:
+            logger.debug(
+                "%s: Probable rate limit due to http status %d",
+                p.url, status_code)
+            logger.debug(headers)
+            self.cooldown(p, host, parse_retry_after(headers.get('Retry-After')))
+            if self.rate_limiter is not None:
+                self.rate_limiter.on_rate_limited(host)
+            outcome = RATE_LIMITED
+        else:
+            if not defer_success:
+                self._handle_success(p, host, status_code, latency)
+            return SUCCESS
+        if self.trace is not None:
+            self.trace.record(self.clock(), p.url, host, outcome, status_code, latency)
+        return outcome
+
+    def _handle_success(self, p, host, status_code, latency):
+        """
+        Accounts for a successful response through proxy p
+        """
+        logger.debug("%s: Latency %.2f sec", p.url, latency)
+        p.set_latency(latency, host)
+        p.increase_successes(host)
+        self.cooldown_reset(p, host)
+        if self.rate_limiter is not None:
+            self.rate_limiter.on_success(host)
+        if self.metrics is not None:
+            self.metrics.emit('success', proxy=p, host=host, latency=latency)
+        if self.trace is not None:
+            self.trace.record(self.clock(), p.url, host, SUCCESS, status_code, latency)
+
+    def _invalidate(self, p):
+        """
+        Schedules updating the sampling weight of a proxy after its metrics
+        changed. Doesn't take the pool lock, the weight is updated by the next
+        sample.
+        """
+        self.dirty[p] = True
+
+    def __drain(self):
+        """
+        Updates the sampling weights of the proxies invalidated since the last
+        call. Must be called inside lock
+        """
+        dirty = self.dirty
+        while dirty:
+            try:
+                p, _ = dirty.popitem()
+            except KeyError:
+                break
+            self._reweight(p)
+
+    def _reweight(self, p):
+        """
+        Updates the sampling weight of a proxy after its metrics changed.
         Must be called inside lock
         """
-        self.proxies = set()
-        for pr in self.providers:
-            proxies = pr.update()
+        if p.store is self.stats:
+            was_good = self.index.weights[p.index] > 0
+            w = p.weight()
+            self.index.update(p.index, w)
+            self.num_good += (w > 0) - was_good
+
+    def __collect(self):
+        """
+        Fetches proxy urls from all providers concurrently, and deduplicates
+        them across providers. Called without lock
+        """
+        results = [set() for _ in self.providers]
+
+        def fetch(i, pr):
+            try:
+                results[i] = pr.update()
+            except Exception as e:
+                logger.error("Update from %s failed: %s", pr.__class__, e)
+
+        threads = [threading.Thread(target=fetch, args=(i, pr))
+                   for i, pr in enumerate(self.providers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+        urls = set()
+        for pr, proxies in zip(self.providers, results):
+            proxies = set(normalize_proxy_url(url) for url in proxies)
+            new = proxies - urls
+            urls.update(new)
+            stats = pr.stats
             logger.info(
-                "Got %d proxies from %s" %
-                (len(proxies), pr.__class__))
-            for proxy in proxies:
-                proxy_inst = ProxyPool.ProxyInst(self, proxy)
-                self.proxies.add(proxy_inst)
+                "Got %d proxies (%d provided already) from %s%s",
+                len(proxies), len(proxies) - len(new), pr.__class__,
+                '' if stats is None else ', parsed in %.3f sec' % stats.parse_time)
+        return urls
+
+    def __swap(self, urls, latencies, saved):
+        """
+        Replaces the proxies of the pool by urls, keeping the metrics of proxies
+        already in the pool and restoring saved metrics of new proxies. Must be
+        called inside lock
+        """
+        for stripe in self.stripes:
+            stripe.acquire()
+        try:
+            self.__swap_locked(urls, latencies, saved)
+        finally:
+            for stripe in self.stripes:
+                stripe.release()
+
+    def __swap_locked(self, urls, latencies, saved):
+        """
+        Must be called inside lock and all proxy locks
+        """
+        now = self.clock()
+        current = dict((p.url, p) for p in self.proxies)
+        stats = StatsStore(len(urls), now=now)
+        proxies = []
+        for i, url in enumerate(urls):
+            p = current.get(url)
+            if p is not None:
+                stats.copy_row(i, p.store, p.index)
+            else:
+                p = ProxyPool.ProxyInst(self, url, stats, i)
+                if url in saved:
+                    self.__restore(i, stats, saved[url])
+                if url in latencies:
+                    stats.add_latency(i, latencies[url], ProxyPool.LATENCY_SMOOTHING)
+            proxies.append(p)
+        # Proxies no longer provided keep referring to the old store
+        for i, p in enumerate(proxies):
+            p.store = stats
+            p.index = i
+        weights = self.policy.weights(self, stats, now)
+        if not any(weights):
+            # Every provided proxy is known to be bad. Give them a fresh
+            # start instead of running out of proxies.
+            for i in range(len(stats)):
+                stats.reset_outcomes(i)
+                stats.down[i] = 0
+                stats.hosts[i] = None
+            weights = self.policy.weights(self, stats, now)
+        self.proxies = proxies
+        self.stats = stats
+        self.index.rebuild(weights)
+        self.num_good = sum(1 for w in weights if w > 0)
         self.provider_updates += 1
-        if len(self.proxies) == 0:
+        self.last_refresh = now
+
+    def __restore(self, i, stats, entry):
+        """
+        Sets row i of stats and the cooldowns of its proxy from an entry of the
+        reputation store. Must be called inside lock
+        """
+        stats.restore(i, entry['stats'])
+        if entry['hosts']:
+            stats.hosts[i] = dict((host, HostStats.from_tuple(values))
+                                  for host, values in entry['hosts'].items())
+        for host, (resume, strikes) in entry['cooldowns'].items():
+            self.cooldowns.restore((entry['url'], host), resume, strikes)
+
+    def _fetch(self, known):
+        """
+        Fetches proxies from the providers, validating the ones not in known
+        and not in the reputation store. Returns the urls to use, the latencies
+        measured by the validation and the saved entries of new proxies.
+        Called without lock
+        """
+        urls = self.__collect()
+        if len(urls) == 0:
             raise Exception("No proxies provided from any provider")
+        saved = {}
+        if self.reputation is not None:
+            saved = self.reputation.load(urls - known)
+        latencies = {}
+        if self.validator is not None:
+            latencies = self.validator.validate(urls - known - set(saved))
+            urls = (urls & known) | set(saved) | set(latencies)
+            if len(urls) == 0:
+                raise Exception("No provided proxies passed validation")
+        return urls, latencies, saved
+
+    def _install(self, urls, latencies, saved):
+        """
+        Swaps fetched proxies into the pool
+        """
+        with self.lock:
+            self.__swap(urls, latencies, saved)
+            if self.reprobe_interval and self.reprober is None:
+                self.reprober = self._start_reprobing()
+            if (self.reputation is not None and self.checkpoint_interval and
+                    self.checkpointer is None):
+                self.checkpointer = self._start_checkpointing()
+        self.sessions.retain(urls)
+        if self.metrics is not None:
+            self.metrics.emit('refresh', proxies=len(urls))
+
+    def refresh(self):
+        """
+        Fetches proxies from the providers and swaps them into the pool. If a
+        refresh already is in progress, waits for it to finish instead.
+        """
+        with self.lock:
+            if self.refreshing:
+                while self.refreshing:
+                    self.refreshed.wait()
+                return
+            self.refreshing = True
+            known = set(p.url for p in self.proxies)
+        try:
+            self._install(*self._fetch(known))
+        finally:
+            with self.lock:
+                self.refreshing = False
+                self.refreshed.notify_all()
+
+    def _refresh_in_background(self):
+        """
+        Starts a refresh without waiting for it. Must be called inside lock
+        """
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error("Background refresh failed: %s", e)
+
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+    def _rehabilitation_candidates(self):
+        """
+        Re-evaluates the weight of excluded proxies, bringing back the ones whose
+        failrate has decayed enough. Returns the proxies marked as down.
+        """
+        with self.lock:
+            excluded = self.__reconsider()
+        return [p for p in excluded if p.down]
+
+    def __reconsider(self):
+        """
+        Brings back the excluded proxies whose weight is positive again, and
+        returns the excluded proxies. Must be called inside lock
+        """
+        self.__drain()
+        now = self.clock()
+        self.last_reconsidered = now
+        weights = self.policy.weights(self, self.stats, now)
+        excluded = [p for p in self.proxies if self.index.weights[p.index] <= 0]
+        for p in excluded:
+            if weights[p.index] > 0:
+                self._reweight(p)
+        return excluded
+
+    def _revive(self, down, latencies):
+        """
+        Brings back the proxies in down that responded to a probe
+        """
+        revived = 0
+        with self.lock:
+            for p in down:
+                if p.url in latencies and p.store is self.stats:
+                    with p.lock:
+                        p.down = 0
+                        self.stats.reset_outcomes(p.index)
+                        p._add_latency(latencies[p.url])
+                    self._reweight(p)
+                    revived += 1
+        if revived:
+            logger.info("Revived %d proxies", revived)
+
+    def rehabilitate(self):
+        """
+        Gives excluded proxies another chance. Proxies excluded due to their
+        failrate are brought back when it has decayed, and proxies marked as
+        down when they pass the validator, if there is one.
+        """
+        down = self._rehabilitation_candidates()
+        if self.validator is not None and down:
+            self._revive(down, self.validator.validate([p.url for p in down]))
+
+    def _start_reprobing(self):
+        """
+        Starts calling rehabilitate() every reprobe_interval seconds, until the
+        pool is closed. Must be called inside lock
+        """
+        def run():
+            while not self.closed.wait(self.reprobe_interval):
+                try:
+                    self.rehabilitate()
+                except Exception as e:
+                    logger.error("Rehabilitation failed: %s", e)
+
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        return t
+
+    def _checkpoint_entries(self):
+        """
+        Returns the state of the proxies in the pool, in the format of the
+        reputation store
+        """
+        with self.lock:
+            cooling = {}
+            now = self.clock()
+            for (url, host), resume in self.cooldowns.resume.items():
+                if resume > now:
+                    cooling.setdefault(url, {})[host] = (
+                        resume, self.cooldowns.strikes.get((url, host), 0))
+            entries = []
+            for p in self.proxies:
+                hosts = self.stats.hosts[p.index] or {}
+                entries.append({'url': p.url,
+                                'stats': self.stats.record(p.index),
+                                'hosts': dict((host, hs.as_tuple())
+                                              for host, hs in list(hosts.items())),
+                                'cooldowns': cooling.get(p.url, {})})
+        return entries
+
+    def checkpoint(self):
+        """
+        Saves the metrics of the proxies in the pool to the reputation store
+        """
+        self.reputation.save(self._checkpoint_entries())
+
+    def _start_checkpointing(self):
+        """
+        Starts calling checkpoint() every checkpoint_interval seconds, until
+        the pool is closed. Must be called inside lock
+        """
+        def run():
+            while not self.closed.wait(self.checkpoint_interval):
+                try:
+                    self.checkpoint()
+                except Exception as e:
+                    logger.error("Checkpoint failed: %s", e)
+
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        return t
 
     def __good_proxies(self):
         """
         Must be called inside lock
         """
-        return [s for s in self.proxies if s.failrate() < self.max_proxy_failrate and not s.down]
+        weights = self.policy.weights(self, self.stats, self.clock())
+        return [p for p in self.proxies if weights[p.index] > 0]
 
-    def get_proxy(self):
-        """ Sample a good proxy """
-        with self.lock:
-            r = random.uniform(0, 1)
-            gp = self.__good_proxies()
-            if len(gp) == 0:
-                self.__fetch_proxies()
-                gp = list(self.proxies)
-            self.__set_weights(gp)
-            s = gp[0].w
-            i = 0
-
-            while s < r:
-                i += 1
-                s += gp[i].w
-
-            p = gp[i]
-            p.sample_counter += 1
+    def __acceptance(self, p, host):
+        """
+        Returns the probability of using sampled proxy p for host: lower the
+        more requests are in flight through it, and 0 if it is saturated,
+        cooling down for host, out of rate limiter tokens for host or banned by
+        host. Must be called inside lock
+        """
+        a = 1.0
+        in_flight = p.in_flight
+        if in_flight > 0:
+            max_concurrency = p.max_concurrency
+            if max_concurrency and in_flight >= max_concurrency:
+                return 0.0
+            a = 1.0 / (1 + in_flight)
+        if not host:
+            return a
+        if self.cooldowns.cooling((p.url, host)):
+            return 0.0
+        if self.rate_limiter is not None and not self.rate_limiter.proxy_ready(p.url, host):
+            return 0.0
+        return a * p.acceptance(host)
+
+    def __saturated(self):
+        """
+        Returns True if a proxy is excluded from sampling only because it is at
+        its maximum concurrency. Must be called inside lock
+        """
+        weights = self.index.weights
+        for p in self.proxies:
+            if weights[p.index] > 0 and p.max_concurrency and p.in_flight >= p.max_concurrency:
+                return True
+        return False
+
+    def __lease(self, p):
+        """
+        Must be called inside lock
+        """
+        p.sample_counter += 1
+        with p.lock:
+            p.in_flight += 1
+
+    def __take(self, p, host):
+        """
+        Accounts for a request to host through p with the rate limiter
+        """
+        if self.rate_limiter is not None and host:
+            self.rate_limiter.take(p.url, host)
+
+    def _released(self):
+        """
+        Wakes up threads waiting for a saturated proxy after a lease ended
+        """
+        self.releases += 1
+        if self.lease_waiters:
+            with self.lock:
+                self.released.notify_all()
+
+    def __sample(self, host=None, exclude=None):
+        """
+        Samples a proxy as decided by the selection policy, skipping proxies
+        cooling down for or banned by host, as well as exclude. Returns None if
+        there are no such proxies. Must be called inside lock
+        """
+        self.__drain()
+        policy = self.policy
+        if policy.candidates == 1 and not policy.explore_candidates:
+            return self.__draw(host, exclude)
+        candidates = [self.__draw(host, exclude) for _ in range(policy.candidates)] + \
+            [self.__draw(host, exclude, uniform=True) for _ in range(policy.explore_candidates)]
+        candidates = [p for p in candidates if p is not None]
+        if len(candidates) == 0:
+            return None
+        return policy.choose(self, candidates, host)
+
+    def __draw(self, host, exclude, uniform=False):
+        """
+        Draws a proxy with probability proportional to its weight, or uniformly
+        among the proxies not excluded if uniform is set, adjusted for its
+        metrics towards host. Must be called inside lock
+        """
+        weights = self.index.weights
+        for _ in range(self.max_rejections):
+            total = self.index.total()
+            if total <= 0:
+                return None
+            if uniform:
+                i = random.randrange(len(weights))
+                if weights[i] <= 0:
+                    continue
+            else:
+                i = self.index.find(random.uniform(0, total))
+                if weights[i] <= 0:
+                    # Only hit on a degenerate sum due to floating point drift
+                    self.index.rebuild(weights)
+                    weights = self.index.weights
+                    continue
+            p = self.proxies[i]
+            if p is exclude:
+                continue
+            a = self.__acceptance(p, host)
+            if a >= 1.0 or random.random() < a:
+                return p
+
+        # Most of the pool is unusable for the host
+        candidates = [(p, (1.0 if uniform else weights[p.index]) * self.__acceptance(p, host))
+                      for p in self.proxies if weights[p.index] > 0 and p is not exclude]
+        candidates = [(p, w) for p, w in candidates if w > 0]
+        if len(candidates) == 0:
+            return None
+        r = random.uniform(0, sum([w for _, w in candidates]))
+        for p, w in candidates:
+            r -= w
+            if r <= 0:
+                break
         return p
 
+    def __try_get_proxy(self, host, lease):
+        """
+        Must be called inside lock
+        """
+        self.cooldowns.expire()
+        if (self.num_good < len(self.proxies) and
+                self.clock() - self.last_reconsidered >= self.reconsider_interval):
+            self.__reconsider()
+        p = self.__sample(host)
+        if p is not None:
+            if lease:
+                self.__lease(p)
+            else:
+                p.sample_counter += 1
+            self.__take(p, host)
+            if (self.num_good < self.refresh_watermark and not self.refreshing and
+                    self.clock() - self.last_refresh >= self.min_refresh_interval):
+                logger.info("%d good proxies left, refreshing", self.num_good)
+                self.last_refresh = self.clock()
+                self._refresh_in_background()
+            return p, None
+        if self.index.total() <= 0:
+            return None, None
+        if self.__saturated():
+            return None, SATURATED
+        resume = self.cooldowns.next_resume(lambda key: key[1] == host)
+        if self.rate_limiter is not None:
+            ready = self.rate_limiter.next_ready(host)
+            if ready is not None:
+                resume = ready if resume is None else min(resume, ready)
+        if resume is None:
+            if not self.__forgive(host):
+                raise Exception("All proxies are banned by or failing for %s" % host)
+            return self.__try_get_proxy(host, lease)
+        return None, max(0.0, resume - self.cooldowns.clock())
+
+    def __forgive(self, host):
+        """
+        Gives the proxies a fresh start for host after all of them have been
+        excluded for it, like a refresh does when all are excluded. Returns
+        False if no proxy was excluded for host. Must be called inside lock
+        """
+        forgiven = 0
+        for p in self.proxies:
+            hosts = self.stats.hosts[p.index]
+            hs = hosts.get(host) if hosts is not None else None
+            if hs is not None and self.index.weights[p.index] > 0 and p.acceptance(host) <= 0:
+                with p.lock:
+                    hs.successes = hs.failures = 0.0
+                    hs.down = False
+                forgiven += 1
+        if forgiven:
+            logger.info("All proxies banned by or failing for %s, giving %d another chance",
+                        host, forgiven)
+        return forgiven > 0
+
+    def _try_get_proxy(self, host=None, lease=False):
+        """
+        Samples a proxy without blocking, and leases it if lease is set.
+        Returns (proxy, None) on success, (None, None) if the pool needs a
+        refresh, (None, SATURATED) if usable proxies are at their maximum
+        concurrency, or (None, delay) if all good proxies are cooling down or
+        out of rate limiter tokens for host during at least delay seconds.
+        """
+        with self.lock:
+            if self.metrics is None:
+                return self.__try_get_proxy(host, lease)
+            t0 = time.time()
+            try:
+                return self.__try_get_proxy(host, lease)
+            finally:
+                self.metrics.observe('proxypool_lock_hold_seconds', time.time() - t0)
+
+    def get_proxy(self, host=None, lease=False, timeout=None, expires=None):
+        """
+        Sample a good proxy. If host is given, proxies cooling down for that host
+        are skipped, waiting for the first one to resume if all are cooling down.
+
+        :lease: Count a request in flight through the proxy until p.release()
+            is called. Proxies at their maximum concurrency are skipped, waiting
+            for a lease to end if all are.
+        :timeout: Seconds to wait for a saturated proxy, lease_timeout by default
+        :expires: Point in time after which to stop waiting for a proxy to
+            resume, raising an exception instead
+        """
+        t0 = time.time()
+        if timeout is None:
+            timeout = self.lease_timeout
+        while True:
+            releases = self.releases
+            p, delay = self._try_get_proxy(host, lease)
+            if p is not None:
+                if self.metrics is not None:
+                    self.metrics.observe('proxypool_selection_wait_seconds', time.time() - t0)
+                return p
+            if delay is None:
+                self.refresh()
+            elif delay is SATURATED:
+                self.__wait_for_release(releases, t0, timeout)
+            else:
+                delay = self._resume_delay(host, delay, expires)
+                logger.info("All proxies cooling down or rate limited for %s, waiting %.1f sec",
+                            host, delay)
+                time.sleep(delay)
+
+    def _resume_delay(self, host, delay, expires):
+        """
+        Returns the seconds to wait for a proxy to resume in delay seconds,
+        raising an exception if it resumes after expires
+        """
+        if expires is not None:
+            remaining = expires - time.time()
+            if delay > remaining:
+                raise Exception("Deadline of request exceeded, all proxies cooling down "
+                                "or rate limited for %s during %.1f sec" % (host, delay))
+        return delay
+
+    def __wait_for_release(self, releases, t0, timeout):
+        """
+        Waits until a lease has ended after releases leases had ended, raising
+        an exception if timeout seconds have passed since t0
+        """
+        remaining = None
+        if timeout is not None:
+            remaining = t0 + timeout - time.time()
+            if remaining <= 0:
+                raise Exception("All proxies are saturated, waited %.1f sec" % timeout)
+        with self.lock:
+            self.lease_waiters += 1
+            try:
+                if self.releases == releases:
+                    self.released.wait(remaining)
+            finally:
+                self.lease_waiters -= 1
+
+    def cooldown(self, p, host, delay=None):
+        """
+        Stops using proxy p for host during delay seconds, or an exponential
+        backoff if delay is None
+        """
+        with self.lock:
+            delay = self.cooldowns.penalize((p.url, host), delay)
+        if self.metrics is not None:
+            self.metrics.emit('cooldown', proxy=p, host=host, delay=delay)
+        logger.debug("%s: Cooling down for %s during %.1f sec", p.url, host, delay)
+
+    def cooldown_reset(self, p, host):
+        """
+        Resets the backoff of proxy p for host after a successful request
+        """
+        key = (p.url, host)
+        if key in self.cooldowns.strikes:
+            with self.lock:
+                self.cooldowns.reset(key)
+
     @Decorators.with_proxypool
-    def request(self, *args, **kwargs):
-        return requests.api.request(*args, **kwargs)
+    def request(self, session, *args, **kwargs):
+        return session.request(*args, **kwargs)
 
+    @Decorators.with_cache
     @Decorators.with_proxypool
-    def get(self, *args, **kwargs):
-        return requests.api.get(*args, **kwargs)
+    def get(self, session, *args, **kwargs):
+        return session.get(*args, **kwargs)
 
     @Decorators.with_proxypool
-    def options(self, *args, **kwargs):
-        return requests.api.options(*args, **kwargs)
+    def options(self, session, *args, **kwargs):
+        return session.options(*args, **kwargs)
 
+    @Decorators.with_cache
     @Decorators.with_proxypool
-    def head(self, *args, **kwargs):
-        return requests.api.head(*args, **kwargs)
+    def head(self, session, *args, **kwargs):
+        return session.head(*args, **kwargs)
 
     @Decorators.with_proxypool
-    def post(self, *args, **kwargs):
-        return requests.api.post(*args, **kwargs)
+    def post(self, session, *args, **kwargs):
+        return session.post(*args, **kwargs)
 
     @Decorators.with_proxypool
-    def put(self, *args, **kwargs):
-        return requests.api.put(*args, **kwargs)
+    def put(self, session, *args, **kwargs):
+        return session.put(*args, **kwargs)
 
     @Decorators.with_proxypool
-    def patch(self, *args, **kwargs):
-        return requests.api.patch(*args, **kwargs)
+    def patch(self, session, *args, **kwargs):
+        return session.patch(*args, **kwargs)
 
     @Decorators.with_proxypool
-    def delete(self, *args, **kwargs):
-        return requests.api.delete(*args, **kwargs)
+    def delete(self, session, *args, **kwargs):
+        return session.delete(*args, **kwargs)
+
+    def stream(self, url, chunk_size=64 * 1024, **kwargs):
+        """
+        Downloads url through the pool, yielding the body in chunks of at most
+        chunk_size bytes without keeping it in memory. If the transfer through
+        a proxy breaks, the proxy is accounted for the failure and the download
+        resumes from the last received byte through another proxy, using a
+        Range request. The ETag or Last-Modified header of the first response
+        is required to resume, and has to match for the resumed response.
+
+        Raises requests.exceptions.HTTPError for error responses, and an
+        exception if the resource changed or can't be resumed.
+        Other arguments are passed to requests, see get().
+        """
+        host = urlparse(url).netloc.lower()
+        deadline = kwargs.pop('deadline', None)
+        expires = time.time() + deadline if deadline is not None else None
+        # Ranges refer to the encoded body, so don't let requests decode it
+        headers = dict(kwargs.pop('headers', None) or {}, **{'Accept-Encoding': 'identity'})
+        offset = 0
+        validator = None  # (header name, value) of the first response
+        failures = 0
+
+        while True:
+            attempt_headers = dict(headers)
+            if offset:
+                attempt_headers['Range'] = 'bytes=%d-' % offset
+                if not validator[1].startswith('W/'):
+                    # Weak ETags can't be used for If-Range
+                    attempt_headers['If-Range'] = validator[1]
+            self.throttle(host, expires)
+            timeout = None
+            if expires is not None:
+                timeout = max(0.0, expires - time.time())
+            p = self.get_proxy(host, lease=True, timeout=timeout, expires=expires)
+            try:
+                outcome, r = self._attempt(_session_get, p, host, (self, url),
+                                           dict(kwargs, headers=attempt_headers, stream=True),
+                                           expires, defer_success=True)
+                if outcome != SUCCESS:
+                    if r is not None:
+                        # Give the connection of the unread body back
+                        r.close()
+                    failures += outcome == FAILURE
+                    if failures > self.max_proxy_attempts:
+                        raise Exception("Too many failures, downloading %s" % url)
+                    continue
+                try:
+                    r.raise_for_status()
+                    skip = 0
+                    if not offset:
+                        for name in ['ETag', 'Last-Modified']:
+                            if r.headers.get(name):
+                                validator = (name, r.headers[name])
+                                break
+                    elif r.headers.get(validator[0]) != validator[1]:
+                        raise Exception("%s changed during download" % url)
+                    elif r.status_code == 206:
+                        if not r.headers.get('Content-Range', '').startswith('bytes %d-' % offset):
+                            raise Exception("Unexpected range %s of %s" %
+                                            (r.headers.get('Content-Range'), url))
+                    else:
+                        # The range was ignored, skip the bytes already received
+                        skip = offset
+                    for chunk in r.iter_content(chunk_size):
+                        if skip:
+                            n = min(skip, len(chunk))
+                            skip -= n
+                            chunk = chunk[n:]
+                            if not chunk:
+                                continue
+                        offset += len(chunk)
+                        yield chunk
+                    self._handle_success(p, host, r.status_code, r.elapsed.total_seconds())
+                    return
+                except (requests.exceptions.ConnectionError,
+                        requests.exceptions.ChunkedEncodingError) as e:
+                    # Accounted for as a failure only, not as a success as well
+                    logger.debug("%s: Transfer of %s broken at byte %d", p.url, url, offset)
+                    self._handle_error(p, host, e)
+                    if validator is None and offset:
+                        raise Exception("%s can't be resumed, no ETag or Last-Modified" % url)
+                    failures += 1
+                    if failures > self.max_proxy_attempts:
+                        raise Exception("Too many failures, downloading %s" % url)
+                except (Exception, GeneratorExit):
+                    # The proxy relayed the response, even if it isn't usable
+                    # or the caller stopped reading it
+                    self._handle_success(p, host, r.status_code, r.elapsed.total_seconds())
+                    raise
+                finally:
+                    r.close()
+            finally:
+                p.release()
+
+    def __fetch(self, item):
+        """
+        Performs a request of get_many, admitted by the rate limiter already
+        """
+        if isinstance(item, requests.Request):
+            kwargs = dict((name, getattr(item, name))
+                          for name in ['headers', 'files', 'data', 'json', 'params',
+                                       'auth', 'cookies', 'hooks']
+                          if getattr(item, name))
+            return self.request(item.method or 'GET', item.url, throttled=True, **kwargs)
+        return self.get(item, throttled=True)
+
+    def get_many(self, urls_or_requests, concurrency=8, ordered=False, lookahead=None):
+        """
+        Performs many requests concurrently, and yields (request, response) pairs
+        as they complete, or in the order of the requests if ordered is set. A
+        failed request is yielded with its exception instead of a response.
+
+        The requests are interleaved by target host, always starting a request
+        to the host with the fewest requests in flight, so that no host
+        monopolizes the proxies. Requests are leased to proxies like all
+        requests, so concurrent requests prefer distinct proxies. Hosts held
+        back by the rate limiter are skipped until it admits them, without
+        occupying a worker.
+
+        The requests are consumed lazily. Requests not started yet are cancelled
+        when the caller stops consuming the generator.
+
+        :urls_or_requests: Iterable of urls to GET, or of requests.Request objects
+        :concurrency: Maximum number of requests in flight
+        :ordered: Yield the responses in the order of the requests
+        :lookahead: Number of requests read ahead for interleaving hosts,
+            4 * concurrency by default
+        """
+        if lookahead is None:
+            lookahead = 4 * concurrency
+        items = iter(urls_or_requests)
+        waiting = OrderedDict()  # host -> deque of (index, request) to start
+        in_flight = {}  # host -> number of requests in flight
+        num_waiting = 0
+        num_read = 0
+        exhausted = False
+        pending = {}  # future -> (index, request, host)
+        done = queue.Queue()
+        results = {}  # index -> (request, result) not yet yielded, if ordered
+        next_index = 0
+        tp = ThreadPool(concurrency, queue_size=0)
+        try:
+            while True:
+                while not exhausted and num_waiting < lookahead and \
+                        (not ordered or num_read - next_index < lookahead + concurrency):
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    url = item.url if isinstance(item, requests.Request) else item
+                    host = urlparse(url).netloc.lower()
+                    waiting.setdefault(host, deque()).append((num_read, item))
+                    num_read += 1
+                    num_waiting += 1
+
+                throttled = None  # Seconds until a host held back is admitted
+                while len(pending) < concurrency and waiting:
+                    ready = list(waiting)
+                    if self.rate_limiter is not None:
+                        delays = dict((h, self.rate_limiter.delay(h)) for h in waiting)
+                        ready = [h for h in ready if delays[h] <= 0]
+                        if not ready:
+                            throttled = min(delays.values())
+                            break
+                    # Ties are broken round robin, as started hosts move last
+                    host = min(ready, key=lambda h: in_flight.get(h, 0))
+                    self._throttle_delay(host)
+                    index, item = waiting[host].popleft()
+                    num_waiting -= 1
+                    if waiting[host]:
+                        waiting.move_to_end(host)
+                    else:
+                        del waiting[host]
+                    in_flight[host] = in_flight.get(host, 0) + 1
+                    future = tp.put(self.__fetch, (item,), {})
+                    pending[future] = (index, item, host)
+                    future.add_done_callback(done.put)
+
+                if not pending and throttled is None:
+                    return
+                try:
+                    future = done.get(timeout=throttled)
+                except queue.Empty:
+                    continue
+                index, item, host = pending.pop(future)
+                in_flight[host] -= 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = e
+                if not ordered:
+                    yield item, result
+                    continue
+                results[index] = (item, result)
+                while next_index in results:
+                    yield results.pop(next_index)
+                    next_index += 1
+        finally:
+            for future in pending:
+                future.cancel()
+            tp.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,246 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Admits rate requests per second on average, and up to burst requests at
+    once after an idle period. Requests reserve their token in advance, so the
+    number of tokens goes negative while requests are queued, and each caller
+    learns how long to wait for its turn.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        """
+        Returns the seconds until a token is available
+        """
+        self.refill(now)
+        return max(0.0, (1.0 - self.tokens) / self.rate)
+
+    def reserve(self, now):
+        """
+        Takes a token, and returns the seconds to wait before using it
+        """
+        self.refill(now)
+        self.tokens -= 1.0
+        return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimiter(object):
+    """
+    Limits the rate of requests to target hosts, so that the pool avoids
+    triggering rate limits instead of reacting to 429/503 responses.
+
+    Requests are admitted by a token bucket per host. Optionally, each proxy
+    has a token bucket per host as well, and proxies out of tokens for a host
+    are skipped when sampling a proxy for it.
+
+    With auto_tune set, the rate of a host is multiplied by backoff when it
+    answers with a rate limit, and raised by probe_step times its configured
+    rate after probe_after successes in a row, up to max_rate. Hosts without a
+    configured rate are not limited, nor tuned.
+
+    Thread safe.
+    """
+
+    def __init__(self, rates=None, default_rate=None, burst=1, proxy_rates=None,
+                 proxy_default_rate=None, proxy_burst=1, auto_tune=False, backoff=0.5,
+                 probe_after=50, probe_step=0.1, min_rate=0.01, max_rate=None,
+                 clock=time.time):
+        """
+        :rates: Dict of host -> requests per second
+        :default_rate: Requests per second to hosts not in rates, None for unlimited
+        :burst: Number of requests to a host admitted at once after an idle period
+        :proxy_rates: Dict of host -> requests per second through each proxy
+        :proxy_default_rate: Requests per second through each proxy to hosts not
+            in proxy_rates, None for unlimited
+        :proxy_burst: Like burst, per proxy and host
+        :auto_tune: Adapt the rates of hosts to their rate limits
+        :backoff: Factor applied to the rate of a host after a rate limit
+        :probe_after: Number of successes in a row before raising the rate of a host
+        :probe_step: Increase of the rate of a host, relative to its configured rate
+        :min_rate: Lower bound of tuned rates
+        :max_rate: Upper bound of tuned rates, None for unbounded
+        :clock: Function returning the current time in seconds
+        """
+        self.rates = rates or {}
+        self.default_rate = default_rate
+        self.burst = burst
+        self.proxy_rates = proxy_rates or {}
+        self.proxy_default_rate = proxy_default_rate
+        self.proxy_burst = proxy_burst
+        self.auto_tune = auto_tune
+        self.backoff = backoff
+        self.probe_after = probe_after
+        self.probe_step = probe_step
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.buckets = {}  # host -> TokenBucket
+        self.proxy_buckets = {}  # (proxy url, host) -> TokenBucket
+        self.successes = {}  # host -> number of successes since the rate changed
+        self.backed_off = {}  # host -> time of the last backoff
+        self.expired = clock()
+
+    def __bucket(self, host, now):
+        """
+        Returns the bucket of host, or None if it isn't limited. Must be
+        called inside lock
+        """
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            rate = self.rates.get(host, self.default_rate)
+            if rate is None:
+                return None
+            bucket = self.buckets[host] = TokenBucket(rate, self.burst, now)
+        return bucket
+
+    def __proxy_bucket(self, url, host, now):
+        """
+        Must be called inside lock
+        """
+        key = (url, host)
+        bucket = self.proxy_buckets.get(key)
+        if bucket is None:
+            rate = self.proxy_rates.get(host, self.proxy_default_rate)
+            if rate is None:
+                return None
+            bucket = self.proxy_buckets[key] = TokenBucket(rate, self.proxy_burst, now)
+        return bucket
+
+    def rate(self, host):
+        """
+        Returns the current rate of host, or None if it isn't limited
+        """
+        with self.lock:
+            bucket = self.__bucket(host, self.clock())
+            return bucket.rate if bucket is not None else None
+
+    def delay(self, host):
+        """
+        Returns the seconds until a request to host would be admitted
+        """
+        with self.lock:
+            now = self.clock()
+            bucket = self.__bucket(host, now)
+            return bucket.delay(now) if bucket is not None else 0.0
+
+    def reserve(self, host):
+        """
+        Reserves a request to host, and returns the seconds to wait before
+        making it
+        """
+        with self.lock:
+            now = self.clock()
+            bucket = self.__bucket(host, now)
+            return bucket.reserve(now) if bucket is not None else 0.0
+
+    def cancel(self, host):
+        """
+        Gives back a reservation of a request to host that won't be made
+        """
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is not None:
+                bucket.tokens = min(bucket.burst, bucket.tokens + 1.0)
+
+    def proxy_ready(self, url, host):
+        """
+        Returns True if proxy url may make a request to host now
+        """
+        if self.proxy_default_rate is None and not self.proxy_rates:
+            return True
+        with self.lock:
+            # Proxies without a bucket haven't made requests to host lately
+            bucket = self.proxy_buckets.get((url, host))
+            return bucket is None or bucket.delay(self.clock()) <= 0
+
+    def take(self, url, host):
+        """
+        Accounts for a request to host through proxy url
+        """
+        if self.proxy_default_rate is None and not self.proxy_rates:
+            return
+        with self.lock:
+            now = self.clock()
+            bucket = self.__proxy_bucket(url, host, now)
+            if bucket is not None:
+                bucket.reserve(now)
+            if now - self.expired > 60.0:
+                self.__expire(now)
+
+    def __expire(self, now):
+        """
+        Drops the buckets of proxies that have refilled, they are recreated on
+        their next request. Must be called inside lock
+        """
+        self.expired = now
+        for key, bucket in list(self.proxy_buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.proxy_buckets[key]
+
+    def next_ready(self, host):
+        """
+        Returns the earliest point in time a proxy out of tokens for host may
+        make a request to it again, or None if there are none
+        """
+        with self.lock:
+            now = self.clock()
+            delays = [bucket.delay(now) for (_, h), bucket in self.proxy_buckets.items()
+                      if h == host]
+            return now + min(delays) if delays else None
+
+    def on_rate_limited(self, host):
+        """
+        Backs off the rate of host after it answered with a rate limit
+        """
+        if not self.auto_tune:
+            return
+        with self.lock:
+            now = self.clock()
+            bucket = self.__bucket(host, now)
+            if bucket is None:
+                return
+            self.successes[host] = 0
+            # Responses to requests admitted before the last backoff don't
+            # count, they were sent at the old rate
+            last = self.backed_off.get(host)
+            if last is not None and now - last < 1.0 / bucket.rate:
+                return
+            self.backed_off[host] = now
+            bucket.refill(now)
+            bucket.rate = max(self.min_rate, bucket.rate * self.backoff)
+
+    def on_success(self, host):
+        """
+        Raises the rate of host after probe_after successes in a row
+        """
+        if not self.auto_tune:
+            return
+        with self.lock:
+            now = self.clock()
+            bucket = self.__bucket(host, now)
+            if bucket is None:
+                return
+            n = self.successes.get(host, 0) + 1
+            if n < self.probe_after:
+                self.successes[host] = n
+                return
+            self.successes[host] = 0
+            bucket.refill(now)
+            rate = bucket.rate + self.probe_step * self.rates.get(host, self.default_rate)
+            bucket.rate = min(self.max_rate, rate) if self.max_rate is not None else rate
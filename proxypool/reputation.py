@@ -0,0 +1,168 @@
+import logging
+import sqlite3
+import threading
+import time
+from array import array
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS proxies (
+    url TEXT PRIMARY KEY,
+    last_seen REAL NOT NULL,
+    t REAL,
+    successes INTEGER,
+    failures INTEGER,
+    recent_successes REAL,
+    recent_failures REAL,
+    updated REAL,
+    down INTEGER,
+    window BLOB
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    url TEXT NOT NULL,
+    host TEXT NOT NULL,
+    t REAL,
+    successes REAL,
+    failures REAL,
+    updated REAL,
+    down INTEGER,
+    PRIMARY KEY (url, host)
+);
+CREATE TABLE IF NOT EXISTS cooldowns (
+    url TEXT NOT NULL,
+    host TEXT NOT NULL,
+    resume REAL NOT NULL,
+    strikes INTEGER NOT NULL,
+    PRIMARY KEY (url, host)
+);
+"""
+
+# Columns of the proxies table taken from StatsStore.record()
+STATS_COLUMNS = ('t', 'successes', 'failures', 'recent_successes',
+                 'recent_failures', 'updated', 'down')
+
+# Maximum number of urls per query, below the SQLite limit of host parameters
+CHUNK_SIZE = 500
+
+
+def _chunks(items, n=CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), n):
+        yield items[i:i + n]
+
+
+class ReputationStore(object):
+    """
+    On-disk cache of proxy metrics in an SQLite database, so that a new pool
+    starts with the latencies, failure history, bans and cooldowns learned by
+    earlier pools instead of rediscovering them with real requests.
+
+    The database is in WAL mode and may be shared by several processes on the
+    same host. Each checkpoint overwrites the entries of the proxies in the
+    saving pool, ie. the last writer of a proxy wins. Entries of proxies that
+    no pool has seen during max_age seconds are dropped.
+    """
+
+    def __init__(self, path, max_age=86400.0, timeout=10.0):
+        """
+        :path: Path of the database file, created if missing
+        :max_age: Seconds after which an entry not seen by any pool is dropped
+        :timeout: Seconds to wait for another process holding the database lock
+        """
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.executescript(SCHEMA)
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def save(self, entries, now=None):
+        """
+        Saves the state of proxies, replacing their earlier entries, and drops
+        stale entries.
+
+        :entries: List of dicts with the keys 'url', 'stats' (a
+            StatsStore.record()), 'hosts' (host -> HostStats.as_tuple()) and
+            'cooldowns' (host -> (resume time, strikes))
+        """
+        if now is None:
+            now = time.time()
+        proxies = []
+        hosts = []
+        cooldowns = []
+        for e in entries:
+            stats = e['stats']
+            proxies.append((e['url'], now) + tuple(stats[c] for c in STATS_COLUMNS) +
+                           (sqlite3.Binary(array('d', stats['window']).tobytes()),))
+            for host, values in e['hosts'].items():
+                hosts.append((e['url'], host) + tuple(values))
+            for host, (resume, strikes) in e['cooldowns'].items():
+                cooldowns.append((e['url'], host, resume, strikes))
+
+        with self.lock:
+            with self.db:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO proxies VALUES (%s)' % ','.join('?' * 10), proxies)
+                for chunk in _chunks([(e['url'],) for e in entries]):
+                    # Cooldowns that ended are not saved, drop their old entries
+                    self.db.executemany('DELETE FROM cooldowns WHERE url = ?', chunk)
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO hosts VALUES (?,?,?,?,?,?,?)', hosts)
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO cooldowns VALUES (?,?,?,?)', cooldowns)
+                self.__expire(now)
+        logger.debug("Saved %d proxies to %s", len(proxies), self.path)
+
+    def __expire(self, now):
+        """
+        Must be called inside lock and a transaction
+        """
+        stale = now - self.max_age
+        self.db.execute('DELETE FROM hosts WHERE url IN '
+                        '(SELECT url FROM proxies WHERE last_seen < ?)', (stale,))
+        self.db.execute('DELETE FROM cooldowns WHERE url IN '
+                        '(SELECT url FROM proxies WHERE last_seen < ?)', (stale,))
+        self.db.execute('DELETE FROM cooldowns WHERE resume <= ?', (now,))
+        self.db.execute('DELETE FROM proxies WHERE last_seen < ?', (stale,))
+
+    def load(self, urls, now=None):
+        """
+        Returns the saved state of the proxies in urls that were seen within
+        max_age seconds, as a dict of url -> entry like the ones passed to save()
+        """
+        if now is None:
+            now = time.time()
+        stale = now - self.max_age
+        entries = {}
+        with self.lock:
+            for chunk in _chunks(urls):
+                marks = ','.join('?' * len(chunk))
+                rows = self.db.execute(
+                    'SELECT url, %s, window FROM proxies WHERE last_seen >= ? AND url IN (%s)' %
+                    (', '.join(STATS_COLUMNS), marks), [stale] + chunk).fetchall()
+                for row in rows:
+                    stats = dict(zip(STATS_COLUMNS, row[1:-1]))
+                    window = array('d')
+                    window.frombytes(bytes(row[-1]))
+                    stats['window'] = window.tolist()
+                    entries[row[0]] = {'url': row[0], 'stats': stats,
+                                       'hosts': {}, 'cooldowns': {}}
+                for row in self.db.execute(
+                        'SELECT * FROM hosts WHERE url IN (%s)' % marks, chunk):
+                    if row[0] in entries:
+                        entries[row[0]]['hosts'][row[1]] = row[2:]
+                for row in self.db.execute(
+                        'SELECT * FROM cooldowns WHERE resume > ? AND url IN (%s)' % marks,
+                        [now] + chunk):
+                    if row[0] in entries:
+                        entries[row[0]]['cooldowns'][row[1]] = (row[2], row[3])
+        logger.debug("Loaded %d of %d proxies from %s", len(entries), len(urls), self.path)
+        return entries
@@ -0,0 +1,474 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import Counter
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from .providers import proxy_dict
+from .proxypool import ProxyPool
+
+logger = logging.getLogger(__name__)
+
+
+class PoolServer(object):
+    """
+    Shares a ProxyPool between the processes of a host over a Unix socket.
+    The server owns the provider refresh, the scoring and the sampling, and
+    PoolClients lease proxies from it and report the outcomes back.
+
+    The protocol is newline delimited JSON. A request carries the id of the
+    client and the reports it buffered, and optionally asks for proxies:
+        {"client": id, "reports": [[url, host, kind, value], ...], "lease": n,
+         "host": host, "timeout": seconds, "deadline": seconds,
+         "wait": true | false}
+    Leased proxies are returned as [url, latency quantile] pairs, the quantile
+    being the timeout_quantile of the recent latencies of the proxy. Fewer than
+    n proxies are leased if the others are saturated or cooling down, and the
+    server only waits for a proxy if none is available and wait is set.
+    "sample" instead of "lease" returns proxies without counting them as in
+    flight.
+        {"client": id, "reports": [...], "op": "refresh" | "status"}
+    Proxies still leased by a client when its last connection closes are
+    released, so that clients exiting without releasing them don't leak them.
+    """
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            owner = self.server.owner
+            client = None
+            try:
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    try:
+                        request = json.loads(line.decode('utf-8'))
+                        if client is None and request.get('client'):
+                            client = request['client']
+                            owner.connect(client)
+                        reply = owner.handle(request)
+                    except Exception as e:
+                        logger.debug("Request failed: %s", e)
+                        reply = {'error': str(e)}
+                    self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+                    self.wfile.flush()
+            finally:
+                if client is not None:
+                    owner.disconnect(client)
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    def __init__(self, pool, path):
+        """
+        :pool: ProxyPool to share
+        :path: Path of the Unix socket
+        """
+        self.pool = pool
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = PoolServer.Server(path, PoolServer.Handler)
+        self.server.owner = self
+        self.thread = None
+        self.by_url = {}
+        self.updates = None
+        self.lock = threading.Lock()
+        # client id -> [open connections, Counter of the urls it leased]
+        self.clients = {}
+
+    def start(self):
+        """
+        Serves clients on a background thread
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __proxy(self, url):
+        """
+        Returns the proxy of the pool with url, or None if it is no longer in
+        the pool
+        """
+        if self.updates != self.pool.provider_updates:
+            self.updates = self.pool.provider_updates
+            self.by_url = dict((p.url, p) for p in self.pool.proxies)
+        return self.by_url.get(url)
+
+    def connect(self, client):
+        """
+        Registers a connection of client
+        """
+        with self.lock:
+            self.clients.setdefault(client, [0, Counter()])[0] += 1
+
+    def disconnect(self, client):
+        """
+        Unregisters a closed connection of client, releasing the proxies it
+        still leased if it was the last one
+        """
+        with self.lock:
+            state = self.clients[client]
+            state[0] -= 1
+            if state[0] > 0:
+                return
+            del self.clients[client]
+        leaked = sum(state[1].values())
+        if leaked:
+            logger.info("Client %s left with %d leases, releasing them", client, leaked)
+        for url, n in state[1].items():
+            p = self.__proxy(url)
+            for _ in range(n if p is not None else 0):
+                p.release()
+
+    def __unlease(self, client, url):
+        """
+        Forgets a lease of url by client, returning False if it has none
+        """
+        if client is None:
+            return True
+        with self.lock:
+            state = self.clients.get(client)
+            if state is None or state[1][url] <= 0:
+                return False
+            state[1][url] -= 1
+            if not state[1][url]:
+                del state[1][url]
+            return True
+
+    def report(self, reports, client=None):
+        """
+        Applies outcomes reported by a client to the pool
+        """
+        for url, host, kind, value in reports:
+            if kind == 'release' and not self.__unlease(client, url):
+                continue
+            p = self.__proxy(url)
+            if p is None:
+                continue
+            if kind == 'latency':
+                p.set_latency(value, host)
+            elif kind == 'success':
+                p.increase_successes(host)
+            elif kind == 'failure':
+                p.increase_failures(host)
+            elif kind == 'down':
+                p.set_down(host)
+            elif kind == 'cooldown':
+                self.pool.cooldown(p, host, value)
+            elif kind == 'cooldown_reset':
+                self.pool.cooldown_reset(p, host)
+            elif kind == 'release':
+                p.release()
+            else:
+                raise Exception("Unknown report %s" % kind)
+
+    def handle(self, request):
+        client = request.get('client')
+        self.report(request.get('reports', ()), client)
+        op = request.get('op')
+        if op == 'refresh':
+            self.pool.refresh()
+        elif op == 'status':
+            return {'proxies': len(self.pool), 'good': self.pool.good,
+                    'provider_updates': self.pool.provider_updates}
+        if request.get('lease') or request.get('sample'):
+            return {'proxies': [(p.url, p.latency_quantile(self.pool.timeout_quantile))
+                                for p in self.lease(request)]}
+        return {}
+
+    def lease(self, request):
+        """
+        Leases up to request['lease'] proxies for request['host'], or samples
+        up to request['sample'] without leasing them, skipping saturated and
+        cooling down ones. If none is available, waits at most
+        request['timeout'] seconds for a saturated one and request['deadline']
+        seconds for one cooling down, unless request['wait'] is false.
+        """
+        host = request.get('host')
+        lease = bool(request.get('lease'))
+        n = request['lease'] if lease else request['sample']
+        expires = None
+        if request.get('deadline') is not None:
+            expires = time.time() + request['deadline']
+        leased = []
+        while len(leased) < n:
+            p, _ = self.pool._try_get_proxy(host, lease=lease)
+            if p is None:
+                if leased or not request.get('wait', True):
+                    break
+                # Refreshes the pool or waits, as needed
+                p = self.pool.get_proxy(host, lease=lease, timeout=request.get('timeout'),
+                                        expires=expires)
+            leased.append(p)
+        client = request.get('client')
+        if lease and client is not None:
+            with self.lock:
+                state = self.clients.get(client)
+                if state is not None:
+                    state[1].update(p.url for p in leased)
+        return leased
+
+
+class PoolClient(ProxyPool):
+    """
+    Drop-in replacement for ProxyPool using the proxies of a PoolServer.
+    Proxies are leased in batches per target host, and outcomes are buffered
+    and sent along with the next lease, or when report_batch outcomes or
+    report_interval seconds have accumulated, by a background thread if the
+    client is idle. Connections through the proxies are made by the client
+    itself.
+
+    Hedging is not supported.
+    """
+
+    class RemoteProxy(object):
+        """
+        A proxy leased from a PoolServer, buffering its outcomes in the client
+        """
+        __slots__ = ('client', 'url', 'quantile', 'leased')
+
+        def __init__(self, client, url, quantile=None, leased=True):
+            self.client = client
+            self.url = url
+            self.quantile = quantile
+            self.leased = leased
+
+        def __str__(self):
+            return self.url
+
+        def as_dict(self):
+            return proxy_dict(self.url)
+
+        def latency_quantile(self, q):
+            """
+            Returns the latency quantile reported by the server, which is the
+            timeout_quantile of the server's pool regardless of q
+            """
+            return self.quantile
+
+        def set_latency(self, t, host=None):
+            self.client._report(self.url, host, 'latency', t)
+
+        def increase_successes(self, host=None):
+            self.client._report(self.url, host, 'success')
+
+        def increase_failures(self, host=None):
+            self.client._report(self.url, host, 'failure')
+
+        def release(self):
+            if self.leased:
+                self.client._report(self.url, None, 'release')
+
+        def set_down(self, host=None):
+            self.client._report(self.url, host, 'down')
+            self.client._forget(self.url, host)
+            if not host:
+                self.client.sessions.evict(self.url)
+            if self.client.metrics is not None:
+                self.client.metrics.emit('down', proxy=self, host=host)
+
+    def __init__(self, path, lease_batch=8, report_batch=64, report_interval=1.0, **kwargs):
+        """
+        :path: Path of the Unix socket of the PoolServer
+        :lease_batch: Number of proxies leased per round trip
+        :report_batch: Number of buffered outcomes that triggers a round trip
+        :report_interval: Maximum number of seconds outcomes are buffered
+        Other arguments are passed on to ProxyPool
+        """
+        kwargs['max_hedge_ratio'] = 0.0
+        ProxyPool.__init__(self, [], **kwargs)
+        self.path = path
+        self.lease_batch = lease_batch
+        self.report_batch = report_batch
+        self.report_interval = report_interval
+        # (host, leased) -> unused (proxy url, latency quantile) pairs
+        self.leases = {}
+        self.reports = []
+        self.last_report = time.time()
+        self.client_id = uuid.uuid4().hex
+        self.local = threading.local()  # Connection per thread
+        self.flusher = self._start_flushing()
+
+    def _start_flushing(self):
+        """
+        Starts sending the buffered reports every report_interval seconds,
+        until the client is closed
+        """
+        def run():
+            try:
+                while not self.closed.wait(self.report_interval):
+                    try:
+                        self.flush()
+                    except Exception as e:
+                        logger.error("Sending reports failed: %s", e)
+            finally:
+                self.__disconnect()
+
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        return t
+
+    def __connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+            conn = self.local.conn = (sock, sock.makefile('rb'))
+        return conn
+
+    def __disconnect(self):
+        """
+        Closes the connection of the calling thread, if any
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+            self.local.conn = None
+
+    def __call(self, request):
+        """
+        Sends request along with the buffered reports, and returns the reply
+        """
+        request['client'] = self.client_id
+        with self.lock:
+            request['reports'], self.reports = self.reports, []
+            self.last_report = time.time()
+        sock, rfile = self.__connection()
+        try:
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            line = rfile.readline()
+        except (IOError, OSError):
+            self.local.conn = None
+            raise
+        if not line:
+            self.local.conn = None
+            raise Exception("Connection to pool server %s closed" % self.path)
+        reply = json.loads(line.decode('utf-8'))
+        if 'error' in reply:
+            raise Exception(reply['error'])
+        return reply
+
+    def _report(self, url, host, kind, value=None):
+        with self.lock:
+            self.reports.append((url, host, kind, value))
+            flush = (len(self.reports) >= self.report_batch or
+                     time.time() - self.last_report >= self.report_interval)
+        if flush:
+            self.flush()
+
+    def __drop_leases(self, match):
+        """
+        Releases the unused leases of (host, url) pairs accepted by match
+        """
+        with self.lock:
+            dropped = []
+            for (host, lease), leased in self.leases.items():
+                if lease:
+                    dropped.extend(u for u, _ in leased if match(host, u))
+                leased[:] = [(u, q) for u, q in leased if not match(host, u)]
+            self.reports.extend((u, None, 'release', None) for u in dropped)
+
+    def _forget(self, url, host=None):
+        """
+        Drops the unused leases of url, for host or for all hosts if None
+        """
+        self.__drop_leases(lambda h, u: u == url and (not host or h == host))
+
+    def flush(self):
+        """
+        Sends the buffered reports to the server
+        """
+        if self.reports:
+            self.__call({})
+
+    def get_proxy(self, host=None, lease=False, timeout=None, expires=None):
+        """
+        Returns a proxy from the server, counted as in flight by the server
+        until it is released if lease is set.
+
+        :timeout: Seconds the server waits for a saturated proxy, the
+            lease_timeout of the server's pool by default
+        :expires: Point in time after which the server stops waiting for a
+            proxy to resume
+        """
+        with self.lock:
+            leased = self.leases.get((host, lease))
+            if leased:
+                return PoolClient.RemoteProxy(self, *leased.pop(), leased=lease)
+        request = {'lease' if lease else 'sample': self.lease_batch, 'host': host,
+                   'timeout': timeout}
+        if expires is not None:
+            request['deadline'] = expires - time.time()
+        leased = self.__call(dict(request, wait=False))['proxies']
+        if not leased:
+            # The unused leases for other hosts may be holding up the proxies
+            self.__drop_leases(lambda h, u: h != host)
+            leased = self.__call(request)['proxies']
+        leased = [tuple(proxy) for proxy in leased]
+        url, quantile = leased.pop()
+        with self.lock:
+            self.leases.setdefault((host, lease), []).extend(leased)
+        return PoolClient.RemoteProxy(self, url, quantile, leased=lease)
+
+    def refresh(self):
+        self.__drop_leases(lambda h, u: True)
+        self.__call({'op': 'refresh'})
+
+    def status(self):
+        """
+        Returns the number of proxies and good proxies of the server's pool,
+        and the number of times it has been refreshed
+        """
+        return self.__call({'op': 'status'})
+
+    def __str__(self):
+        status = self.status()
+        return "%d proxies (%d good, updated %d times) at %s" % (
+            status['proxies'], status['good'], status['provider_updates'], self.path)
+
+    def __len__(self):
+        return self.status()['proxies']
+
+    @property
+    def good(self):
+        return self.status()['good']
+
+    def cooldown(self, p, host, delay=None):
+        # Leased proxies may be cooling down as well, lease fresh ones
+        self.__drop_leases(lambda h, u: h == host)
+        self._report(p.url, host, 'cooldown', delay)
+        if self.metrics is not None:
+            self.metrics.emit('cooldown', proxy=p, host=host, delay=delay)
+
+    def cooldown_reset(self, p, host):
+        self._report(p.url, host, 'cooldown_reset')
+
+    def close(self):
+        try:
+            self.__drop_leases(lambda h, u: True)
+            self.flush()
+        finally:
+            ProxyPool.close(self)
+            self.__disconnect()
@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+try:
+    from http.cookiejar import DefaultCookiePolicy
+except ImportError:
+    from cookielib import DefaultCookiePolicy
+
+import requests
+
+
+class SessionCache(object):
+    """
+    Bounded LRU of requests.Session objects keyed by proxy url, so that
+    connections through a proxy are kept alive and reused between requests.
+    """
+
+    def __init__(self, max_sessions=256, pool_connections=10, pool_maxsize=10):
+        """
+        :max_sessions: Maximum number of proxies to keep sessions for
+        :pool_connections: Number of connection pools (target hosts) to cache per proxy
+        :pool_maxsize: Maximum number of connections to keep per connection pool
+        """
+        self.max_sessions = max_sessions
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __create(self):
+        s = requests.Session()
+        # Sessions are shared between unrelated requests, so behave like the
+        # stateless requests API and don't let cookies leak between them
+        s.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        for prefix in ['http://', 'https://']:
+            s.mount(prefix, requests.adapters.HTTPAdapter(
+                pool_connections=self.pool_connections,
+                pool_maxsize=self.pool_maxsize))
+        return s
+
+    def get(self, url):
+        """
+        Returns the session for the proxy url, creating it if needed
+        """
+        evicted = None
+        with self.lock:
+            s = self.sessions.pop(url, None)
+            if s is None:
+                s = self.__create()
+                if len(self.sessions) >= self.max_sessions:
+                    _, evicted = self.sessions.popitem(last=False)
+            self.sessions[url] = s
+        if evicted is not None:
+            evicted.close()
+        return s
+
+    def evict(self, url):
+        """
+        Closes and forgets the session for the proxy url, if any
+        """
+        with self.lock:
+            s = self.sessions.pop(url, None)
+        if s is not None:
+            s.close()
+
+    def retain(self, urls):
+        """
+        Evicts every session whose proxy url is not in urls
+        """
+        with self.lock:
+            dropped = [url for url in self.sessions if url not in urls]
+            closed = [self.sessions.pop(url) for url in dropped]
+        for s in closed:
+            s.close()
+
+    def clear(self):
+        self.retain(())
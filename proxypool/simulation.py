@@ -0,0 +1,328 @@
+import bisect
+import collections
+import heapq
+import math
+import random
+import time
+
+import requests
+
+from .providers import ProxyProvider
+from .proxypool import ProxyPool, SUCCESS, FAILURE, SATURATED
+
+# Errors reported to the pool for simulated attempts
+CONNECT_TIMEOUT = requests.exceptions.ConnectTimeout("Simulated connect timeout")
+READ_TIMEOUT = requests.exceptions.ReadTimeout("Simulated read timeout")
+CONNECTION_ERROR = requests.exceptions.ConnectionError("Simulated connection error")
+
+
+class ProxyModel(object):
+    """
+    Behaviour of a simulated proxy. Latencies are log-normally distributed
+    around latency. Dead proxies never accept connections.
+    """
+
+    def __init__(self, latency=0.5, spread=0.5, failrate=0.0, rate_limit=0.0, ban=0.0,
+                 dead=False):
+        """
+        :latency: Median latency in seconds
+        :spread: Standard deviation of the logarithm of the latency
+        :failrate: Probability of a connection error
+        :rate_limit: Probability of a 429 response
+        :ban: Probability of a 403 response
+        :dead: Never accept connections
+        """
+        self.latency = latency
+        self.spread = spread
+        self.failrate = failrate
+        self.rate_limit = rate_limit
+        self.ban = ban
+        self.dead = dead
+
+    def attempt(self, rng, host):
+        """
+        Returns the (status, latency) of an attempt to host: status 0 for a
+        connection error after latency seconds, and (None, None) if the proxy
+        doesn't accept the connection
+        """
+        if self.dead:
+            return None, None
+        latency = self.latency * rng.lognormvariate(0.0, self.spread)
+        r = rng.random()
+        if r < self.failrate:
+            return 0, latency
+        r -= self.failrate
+        if r < self.rate_limit:
+            return 429, latency
+        r -= self.rate_limit
+        if r < self.ban:
+            return 403, latency
+        return 200, latency
+
+
+class SampledProxy(object):
+    """
+    Simulated proxy replaying the attempts of a trace in random order
+    """
+
+    def __init__(self, samples):
+        """
+        :samples: List of (status, latency) pairs, with latency NaN for
+            connection errors of unknown duration
+        """
+        self.samples = samples
+
+    def attempt(self, rng, host):
+        status, latency = self.samples[int(rng.random() * len(self.samples))]
+        if math.isnan(latency):
+            return None, None
+        return status, latency
+
+
+def synthetic_proxies(n, seed=None, dead=0.3, failing=0.1, slow=0.2, rate_limited=0.05):
+    """
+    Returns a dict of url -> ProxyModel of n proxies, mixing dead, failing,
+    slow and rate limited proxies like scraped proxy lists
+    """
+    rng = random.Random(seed)
+    proxies = {}
+    for i in range(n):
+        url = 'http://10.%d.%d.%d:8080' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+        r = rng.random()
+        latency = rng.uniform(0.1, 1.0)
+        if r < dead:
+            proxies[url] = ProxyModel(dead=True)
+        elif r < dead + failing:
+            proxies[url] = ProxyModel(latency, failrate=rng.uniform(0.3, 0.9))
+        elif r < dead + failing + slow:
+            proxies[url] = ProxyModel(rng.uniform(2.0, 10.0), spread=1.0, failrate=0.05)
+        elif r < dead + failing + slow + rate_limited:
+            proxies[url] = ProxyModel(latency, rate_limit=0.5)
+        else:
+            proxies[url] = ProxyModel(latency, failrate=rng.uniform(0.0, 0.05))
+    return proxies
+
+
+def trace_proxies(records):
+    """
+    Returns a dict of url -> SampledProxy, and a dict of host -> number of
+    attempts, from the TraceRecords of a trace
+    """
+    samples = collections.defaultdict(list)
+    hosts = collections.Counter()
+    for record in records:
+        samples[record.proxy].append((record.status, record.latency))
+        if record.host:
+            hosts[record.host] += 1
+    return dict((url, SampledProxy(s)) for url, s in samples.items()), dict(hosts)
+
+
+def percentile(samples, q):
+    """
+    Returns the q quantile of sorted samples
+    """
+    return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else None
+
+
+class _Population(ProxyProvider):
+
+    def __init__(self, urls):
+        self.urls = set(urls)
+
+    def update(self):
+        return set(self.urls)
+
+
+class _SimulatedPool(ProxyPool):
+    """
+    ProxyPool whose background work is scheduled as simulator events instead
+    of running on threads
+    """
+
+    def __init__(self, simulator, providers, **kwargs):
+        ProxyPool.__init__(self, providers, clock=simulator.clock, **kwargs)
+        self.simulator = simulator
+
+    def _refresh_in_background(self):
+        self.simulator.schedule(0.0, self.refresh)
+
+    def _start_reprobing(self):
+        def run():
+            down = self._rehabilitation_candidates()
+            latencies = {}
+            for p in down:
+                status, latency = self.simulator.proxies[p.url].attempt(self.simulator.rng, None)
+                if status == 200:
+                    latencies[p.url] = latency
+            self._revive(down, latencies)
+            self.simulator.schedule(self.reprobe_interval, run)
+
+        self.simulator.schedule(self.reprobe_interval, run)
+        return run
+
+
+class _Request(object):
+    __slots__ = ('host', 'start', 'failures', 'attempts')
+
+    def __init__(self, host, start):
+        self.host = host
+        self.start = start
+        self.failures = 0
+        self.attempts = 0
+
+
+class Simulator(object):
+    """
+    Discrete-event simulator of a ProxyPool in virtual time, for tuning its
+    parameters offline. Requests are made by concurrency clients, each making
+    its next request as soon as the previous one is done, through simulated
+    proxies given as ProxyModels or replayed from a trace.
+
+    Proxies are sampled, leased, timed out, scored, cooled down and excluded
+    by the pool itself, with the retry logic of ProxyPool.request. Hedging,
+    rate limiters and deadlines are not simulated.
+    """
+
+    def __init__(self, proxies, hosts=None, concurrency=32, seed=None):
+        """
+        :proxies: Dict of url -> ProxyModel or SampledProxy
+        :hosts: Dict of target host -> relative frequency of requests
+        :concurrency: Number of requests in flight
+        :seed: Seed of the random numbers, also seeds the random module that
+            the pool samples with
+        """
+        self.proxies = proxies
+        self.hosts = hosts or {'example.com': 1}
+        self.concurrency = concurrency
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.now = 0.0
+        self.events = []  # (time, sequence number, callback, args)
+        self.sequence = 0
+
+    def clock(self):
+        return self.now
+
+    def schedule(self, delay, callback, *args):
+        self.sequence += 1
+        heapq.heappush(self.events, (self.now + delay, self.sequence, callback, args))
+
+    def run(self, requests=100000, **kwargs):
+        """
+        Simulates requests through a pool created with kwargs, and returns
+        its throughput, success rate and latencies as a dict
+        """
+        if self.seed is not None:
+            random.seed(self.seed)
+        self.rng = random.Random(self.seed)
+        self.now = 0.0
+        self.events = []
+        pool = _SimulatedPool(self, [_Population(self.proxies)], **kwargs)
+        pool.refresh()
+        hosts = list(self.hosts)
+        cum_weights = []
+        total = 0.0
+        for host in hosts:
+            total += self.hosts[host]
+            cum_weights.append(total)
+
+        latencies = []
+        waiting = []  # Requests waiting for a proxy to be released
+        state = {'issued': 0, 'done': 0, 'failed': 0, 'attempts': 0}
+        rng = self.rng
+        max_attempts = pool.max_proxy_attempts
+
+        def issue():
+            if state['issued'] >= requests:
+                return
+            state['issued'] += 1
+            host = hosts[min(len(hosts) - 1,
+                             bisect.bisect_right(cum_weights, rng.random() * total))]
+            start(_Request(host, self.now))
+
+        def finish(req, ok):
+            if ok:
+                latencies.append(self.now - req.start)
+            else:
+                state['failed'] += 1
+            state['attempts'] += req.attempts
+            state['done'] += 1
+            issue()
+
+        def start(req):
+            try:
+                p, delay = pool._try_get_proxy(req.host, lease=True)
+            except Exception:
+                # All proxies are banned by or failing for the host
+                finish(req, False)
+                return
+            if p is None:
+                if delay is None:
+                    pool.refresh()
+                    self.schedule(0.0, start, req)
+                elif delay is SATURATED:
+                    waiting.append(req)
+                else:
+                    self.schedule(delay, start, req)
+                return
+            req.attempts += 1
+            status, latency = self.proxies[p.url].attempt(rng, req.host)
+            connect, read = pool.timeouts(p)
+            if status is None:
+                self.schedule(connect, complete, req, p, CONNECT_TIMEOUT, None, connect)
+            elif latency > read:
+                self.schedule(read, complete, req, p, READ_TIMEOUT, None, read)
+            elif status == 0:
+                self.schedule(latency, complete, req, p, CONNECTION_ERROR, None, latency)
+            else:
+                self.schedule(latency, complete, req, p, None, status, latency)
+
+        def complete(req, p, error, status, latency):
+            p.release()
+            if waiting:
+                for w in waiting:
+                    self.schedule(0.0, start, w)
+                del waiting[:]
+            if error is not None:
+                pool._handle_error(p, None if error is CONNECT_TIMEOUT else req.host,
+                                   error, latency)
+                outcome = FAILURE
+            else:
+                outcome = pool._handle_response(p, req.host, status, {}, latency)
+            if outcome == SUCCESS:
+                finish(req, True)
+                return
+            if outcome == FAILURE:
+                req.failures += 1
+                if req.failures > max_attempts:
+                    finish(req, False)
+                    return
+            start(req)
+
+        t0 = time.time()
+        for _ in range(min(self.concurrency, requests)):
+            issue()
+        events = self.events
+        # Periodic events like reprobing don't end by themselves
+        while events and state['done'] < requests:
+            t, _, callback, args = heapq.heappop(events)
+            self.now = t
+            callback(*args)
+        wall_time = time.time() - t0
+        pool.close()
+
+        latencies.sort()
+        done = state['done']
+        return {
+            'requests': done,
+            'successes': len(latencies),
+            'success_rate': float(len(latencies)) / done if done else 0.0,
+            'attempts_per_request': float(state['attempts']) / done if done else 0.0,
+            'throughput': len(latencies) / self.now if self.now else 0.0,
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'virtual_time': self.now,
+            'wall_time': wall_time,
+            'requests_per_second': done / wall_time if wall_time else 0.0,
+        }
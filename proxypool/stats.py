@@ -0,0 +1,268 @@
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class LatencyWindow(object):
+    """
+    The most recent latency samples of a proxy, used for streaming quantile
+    estimates (eg. p50/p95) that follow changes in the proxy's behaviour.
+    """
+    __slots__ = ('samples', 'size', 'pos')
+
+    def __init__(self, size=32):
+        self.samples = []
+        self.size = size
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, t):
+        """
+        Safe to call without a lock, concurrent adds may at worst overwrite
+        each other or grow the window by a few samples
+        """
+        if len(self.samples) < self.size:
+            self.samples.append(t)
+        else:
+            self.samples[self.pos] = t
+            self.pos = (self.pos + 1) % self.size
+
+    def quantile(self, q):
+        """
+        Returns the q-quantile (0 <= q <= 1) of the window, or None if empty
+        """
+        if not self.samples:
+            return None
+        s = sorted(self.samples)
+        return s[min(len(s) - 1, int(q * len(s)))]
+
+
+def decay_factor(elapsed, half_life):
+    """
+    Returns the weight of an observation made elapsed seconds ago
+    """
+    return 0.5 ** (elapsed / half_life)
+
+
+class HostStats(object):
+    """
+    Metrics of a proxy towards a single target host. Kept small, as there is
+    one instance per (proxy, host) pair in use. The decay parameters are
+    passed in by the owner instead of being stored per instance.
+    """
+    __slots__ = ('t', 'successes', 'failures', 'updated', 'down')
+
+    def __init__(self, now):
+        self.t = None
+        self.successes = 0.0
+        self.failures = 0.0
+        self.updated = now
+        self.down = False
+
+    def add_latency(self, t, smoothing):
+        self.t = t if self.t is None else self.t + smoothing * (t - self.t)
+
+    def add_outcome(self, failed, now, half_life):
+        k = decay_factor(now - self.updated, half_life)
+        self.successes *= k
+        self.failures *= k
+        self.updated = now
+        if failed:
+            self.failures += 1
+        else:
+            self.successes += 1
+
+    def as_tuple(self):
+        return (self.t, self.successes, self.failures, self.updated, self.down)
+
+    @classmethod
+    def from_tuple(cls, values):
+        hs = cls(0.0)
+        hs.t, hs.successes, hs.failures, hs.updated, down = values
+        hs.down = bool(down)
+        return hs
+
+    def rate(self, now, half_life, prior=1.0):
+        """
+        See StatsStore.failrate
+        """
+        k = decay_factor(now - self.updated, half_life)
+        return self.failures * k / ((self.successes + self.failures) * k + prior)
+
+
+class StatsStore(object):
+    """
+    Metrics of the proxies of a pool, kept in contiguous arrays indexed by
+    proxy row instead of in one Python object per proxy. Allows computing the
+    sampling weights of the whole pool in one batch, vectorized if numpy is
+    available.
+
+    Recent outcomes decay exponentially with time, so that the failrate
+    reflects recent behaviour and old failures are forgotten.
+    """
+
+    # name -> (array typecode, initial value)
+    COLUMNS = {
+        # Smoothed latency. Assume an initially small latency to give new
+        # proxies a high probability of being sampled.
+        't': ('d', 1e-3),
+        # Lifetime counters
+        'successes': ('q', 0),
+        'failures': ('q', 0),
+        # Decayed counters and the time they were last decayed
+        'recent_successes': ('d', 0.0),
+        'recent_failures': ('d', 0.0),
+        'updated': ('d', 0.0),
+        'down': ('b', 0),
+        'sample_counter': ('q', 0),
+        # Number of leased requests in flight, and the maximum allowed at
+        # once (0 for the default of the pool)
+        'in_flight': ('i', 0),
+        'max_in_flight': ('i', 0),
+        # Number of samples in, and next position of, the latency window
+        'window_len': ('H', 0),
+        'window_pos': ('H', 0),
+    }
+
+    def __init__(self, n, window_size=32, now=0.0):
+        """
+        :n: Number of rows
+        :window_size: Number of recent latency samples kept per row
+        :now: Initial decay time
+        """
+        for name, (typecode, value) in self.COLUMNS.items():
+            setattr(self, name, array(typecode, [value]) * n)
+        self.updated = array('d', [now]) * n
+        self.window_size = window_size
+        self.window = array('d', [0.0]) * (n * window_size)
+        # host -> HostStats per row, None until the first host is recorded
+        self.hosts = [None] * n
+
+    def __len__(self):
+        return len(self.t)
+
+    def nbytes(self):
+        """
+        Returns the size of the arrays in bytes
+        """
+        return sum(a.itemsize * len(a) for a in
+                   [getattr(self, name) for name in self.COLUMNS] + [self.window])
+
+    def copy_row(self, i, other, j):
+        """
+        Copies row j of other into row i
+        """
+        for name in self.COLUMNS:
+            getattr(self, name)[i] = getattr(other, name)[j]
+        w = self.window_size
+        if w == other.window_size:
+            self.window[i * w:(i + 1) * w] = other.window[j * w:(j + 1) * w]
+        self.hosts[i] = other.hosts[j]
+
+    def record(self, i):
+        """
+        Returns the metrics of row i as a dict of column -> value, with the
+        latency window as a list from oldest to newest sample
+        """
+        rec = dict((name, getattr(self, name)[i]) for name in self.COLUMNS)
+        w = self.window_size
+        n = self.window_len[i]
+        window = self.window[i * w:i * w + n].tolist()
+        if n == w:
+            pos = self.window_pos[i]
+            window = window[pos:] + window[:pos]
+        rec['window'] = window
+        return rec
+
+    def restore(self, i, rec):
+        """
+        Sets the metrics of row i from a record() of any store
+        """
+        for name in self.COLUMNS:
+            if name in rec:
+                getattr(self, name)[i] = rec[name]
+        window = rec.get('window', [])[-self.window_size:]
+        w = self.window_size
+        self.window[i * w:i * w + len(window)] = array('d', window)
+        self.window_len[i] = len(window)
+        self.window_pos[i] = len(window) % w
+
+    def add_latency(self, i, t, smoothing):
+        if self.window_len[i] == 0:
+            self.t[i] = t
+        else:
+            self.t[i] += smoothing * (t - self.t[i])
+        pos = self.window_pos[i]
+        self.window[i * self.window_size + pos] = t
+        self.window_pos[i] = (pos + 1) % self.window_size
+        if self.window_len[i] < self.window_size:
+            self.window_len[i] += 1
+
+    def latency_quantile(self, i, q):
+        """
+        Returns the q-quantile (0 <= q <= 1) of the recent latencies of row i,
+        or None if there are none
+        """
+        n = self.window_len[i]
+        if n == 0:
+            return None
+        s = sorted(self.window[i * self.window_size:i * self.window_size + n])
+        return s[min(n - 1, int(q * n))]
+
+    def add_outcome(self, i, failed, now, half_life):
+        k = decay_factor(now - self.updated[i], half_life)
+        self.recent_successes[i] *= k
+        self.recent_failures[i] *= k
+        self.updated[i] = now
+        if failed:
+            self.failures[i] += 1
+            self.recent_failures[i] += 1
+        else:
+            self.successes[i] += 1
+            self.recent_successes[i] += 1
+
+    def reset_outcomes(self, i):
+        self.recent_successes[i] = 0.0
+        self.recent_failures[i] = 0.0
+
+    def failrate(self, i, now, half_life, prior=1.0):
+        """
+        Returns the decayed failrate of row i. prior pseudo-observations pull
+        the rate of proxies without recent outcomes towards 0, which lets
+        excluded proxies recover over time.
+        """
+        k = decay_factor(now - self.updated[i], half_life)
+        f = self.recent_failures[i] * k
+        return f / ((self.recent_successes[i] + self.recent_failures[i]) * k + prior)
+
+    def excluded(self, i, max_failrate, now, half_life):
+        """
+        Returns True if row i is down or fails too often to be used
+        """
+        return bool(self.down[i]) or self.failrate(i, now, half_life) >= max_failrate
+
+    def weight(self, i, max_failrate, now, half_life):
+        """
+        Returns the unnormalized sampling weight of row i, 0 if it is excluded
+        """
+        if self.excluded(i, max_failrate, now, half_life):
+            return 0.0
+        return self.t[i] ** -1.0
+
+    def weights(self, max_failrate, now, half_life):
+        """
+        Returns the sampling weights of all rows as a list
+        """
+        if numpy is not None and len(self) > 0:
+            t = numpy.frombuffer(self.t, dtype=numpy.float64)
+            s = numpy.frombuffer(self.recent_successes, dtype=numpy.float64)
+            f = numpy.frombuffer(self.recent_failures, dtype=numpy.float64)
+            k = 0.5 ** ((now - numpy.frombuffer(self.updated, dtype=numpy.float64)) / half_life)
+            rate = f * k / ((s + f) * k + 1.0)
+            good = (numpy.frombuffer(self.down, dtype=numpy.int8) == 0) & (rate < max_failrate)
+            return numpy.where(good, 1.0 / t, 0.0).tolist()
+        return [self.weight(i, max_failrate, now, half_life) for i in range(len(self))]
@@ -1,5 +1,7 @@
+import collections
 import logging
 import threading
+from concurrent.futures import Future
 try:
     import queue
 except ImportError:
@@ -10,6 +12,13 @@ logger = logging.getLogger(__name__)
 
 
 class ThreadPool(object):
+    """
+    Runs functions on a fixed number of worker threads. Submitted calls are
+    represented by futures, delivering results and exceptions to the caller.
+    The queue of pending calls is bounded, so that producers block instead of
+    materializing every task up front.
+    """
+
     class Worker(threading.Thread):
 
         def __init__(self, tasks):
@@ -20,26 +29,136 @@ class ThreadPool(object):
 
         def run(self):
             while True:
-                func, result_handler, args, kwargs = self.tasks.get()
+                task = self.tasks.get()
                 try:
-                    result_handler(func(*args, **kwargs))
-                except Exception as e:
-                    logger.error(e)
+                    if task is None:
+                        # Shutdown sentinel
+                        return
+                    future, func, result_handler, args, kwargs = task
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        result = func(*args, **kwargs)
+                        if result_handler is not None:
+                            result_handler(result)
+                    except BaseException as e:
+                        logger.debug(e)
+                        future.set_exception(e)
+                    else:
+                        future.set_result(result)
                 finally:
                     self.tasks.task_done()
 
-    def __init__(self, num_workers):
-        self.call_queue = queue.Queue()
+    def __init__(self, num_workers, queue_size=None):
+        """
+        :num_workers: Number of worker threads
+        :queue_size: Maximum number of calls waiting for a worker before put()
+            blocks, defaults to 4 * num_workers. 0 means unbounded.
+        """
+        if queue_size is None:
+            queue_size = 4 * num_workers
+        self.call_queue = queue.Queue(queue_size)
+        self.closed = False
 
         self.workers = [ThreadPool.Worker(self.call_queue)
                         for _ in range(num_workers)]
 
-    def put(self, func, args, kwargs, result_handler=lambda x: x):
-        self.call_queue.put((func, result_handler, args, kwargs))
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def __window(self):
+        """
+        Number of calls that can be outstanding without blocking a producer
+        """
+        return len(self.workers) + max(self.call_queue.maxsize, len(self.workers))
+
+    def put(self, func, args, kwargs, result_handler=None):
+        """
+        Schedules func(*args, **kwargs), blocking while the queue is full, and
+        returns a Future of its result. The optional result_handler is called
+        with the result on the worker thread.
+        """
+        if self.closed:
+            raise RuntimeError("ThreadPool is shut down")
+        future = Future()
+        self.call_queue.put((future, func, result_handler, args, kwargs))
+        return future
+
+    def map(self, func, args_list, result_handler=None):
+        """
+        Schedules func for every (args, kwargs) in args_list and returns the
+        list of futures
+        """
+        return [self.put(func, args, kwargs, result_handler)
+                for args, kwargs in args_list]
 
-    def map(self, func, args_list, result_handler=lambda x: x):
-        for args, kwargs in args_list:
-            self.put(func, args, kwargs, result_handler)
+    def imap(self, func, args_list):
+        """
+        Yields the results of func for every (args, kwargs) in args_list, in
+        order. args_list is consumed lazily, and an exception raised by a call
+        is raised when its result is reached.
+        """
+        pending = collections.deque()
+        try:
+            for args, kwargs in args_list:
+                if len(pending) >= self.__window():
+                    yield pending.popleft().result()
+                pending.append(self.put(func, args, kwargs))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def imap_unordered(self, func, args_list):
+        """
+        Like imap, but yields the results as they complete
+        """
+        done = queue.Queue()
+        pending = set()
+        args_list = iter(args_list)
+        try:
+            while True:
+                while len(pending) < self.__window():
+                    try:
+                        args, kwargs = next(args_list)
+                    except StopIteration:
+                        break
+                    future = self.put(func, args, kwargs)
+                    pending.add(future)
+                    future.add_done_callback(done.put)
+                if not pending:
+                    return
+                future = done.get()
+                pending.discard(future)
+                yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
 
     def wait(self):
         self.call_queue.join()
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        """
+        Stops the workers once the queued calls are done, or cancels the queued
+        calls first if cancel_futures is set.
+        """
+        self.closed = True
+        if cancel_futures:
+            while True:
+                try:
+                    task = self.call_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if task is not None:
+                    task[0].cancel()
+                self.call_queue.task_done()
+        for _ in self.workers:
+            self.call_queue.put(None)
+        if wait:
+            for w in self.workers:
+                w.join()
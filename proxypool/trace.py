@@ -0,0 +1,111 @@
+import collections
+import struct
+import threading
+
+from .proxypool import SUCCESS, FAILURE, RATE_LIMITED
+
+MAGIC = b'PPTRACE1'
+
+# Record kinds
+STRING = 0
+ATTEMPT = 1
+
+# kind, string id, length of the utf-8 string that follows
+STRING_RECORD = struct.Struct('<BIH')
+# kind, time, proxy string id, host string id, outcome, status, latency
+ATTEMPT_RECORD = struct.Struct('<BdIIBHf')
+
+# Outcomes as stored, in the order of their codes
+OUTCOMES = [SUCCESS, FAILURE, RATE_LIMITED]
+OUTCOME_CODES = dict((outcome, i) for i, outcome in enumerate(OUTCOMES))
+
+TraceRecord = collections.namedtuple(
+    'TraceRecord', ['time', 'proxy', 'host', 'outcome', 'status', 'latency'])
+TraceRecord.__doc__ = """
+An attempt through a proxy. host is None for errors that don't depend on the
+target host, status is 0 for connection errors and latency is NaN if unknown.
+"""
+
+
+class TraceRecorder(object):
+    """
+    Records every attempt of a ProxyPool to a compact binary file, 24 bytes
+    per attempt. Proxy urls and hosts are written once, and referred to by id
+    afterwards. Read traces with read_trace().
+    """
+
+    def __init__(self, path, buffer_size=64 * 1024):
+        """
+        :path: Path of the trace file, overwritten if it exists
+        :buffer_size: Bytes buffered before writing to the file
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'wb', buffer_size)
+        self.file.write(MAGIC)
+        self.ids = {}  # string -> id
+        self.count = 0
+
+    def __id(self, s):
+        """
+        Must be called inside lock
+        """
+        i = self.ids.get(s)
+        if i is None:
+            i = self.ids[s] = len(self.ids)
+            data = s.encode('utf-8')
+            self.file.write(STRING_RECORD.pack(STRING, i, len(data)))
+            self.file.write(data)
+        return i
+
+    def record(self, now, proxy, host, outcome, status, latency):
+        """
+        :now: Time of the attempt
+        :proxy: Url of the proxy
+        :host: Target host, None for errors that don't depend on it
+        :outcome: SUCCESS, FAILURE or RATE_LIMITED
+        :status: HTTP status, 0 for connection errors
+        :latency: Seconds until the response or error, None if unknown
+        """
+        with self.lock:
+            self.file.write(ATTEMPT_RECORD.pack(
+                ATTEMPT, now, self.__id(proxy), self.__id(host or ''),
+                OUTCOME_CODES[outcome], status,
+                float('nan') if latency is None else latency))
+            self.count += 1
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_trace(path):
+    """
+    Yields the TraceRecords of a trace file
+    """
+    strings = {}
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception("%s is not a proxypool trace" % path)
+        while True:
+            kind = f.read(1)
+            if not kind:
+                return
+            if ord(kind) == STRING:
+                header = kind + f.read(STRING_RECORD.size - 1)
+                _, i, length = STRING_RECORD.unpack(header)
+                strings[i] = f.read(length).decode('utf-8')
+            elif ord(kind) == ATTEMPT:
+                data = kind + f.read(ATTEMPT_RECORD.size - 1)
+                if len(data) < ATTEMPT_RECORD.size:
+                    # Truncated by a process that didn't close the trace
+                    return
+                _, t, proxy, host, outcome, status, latency = ATTEMPT_RECORD.unpack(data)
+                yield TraceRecord(t, strings[proxy], strings[host] or None,
+                                  OUTCOMES[outcome], status, latency)
+            else:
+                raise Exception("Corrupt trace %s" % path)
@@ -0,0 +1,74 @@
+import logging
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import requests
+
+from .providers import proxy_dict
+
+logger = logging.getLogger(__name__)
+
+
+class ProxyValidator(object):
+    """
+    Probes proxies concurrently before they are admitted to a pool, so that
+    dead proxies from scraped lists don't cost real requests.
+    """
+
+    def __init__(self, probe_url='https://api.ipify.org', timeout=5.0, parallelism=32):
+        """
+        :probe_url: Url fetched through every proxy
+        :timeout: Timeout of a probe in seconds
+        :parallelism: Maximum number of concurrent probes
+        """
+        self.probe_url = probe_url
+        self.timeout = timeout
+        self.parallelism = parallelism
+
+    def probe(self, url):
+        """
+        Returns the latency in seconds of a request through the proxy url, or
+        None if the proxy doesn't respond successfully.
+        """
+        try:
+            r = requests.get(self.probe_url, proxies=proxy_dict(url), timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            logger.debug("%s: Probe failed: %s", url, e)
+            return None
+        if r.status_code >= 400:
+            logger.debug("%s: Probe failed with http status %d", url, r.status_code)
+            return None
+        return r.elapsed.total_seconds()
+
+    def validate(self, urls):
+        """
+        Probes all urls and returns a dict of proxy url -> latency for the
+        proxies that responded.
+        """
+        tasks = queue.Queue()
+        for url in urls:
+            tasks.put(url)
+        latencies = {}
+
+        def run():
+            while True:
+                try:
+                    url = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                t = self.probe(url)
+                if t is not None:
+                    latencies[url] = t
+
+        threads = [threading.Thread(target=run)
+                   for _ in range(min(self.parallelism, tasks.qsize()))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        logger.info("%d of %d proxies passed validation", len(latencies), len(urls))
+        return latencies
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+"""
+Benchmarks ProxyPool offline and prints the results as JSON, so that
+regressions in the hot path can be tracked.
+
+    selection    get_proxy ops/sec for growing pools and thread counts, with
+                 synthetic metric updates between samples
+    e2e          requests/sec and p50/p99 latency through local proxies with
+                 mixed latencies and failure rates, using the test harness.
+                 The proxies are addresses of the 127.0.0.0/8 loopback range
+                 served by a handful of servers, as on Linux, so that pools of
+                 10,000 proxies don't need as many sockets.
+    contention   get_proxy ops/sec while other threads report outcomes
+    convergence  how quickly sampling concentrates on the fastest proxies
+    memory       bytes allocated per proxy by a refreshed pool
+
+Example: script/benchmark.py --sizes 10,1000 --threads 1,8 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import importlib.util
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import proxypool  # noqa: E402
+
+
+def load_harness():
+    """
+    Imports the local http (proxy) servers from test/test.py
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'test.py')
+    spec = importlib.util.spec_from_file_location('harness', path)
+    harness = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(harness)
+    return harness
+
+
+class StaticProvider(proxypool.ProxyProvider):
+    def __init__(self, urls):
+        self.urls = set(urls)
+
+    def update(self):
+        return set(self.urls)
+
+
+def synthetic_urls(n):
+    return ['http://10.%d.%d.%d:8080' % (i >> 16 & 255, i >> 8 & 255, i & 255) for i in range(n)]
+
+
+def percentile(samples, q):
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(q * len(s)))] if s else None
+
+
+def bench_selection(n, num_threads, num_samples=20000):
+    pp = proxypool.ProxyPool(providers=[StaticProvider(synthetic_urls(n))])
+    pp.refresh()
+    true_latency = dict((p.url, random.uniform(0.05, 2.0)) for p in pp.proxies)
+    per_thread = num_samples // num_threads
+
+    def run():
+        for _ in range(per_thread):
+            p = pp.get_proxy()
+            # Feed back a result, like a request through the proxy would
+            p.set_latency(true_latency[p.url])
+            p.increase_successes()
+
+    threads = [threading.Thread(target=run) for _ in range(num_threads)]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - t0
+    return {'proxies': n, 'threads': num_threads,
+            'ops_per_sec': per_thread * num_threads / elapsed}
+
+
+def bench_contention(n, num_threads, duration=1.0):
+    """
+    Runs a sampling thread against num_threads threads reporting outcomes,
+    and reports the throughput of both
+    """
+    pp = proxypool.ProxyPool(providers=[StaticProvider(synthetic_urls(n))])
+    pp.refresh()
+    stop = threading.Event()
+    counts = [0] * (num_threads + 1)
+
+    def sample():
+        while not stop.is_set():
+            pp.get_proxy()
+            counts[0] += 1
+
+    def report(i):
+        proxies = list(pp.proxies)
+        while not stop.is_set():
+            p = random.choice(proxies)
+            p.set_latency(random.uniform(0.05, 2.0))
+            p.increase_successes()
+            counts[i] += 1
+
+    threads = [threading.Thread(target=sample)] + \
+        [threading.Thread(target=report, args=(i + 1,)) for i in range(num_threads)]
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    return {'proxies': n, 'reporting_threads': num_threads,
+            'samples_per_sec': counts[0] / duration,
+            'reports_per_sec': sum(counts[1:]) / duration}
+
+
+POLICIES = {
+    'inverse_latency': proxypool.InverseLatency,
+    'power_of_two': proxypool.PowerOfTwoChoices,
+    'thompson': proxypool.ThompsonSampling,
+}
+
+
+def bench_convergence(n, policy, num_requests=20000, window=1000):
+    """
+    Feeds back latencies from a fixed, heavy tailed latency distribution per
+    proxy, and reports the share of samples going to the fastest 10% of the
+    proxies over time.
+    """
+    pp = proxypool.ProxyPool(providers=[StaticProvider(synthetic_urls(n))],
+                             policy=POLICIES[policy]())
+    pp.refresh()
+    true_latency = dict((p.url, random.lognormvariate(-1.0, 1.0)) for p in pp.proxies)
+    fastest = set(sorted(true_latency, key=true_latency.get)[:max(1, n // 10)])
+
+    shares = []
+    hits = 0
+    for i in range(1, num_requests + 1):
+        p = pp.get_proxy()
+        hits += p.url in fastest
+        p.set_latency(true_latency[p.url] * random.uniform(0.8, 1.2))
+        p.increase_successes()
+        if i % window == 0:
+            shares.append([i, hits / float(window)])
+            hits = 0
+    return {'proxies': n, 'policy': policy, 'window': window, 'fastest_decile_share': shares}
+
+
+def bench_memory(n):
+    urls = synthetic_urls(n)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    pp = proxypool.ProxyPool(providers=[StaticProvider(urls)])
+    pp.refresh()
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return {'proxies': n, 'bytes_per_proxy': allocated / float(n),
+            'stats_bytes_per_proxy': pp.stats.nbytes() / float(n)}
+
+
+def loopback_address(i):
+    """
+    Returns the i:th address of the 127.1.0.0/16 loopback range
+    """
+    return '127.1.%d.%d' % (i // 250, i % 250 + 1)
+
+
+def bench_e2e(harness, n, num_threads, num_requests):
+    """
+    Runs requests through n local proxies: 10% don't respond, 10% respond
+    with 403, and the rest have latencies up to 50 ms. Proxies behaving alike
+    share a server listening on all addresses, and differ by address.
+    """
+    class ThreadingServer(socketserver.ThreadingMixIn, harness.MyHTTPServer):
+        daemon_threads = True
+
+    servers = []
+
+    def spawn(handler_class, latency, response_code):
+        s = ThreadingServer(('0.0.0.0', 0), handler_class,
+                            latency=latency, response_code=response_code)
+        t = threading.Thread(target=s.serve_forever)
+        t.daemon = True
+        t.start()
+        servers.append(s)
+        return s.server_port
+
+    target = 'http://127.0.0.1:%d/' % spawn(harness.HTTPRequestHandler, 0.0, 200)
+    silent = spawn(harness.HTTPProxyRequestHandler, 0.0, None)
+    banned = spawn(harness.HTTPProxyRequestHandler, 0.0, 403)
+    latencies = [spawn(harness.HTTPProxyRequestHandler, 0.01 * i, 200) for i in range(6)]
+    urls = []
+    for i in range(n):
+        if i % 10 == 0:
+            port = silent
+        elif i % 10 == 1:
+            port = banned
+        else:
+            port = random.choice(latencies)
+        urls.append('http://%s:%d' % (loopback_address(i), port))
+
+    pp = proxypool.ProxyPool(providers=[StaticProvider(urls)], default_timeout=1.0)
+    pp.refresh()
+
+    def timed_get(url):
+        t0 = time.time()
+        try:
+            pp.get(url)
+        except Exception:
+            return None
+        return time.time() - t0
+
+    t0 = time.time()
+    with proxypool.ThreadPool(num_threads) as tp:
+        latencies = list(tp.imap_unordered(timed_get, [((target,), {})] * num_requests))
+    elapsed = time.time() - t0
+    pp.close()
+    for s in servers:
+        s.shutdown()
+        s.server_close()
+
+    ok = [t for t in latencies if t is not None]
+    return {'proxies': n, 'threads': num_threads, 'requests': num_requests,
+            'errors': num_requests - len(ok),
+            'requests_per_sec': num_requests / elapsed,
+            'p50': percentile(ok, 0.5), 'p99': percentile(ok, 0.99)}
+
+
+def int_list(s):
+    return [int(x) for x in s.split(',') if x]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', default='selection,contention,e2e,convergence,memory',
+                        help='Comma separated benchmarks to run')
+    parser.add_argument('--sizes', type=int_list, default=[10, 100, 1000, 10000, 100000],
+                        help='Pool sizes for the selection, convergence and memory benchmarks')
+    parser.add_argument('--threads', type=int_list, default=[1, 4, 16, 64])
+    parser.add_argument('--e2e-sizes', type=int_list, default=[10, 100, 1000, 10000],
+                        help='Number of local proxies for the e2e benchmark')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='Requests per e2e benchmark')
+    parser.add_argument('--policies', default=','.join(sorted(POLICIES)),
+                        help='Comma separated selection policies for the convergence benchmark')
+    parser.add_argument('--output', help='Write results to a file instead of stdout')
+    args = parser.parse_args()
+    only = args.only.split(',')
+
+    results = {'python': platform.python_version(), 'time': time.time()}
+    if 'selection' in only:
+        results['selection'] = [bench_selection(n, t) for n in args.sizes for t in args.threads]
+    if 'contention' in only:
+        results['contention'] = [bench_contention(n, t) for n in args.sizes for t in args.threads]
+    if 'convergence' in only:
+        results['convergence'] = [bench_convergence(n, policy) for n in args.sizes
+                                  for policy in args.policies.split(',')]
+    if 'memory' in only:
+        results['memory'] = [bench_memory(n) for n in args.sizes]
+    if 'e2e' in only:
+        harness = load_harness()
+        results['e2e'] = [bench_e2e(harness, n, t, args.requests)
+                          for n in args.e2e_sizes for t in args.threads]
+
+    out = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
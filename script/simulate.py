@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Simulates ProxyPool configurations offline and prints their throughput,
+success rate and latencies as JSON, one result per combination of the given
+parameter values.
+
+The simulated proxies are either a synthetic population, or replayed from a
+trace recorded by a pool with trace=TraceRecorder(path).
+
+Example: script/simulate.py --trace pool.trace --max-proxy-failrate 0.05,0.1,0.2 \\
+             --connection-retries 10,30 --default-timeout 2,5
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import proxypool  # noqa: E402
+from proxypool.simulation import synthetic_proxies, trace_proxies  # noqa: E402
+
+
+def float_list(s):
+    return [float(x) for x in s.split(',') if x]
+
+
+def int_list(s):
+    return [int(x) for x in s.split(',') if x]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trace', help='Replay the proxies of a trace file')
+    parser.add_argument('--proxies', type=int, default=1000,
+                        help='Number of synthetic proxies, without --trace')
+    parser.add_argument('--requests', type=int, default=1000000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-proxy-failrate', type=float_list, default=[0.1])
+    parser.add_argument('--connection-retries', type=int_list, default=[30])
+    parser.add_argument('--default-timeout', type=float_list, default=[5.0])
+    parser.add_argument('--output', help='Write results to a file instead of stdout')
+    args = parser.parse_args()
+
+    hosts = None
+    if args.trace:
+        proxies, hosts = trace_proxies(proxypool.read_trace(args.trace))
+    else:
+        proxies = synthetic_proxies(args.proxies, seed=args.seed)
+    sim = proxypool.Simulator(proxies, hosts=hosts, concurrency=args.concurrency,
+                              seed=args.seed)
+
+    results = []
+    for failrate, retries, timeout in itertools.product(
+            args.max_proxy_failrate, args.connection_retries, args.default_timeout):
+        config = {'max_proxy_failrate': failrate, 'connection_retries': retries,
+                  'default_timeout': timeout}
+        result = sim.run(args.requests, **config)
+        result['config'] = config
+        results.append(result)
+
+    out = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
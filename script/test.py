@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 import logging
 
+import requests
+
 import proxypool
 
 logging.basicConfig(level=logging.DEBUG)
@@ -24,14 +26,11 @@ urls = [
 ]
 
 
-def print_result(response):
-    print("%s gave response %s" %
-          (response.request.url, response.text))
-
-
-tp = proxypool.ThreadPool(3)
-tp.map(pp.get, [((url,), {'headers': headers})
-                for url in urls], result_handler=print_result)
-tp.wait()
+for request, response in pp.get_many([requests.Request('GET', url, headers=headers)
+                                     for url in urls], concurrency=3):
+    if isinstance(response, Exception):
+        print("%s failed: %s" % (request.url, response))
+    else:
+        print("%s gave response %s" % (request.url, response.text))
 
 print(pp)
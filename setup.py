@@ -10,4 +10,5 @@ setup(name='Proxypool',
       description='A drop-in proxy wrapper for the Requests API',
       author='Simon Tegelid',
       author_email='simon@tegelid.se',
-      packages=['proxypool'])
+      packages=['proxypool'],
+      extras_require={'async': ['aiohttp']})
@@ -1,6 +1,11 @@
 #!/usr/bin/env python
+import os
+import re
+import shutil
+import tempfile
 import unittest
 import threading
+import time
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from collections import Counter
 import sys
@@ -107,6 +112,103 @@ class HTTPProxyRequestHandler(MyBaseHTTPRequestHandler):
                 self.wfile.write(resp.content)
 
 
+class RangeRequestHandler(MyBaseHTTPRequestHandler):
+    """
+    Serves a large body with an ETag, supporting Range requests
+    """
+    body = bytes(bytearray(range(256))) * 1024
+    ranges = []
+
+    def do_GET(self):
+        start = 0
+        rng = self.headers.get('Range')
+        RangeRequestHandler.ranges.append(rng)
+        if rng and self.headers.get('If-Range', '"v1"') == '"v1"':
+            start = int(rng.split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(self.body) - 1, len(self.body)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(self.body) - start))
+        self.end_headers()
+        self.wfile.write(self.body[start:])
+
+
+class TruncatingProxyRequestHandler(MyBaseHTTPRequestHandler):
+    """
+    Proxy dropping the connection halfway through the first response body
+    """
+    truncated = []
+
+    def do_GET(self):
+        resp = requests.get(self.path, headers=self.headers)
+        self.send_response(resp.status_code)
+        for k, v in list(resp.headers.items()):
+            self.send_header(k, v)
+        self.end_headers()
+        if not TruncatingProxyRequestHandler.truncated:
+            TruncatingProxyRequestHandler.truncated.append(len(resp.content) // 2)
+            self.wfile.write(resp.content[:len(resp.content) // 2])
+        else:
+            self.wfile.write(resp.content)
+
+
+class CachingRequestHandler(MyBaseHTTPRequestHandler):
+    """
+    Serves /fresh for a minute, /etag with an ETag to revalidate and /slow
+    after a delay
+    """
+    requests = []
+
+    def do_GET(self):
+        CachingRequestHandler.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.path == '/slow':
+            time.sleep(0.2)
+        if self.path == '/etag' and self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+            return
+        body = ('Got %s' % self.path).encode('utf-8')
+        self.send_response(200)
+        if self.path == '/etag':
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('ETag', '"v1"')
+        else:
+            self.send_header('Cache-Control', 'max-age=60')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ProxyListRequestHandler(MyBaseHTTPRequestHandler):
+    """
+    Serves proxy lists, /etag with an ETag and /page/<n> without validators
+    """
+    requests = []
+
+    def rows(self, n):
+        return ''.join('<tr><td>10.0.%d.%d</td><td>80%02d</td></tr>\n' % (n, i, i)
+                       for i in range(50))
+
+    def do_GET(self):
+        ProxyListRequestHandler.requests.append(self.path)
+        if self.path == '/etag' and self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = self.rows(int(self.path.split('/')[-1]) if '/page/' in self.path else 0)
+        self.send_response(200)
+        if self.path == '/etag':
+            self.send_header('ETag', '"v1"')
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+
 class TestBase(unittest.TestCase):
     def setUp(self):
         self.servers = []
@@ -189,17 +291,219 @@ class ProxyPoolTests(TestBase):
             def update(self):
                 return set(['http://localhost:%d' % (9000 + i) for i in range(10)])
 
-        num_calls = 1000
+        num_calls = 500
+
+        for policy in [proxypool.InverseLatency(), proxypool.PowerOfTwoChoices(),
+                       proxypool.ThompsonSampling()]:
+            call_stats.clear()
+            pp = proxypool.ProxyPool(providers=[TestProvider()], policy=policy)
+
+            for i in range(num_calls):
+                pp.get('http://localhost:8000')
+
+            self.assertEqual(
+                call_stats['HTTPRequestHandler.do_GET.8000'], num_calls)
+            fastest = call_stats['HTTPProxyRequestHandler.do_GET.9000']
+            slowest = call_stats['HTTPProxyRequestHandler.do_GET.9009']
+            self.assertTrue(fastest > slowest, "%s: %d calls through the fastest proxy, %d through the slowest. "
+                            "Stochastic functions involved, so might fail occasionally..." %
+                            (policy.__class__.__name__, fastest, slowest))
+
+    def test_deadline(self):
+        self.spawn_servers([(8000, 0.0, 200, True)],
+                           [(9000, 2.0, 200, True)])
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:9000'])
 
         pp = proxypool.ProxyPool(providers=[TestProvider()])
+        t0 = time.time()
+        self.assertRaises(Exception, pp.get, 'http://localhost:8000', deadline=0.5)
+        self.assertLess(time.time() - t0, 1.5)
 
-        for i in range(num_calls):
+        # Not waiting for a proxy cooling down past the deadline either
+        pp.cooldown(pp.proxies[0], 'localhost:8000', 3.0)
+        t0 = time.time()
+        self.assertRaises(Exception, pp.get, 'http://localhost:8000', deadline=0.5)
+        self.assertLess(time.time() - t0, 0.5)
+
+    def test_host_recovers(self):
+        self.spawn_servers([(8000, 0.0, 200, True)],
+                           [(9000, 0.0, 200, True), (9001, 0.0, 200, True)])
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:9000', 'http://localhost:9001'])
+
+        pp = proxypool.ProxyPool(providers=[TestProvider()])
+        pp.refresh()
+        # Transient failures exclude every proxy for the host
+        for p in pp.proxies:
+            for _ in range(20):
+                p.increase_successes()
+            p.increase_failures('localhost:8000')
+            self.assertEqual(p.acceptance('localhost:8000'), 0.0)
+        r = pp.get('http://localhost:8000')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(sum(p.hosts['localhost:8000'].successes for p in pp.proxies), 1)
+
+    def test_stream_resumes(self):
+        for port, handler_class in [(8000, RangeRequestHandler),
+                                    (9000, TruncatingProxyRequestHandler),
+                                    (9001, HTTPProxyRequestHandler)]:
+            httpd = MyHTTPServer(('', port), handler_class)
+            t = threading.Thread(target=httpd.serve_forever)
+            t.daemon = True
+            t.start()
+            self.servers.append((t, httpd))
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:9000', 'http://localhost:9001'])
+
+        pp = proxypool.ProxyPool(providers=[TestProvider()])
+        pp.refresh()
+        truncating, other = sorted(pp.proxies, key=lambda p: p.url)
+        # Make sure the download starts through the truncating proxy
+        other.set_latency(1000.0)
+        chunks = list(pp.stream('http://localhost:8000', chunk_size=4096))
+        self.assertTrue(max(len(c) for c in chunks) <= 4096)
+        self.assertEqual(b''.join(chunks), RangeRequestHandler.body)
+        # Resumed from the last received byte after the connection broke
+        half = TruncatingProxyRequestHandler.truncated[0]
+        self.assertEqual(RangeRequestHandler.ranges, [None, 'bytes=%d-' % half])
+        # The broken transfer only counts as a failure
+        self.assertEqual((truncating.failures, truncating.successes), (1, 0))
+        self.assertEqual(other.successes, 1)
+
+    def test_cache(self):
+        for port, handler_class in [(8000, CachingRequestHandler),
+                                    (9000, HTTPProxyRequestHandler)]:
+            httpd = MyHTTPServer(('', port), handler_class)
+            t = threading.Thread(target=httpd.serve_forever)
+            t.daemon = True
+            t.start()
+            self.servers.append((t, httpd))
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:9000'])
+
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        cache = proxypool.ResponseCache(path=os.path.join(tmp, 'cache.db'))
+        pp = proxypool.ProxyPool(providers=[TestProvider()], cache=cache)
+        del CachingRequestHandler.requests[:]
+
+        responses = [pp.get('http://localhost:8000/fresh') for _ in range(3)]
+        self.assertEqual([r.text for r in responses], ['Got /fresh'] * 3)
+        self.assertEqual([r.from_cache for r in responses], [False, True, True])
+        self.assertEqual(CachingRequestHandler.requests, [('/fresh', None)])
+
+        # Revalidated on every use
+        del CachingRequestHandler.requests[:]
+        responses = [pp.get('http://localhost:8000/etag') for _ in range(2)]
+        self.assertEqual([r.text for r in responses], ['Got /etag'] * 2)
+        self.assertEqual(CachingRequestHandler.requests, [('/etag', None), ('/etag', '"v1"')])
+        self.assertEqual(cache.revalidations, 1)
+
+        # Identical requests in flight are made once
+        del CachingRequestHandler.requests[:]
+        tp = proxypool.ThreadPool(4)
+        responses = list(tp.imap(pp.get, [(('http://localhost:8000/slow',), {})] * 4))
+        tp.shutdown()
+        self.assertEqual([r.text for r in responses], ['Got /slow'] * 4)
+        self.assertEqual(CachingRequestHandler.requests, [('/slow', None)])
+        self.assertEqual(cache.coalesced, 3)
+
+        # Responses on disk outlive the memory of the pool
+        cache.close()
+        cache = proxypool.ResponseCache(path=os.path.join(tmp, 'cache.db'))
+        pp = proxypool.ProxyPool(providers=[TestProvider()], cache=cache)
+        self.assertTrue(pp.get('http://localhost:8000/fresh').from_cache)
+        cache.close()
+
+    def test_trace(self):
+        self.spawn_servers([(8000, 0.0, 200, True)],
+                           [(9000, 0.0, 200, True), (9001, 0.0, 403, True)])
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:9000', 'http://localhost:9001'])
+
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'pool.trace')
+        trace = proxypool.TraceRecorder(path)
+        pp = proxypool.ProxyPool(providers=[TestProvider()], trace=trace)
+        for _ in range(10):
             pp.get('http://localhost:8000')
+        trace.close()
 
-        self.assertEqual(
-            call_stats['HTTPRequestHandler.do_GET.8000'], num_calls)
-        self.assertTrue(call_stats['HTTPProxyRequestHandler.do_GET.9000']
-                        > call_stats['HTTPProxyRequestHandler.do_GET.9001'], "Stochastic functions involved, so might fail occasionally...")
+        records = list(proxypool.read_trace(path))
+        self.assertEqual(len(records), trace.count)
+        # Strings are written once
+        self.assertEqual(os.path.getsize(path), len(proxypool.trace.MAGIC) + 24 * len(records) +
+                         sum(7 + len(s) for s in trace.ids))
+        successes = [r for r in records if r.outcome == 'success']
+        self.assertEqual(len(successes), 10)
+        self.assertEqual(set((r.proxy, r.host, r.status) for r in successes),
+                         set([('http://localhost:9000', 'localhost:8000', 200)]))
+        self.assertEqual(set((r.proxy, r.status) for r in records if r.outcome != 'success'),
+                         set([('http://localhost:9001', 403)]) if len(records) > 10 else set())
+
+        # Replayed offline, the banned proxy is soon left alone
+        proxies, hosts = proxypool.simulation.trace_proxies(records)
+        result = proxypool.Simulator(proxies, hosts=hosts, concurrency=4, seed=0).run(1000)
+        self.assertEqual(result['success_rate'], 1.0)
+        self.assertLess(result['attempts_per_request'], 1.01)
+
+    def test_get_many(self):
+        self.spawn_servers([(8000, 0.0, 200, True), (8001, 0.0, 200, True)],
+                           [(9000, 0.0, 200, True), (9001, 0.0, 200, True)])
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:9000', 'http://localhost:9001'])
+
+        pp = proxypool.ProxyPool(providers=[TestProvider()])
+        urls = ['http://localhost:8000/%d' % i for i in range(4)] + \
+            ['http://localhost:8001/%d' % i for i in range(2)]
+
+        results = list(pp.get_many(urls, concurrency=3, ordered=True))
+        self.assertEqual([url for url, _ in results], urls)
+        self.assertEqual([r.status_code for _, r in results], [200] * 6)
+
+        # One at a time, the hosts read ahead are interleaved
+        results = list(pp.get_many(urls, concurrency=1, lookahead=6))
+        self.assertEqual([url for url, _ in results],
+                         [urls[0], urls[4], urls[1], urls[5], urls[2], urls[3]])
+
+        # Requests aren't started after the caller stops consuming
+        call_stats.clear()
+        for _ in pp.get_many(urls, concurrency=1):
+            break
+        time.sleep(0.1)
+        self.assertEqual(call_stats['HTTPRequestHandler.do_GET.8000'], 1)
+        self.assertEqual(call_stats['HTTPRequestHandler.do_GET.8001'], 0)
+
+    def test_adaptive_timeouts(self):
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://a:1'])
+
+        pp = proxypool.ProxyPool(providers=[TestProvider()], default_timeout=10.0,
+                                 connect_timeout=3.0)
+        p = pp.get_proxy()
+        self.assertEqual(pp.timeouts(p), (3.0, 10.0))
+        self.assertEqual(pp.timeouts(p, 7.0), (7.0, 7.0))
+        p.set_latency(0.5)
+        self.assertEqual(pp.timeouts(p), (2.0, 2.0))
+        self.assertEqual(pp.timeouts(p, (1.5, 10.0)), (1.5, 2.0))
+        connect, read = pp.timeouts(p, expires=time.time() + 1.0)
+        self.assertTrue(0.9 < connect <= 1.0 and read == connect)
+        self.assertRaises(Exception, pp.timeouts, p, expires=time.time())
 
     def test_proxy_down(self):
         num_calls = 20
@@ -235,6 +539,787 @@ class ProxyPoolTests(TestBase):
             self.assertGreater(
                 call_stats['HTTPProxyRequestHandler.do_GET.%d' % (9000 + i)], 1)
 
+    def test_sessions_evicted_when_down(self):
+        self.spawn_servers([(8000, 0.0, 200, True)],
+                           [(9000, 0.0, 200, True), (9001, 0.0, 200, True)])
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:9000', 'http://localhost:9001'])
+
+        pp = proxypool.ProxyPool(providers=[TestProvider()])
+
+        for i in range(20):
+            pp.get('http://localhost:8000')
+
+        self.assertEqual(len(pp.sessions), 2)
+        pp.proxies[0].set_down()
+        self.assertEqual(list(pp.sessions.sessions), [pp.proxies[1].url])
+        pp.close()
+        self.assertEqual(len(pp.sessions), 0)
+
+    def test_banned_per_host(self):
+        self.spawn_servers([(8000, 0.0, 200, True), (8001, 0.0, 403, True)],
+                           [(9000, 0.0, 200, True), (9001, 0.0, 200, True)])
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:9000', 'http://localhost:9001'])
+
+        pp = proxypool.ProxyPool(providers=[TestProvider()], connection_retries=5)
+
+        self.assertRaises(Exception, pp.get, 'http://localhost:8001')
+        for p in pp.proxies:
+            self.assertTrue(p.hosts['localhost:8001'].down)
+
+        for i in range(10):
+            pp.get('http://localhost:8000')
+        self.assertEqual(pp.good, 2)
+        self.assertEqual(call_stats['HTTPRequestHandler.do_GET.8000'], 10)
+        # Banned proxies get another chance, within connection_retries
+        self.assertEqual(call_stats['HTTPRequestHandler.do_GET.8001'], 6)
+
+    def test_rate_limited_proxy_cools_down(self):
+        self.spawn_servers([(8000, 0.0, 200, True)],
+                           [(9000, 0.0, 429, True), (9001, 0.0, 200, True)])
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:9000', 'http://localhost:9001'])
+
+        pp = proxypool.ProxyPool(providers=[TestProvider()])
+
+        for i in range(20):
+            pp.get('http://localhost:8000')
+
+        self.assertEqual(
+            call_stats['HTTPRequestHandler.do_GET.8000'], 20)
+        self.assertLessEqual(
+            call_stats['HTTPProxyRequestHandler.do_GET.9000'], 1)
+        self.assertEqual(len(pp.cooldowns),
+                         call_stats['HTTPProxyRequestHandler.do_GET.9000'])
+
+    def test_rate_limiter_paces_host(self):
+        self.spawn_servers([(8000, 0.0, 200, True), (8001, 0.0, 200, True)],
+                           [(9000, 0.0, 200, True), (9001, 0.0, 200, True)])
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:9000', 'http://localhost:9001'])
+
+        limiter = proxypool.RateLimiter(rates={'localhost:8000': 20.0})
+        pp = proxypool.ProxyPool(providers=[TestProvider()], rate_limiter=limiter)
+        urls = ['http://localhost:8000/%d' % i for i in range(5)] + \
+            ['http://localhost:8001/%d' % i for i in range(20)]
+
+        t0 = time.time()
+        results = list(pp.get_many(urls, concurrency=4))
+        self.assertGreaterEqual(time.time() - t0, 0.2)
+        self.assertEqual(sorted(r.status_code for _, r in results), [200] * 25)
+        # The unlimited host isn't held back by the limited one
+        self.assertEqual([url for url, _ in results][-1], urls[4])
+
+        # Requests queued by others take the request past its deadline
+        for _ in range(3):
+            limiter.reserve('localhost:8000')
+        with self.assertRaises(Exception):
+            pp.get('http://localhost:8000', deadline=0.1)
+
+    def test_metrics(self):
+        self.spawn_servers([(8000, 0.0, 200, True)],
+                           [(9000, 0.0, 200, True), (5000, 0.0, None, True)])
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:9000', 'http://localhost:5000'])
+
+        metrics = proxypool.Metrics()
+        failed = []
+        metrics.add_hook('failure', lambda event, proxy, host, error: failed.append(proxy.url))
+        pp = proxypool.ProxyPool(providers=[TestProvider()], metrics=metrics)
+        for i in range(10):
+            pp.get('http://localhost:8000')
+
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['proxypool_successes_total'], 10)
+        self.assertEqual(counters['proxypool_responses_total{code="200"}'], 10)
+        self.assertEqual(counters['proxypool_attempts_total'], 10 + len(failed))
+        self.assertEqual(counters['proxypool_refreshes_total'], 1)
+        self.assertEqual(set(failed), set(['http://localhost:5000']) if failed else set())
+
+        text = metrics.to_prometheus()
+        self.assertIn('proxypool_successes_total 10\n', text)
+        self.assertIn('proxypool_request_latency_seconds_count 10\n', text)
+        # One extra sample from before the initial refresh
+        self.assertIn('proxypool_lock_hold_seconds_bucket{le="+Inf"} %d\n' %
+                      (counters['proxypool_attempts_total'] + 1), text)
+
+    def test_hedging(self):
+        self.spawn_servers([(8000, 0.0, 200, True)],
+                           [(9000, 1.0, 200, True), (9001, 0.0, 200, True)])
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:9000', 'http://localhost:9001'])
+
+        pp = proxypool.ProxyPool(providers=[TestProvider()], max_hedge_ratio=1.0,
+                                 min_timeout=0.3)
+        pp.refresh()
+        for p in pp.proxies:
+            # Make the slow proxy look fast, so that it is sampled first
+            p.set_latency(0.000001 if p.url.endswith('9000') else 0.01)
+        slow, fast = sorted(pp.proxies, key=lambda p: p.url)
+
+        # The response of the hedge is used once the slow proxy times out,
+        # without another attempt
+        t0 = time.time()
+        r = pp.get('http://localhost:8000')
+        self.assertLess(time.time() - t0, 0.9)
+        self.assertTrue(r.text.endswith("Got GET"))
+        self.assertEqual(pp.hedges, 1)
+        self.assertEqual((slow.failures, fast.successes), (1, 1))
+        self.assertEqual([p.in_flight for p in pp.proxies], [0, 0])
+        pp.close()
+
+    def test_validation(self):
+        self.spawn_servers([(8000, 0.0, 200, True)],
+                           [(9000, 0.05, 200, True), (9001, 0.0, 200, True),
+                            (5000, 0.0, None, True), (5001, 0.0, 403, True)])
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:%d' % port for port in [9000, 9001, 5000, 5001]])
+
+        validator = proxypool.ProxyValidator(
+            probe_url='http://localhost:8000', timeout=1.0, parallelism=4)
+        pp = proxypool.ProxyPool(providers=[TestProvider()], validator=validator)
+        pp.refresh()
+
+        self.assertEqual(sorted(p.url for p in pp.proxies),
+                         ['http://localhost:9000', 'http://localhost:9001'])
+        latency = dict((p.url, p.t) for p in pp.proxies)
+        self.assertGreaterEqual(latency['http://localhost:9000'], 0.05)
+        self.assertGreater(latency['http://localhost:9000'],
+                           latency['http://localhost:9001'])
+        for port in [9000, 9001, 5000, 5001]:
+            self.assertEqual(
+                call_stats['HTTPProxyRequestHandler.do_GET.%d' % port], 1)
+
+
+@unittest.skipIf(proxypool.asyncpool.aiohttp is None, "aiohttp not installed")
+class AsyncProxyPoolTests(TestBase):
+    def test_proxy_down(self):
+        import asyncio
+
+        self.spawn_servers([(8000, 0.0, 200, True)],
+                           [(9000, 0.0, 200, True), (9001, 0.0, 200, True),
+                            (5000, 0.0, None, True)])
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:9000', 'http://localhost:9001',
+                            'http://localhost:5000'])
+
+        async def run():
+            async with proxypool.AsyncProxyPool(providers=[TestProvider()],
+                                                max_requests=4, max_concurrency=2) as pp:
+                rs = await pp.gather(['http://localhost:8000'] * 10)
+                self.assertEqual(pp.max_requests, 4)
+                self.assertEqual([p.max_concurrency for p in pp.proxies], [2, 2, 2])
+                self.assertTrue(all(r.status == 200 for r in rs))
+                results = [r async for r in pp.as_completed(['http://localhost:8000'] * 10)]
+                self.assertEqual(len(results), 10)
+                self.assertTrue(all(r.status == 200 for _, r in results))
+                return pp
+
+        pp = asyncio.run(run())
+
+        self.assertEqual(call_stats['HTTPRequestHandler.do_GET.8000'], 20)
+        bad = [p for p in pp.proxies if p.url == 'http://localhost:5000'][0]
+        # Concurrent requests may pick the bad proxy before its first failure
+        self.assertLessEqual(bad.failures, 4)
+        self.assertEqual(bad.successes, 0)
+
+    def test_deadline(self):
+        import asyncio
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:9000'])
+
+        async def run():
+            async with proxypool.AsyncProxyPool(providers=[TestProvider()]) as pp:
+                await pp.refresh()
+                pp.cooldown(pp.proxies[0], 'localhost:8000', 3.0)
+                t0 = time.time()
+                with self.assertRaises(Exception):
+                    await pp.get('http://localhost:8000', deadline=0.5)
+                self.assertLess(time.time() - t0, 0.5)
+
+        asyncio.run(run())
+
+    def test_unsupported(self):
+        pp = proxypool.AsyncProxyPool(providers=[])
+        self.assertRaises(NotImplementedError, pp.get_many, ['http://localhost:8000'])
+        self.assertRaises(NotImplementedError, pp.stream, 'http://localhost:8000')
+
+
+class PoolServerTests(TestBase):
+    def test_client(self):
+        self.spawn_servers([(8000, 0.0, 200, True)],
+                           [(9000, 0.0, 200, True), (9001, 0.0, 403, True)])
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:9000', 'http://localhost:9001'])
+
+        path = os.path.join(tempfile.mkdtemp(), 'pool.sock')
+        pp = proxypool.ProxyPool(providers=[TestProvider()])
+        server = proxypool.PoolServer(pp, path)
+        server.start()
+        try:
+            client = proxypool.PoolClient(path, lease_batch=4)
+            for _ in range(10):
+                r = client.get('http://localhost:8000')
+                self.assertEqual(r.status_code, 200)
+            self.assertEqual(len(client), 2)
+            client.close()
+        finally:
+            server.close()
+
+        self.assertEqual(pp.provider_updates, 1)
+        good, banned = sorted(pp.proxies, key=lambda p: p.url)
+        self.assertEqual(good.successes, 10)
+        self.assertTrue(banned.hosts['localhost:8000'].down)
+        self.assertEqual((good.in_flight, banned.in_flight), (0, 0))
+
+    def test_max_concurrency(self):
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://a:1', 'http://b:1'])
+
+        path = os.path.join(tempfile.mkdtemp(), 'pool.sock')
+        pp = proxypool.ProxyPool(providers=[TestProvider()], max_concurrency=1)
+        server = proxypool.PoolServer(pp, path)
+        server.start()
+        try:
+            client = proxypool.PoolClient(path, lease_batch=4)
+            # Batches larger than the capacity of the pool are partial
+            p = client.get_proxy('a', lease=True)
+            self.assertEqual([p.in_flight for p in pp.proxies], [1, 1])
+            # Unused leases for other hosts are given back
+            q = client.get_proxy('b', lease=True)
+            self.assertNotEqual(p.url, q.url)
+            self.assertRaises(Exception, client.get_proxy, 'c', lease=True, timeout=0.2)
+            q.release()
+            self.assertEqual(client.get_proxy('c', lease=True, timeout=5.0).url, q.url)
+            client.close()
+        finally:
+            server.close()
+
+    def test_leases_released(self):
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://a:1'])
+
+        path = os.path.join(tempfile.mkdtemp(), 'pool.sock')
+        pp = proxypool.ProxyPool(providers=[TestProvider()], max_concurrency=1)
+        server = proxypool.PoolServer(pp, path)
+        server.start()
+        try:
+            a = proxypool.PoolClient(path, report_interval=0.1)
+            b = proxypool.PoolClient(path, report_interval=0.1)
+            # Sampling without a lease doesn't count as in flight
+            a.get_proxy()
+            self.assertEqual(pp.proxies[0].in_flight, 0)
+            # Releases of an idle client reach the server
+            a.get_proxy(lease=True).release()
+            b.get_proxy(lease=True, timeout=5.0)
+            self.assertEqual(pp.proxies[0].in_flight, 1)
+            # Leases of a client gone without releasing them are released
+            b.closed.set()
+            b.flusher.join()
+            b.local.conn[0].close()
+            b.local.conn[1].close()
+            a.get_proxy(lease=True, timeout=5.0).release()
+            a.close()
+            for _ in range(100):
+                if pp.proxies[0].in_flight == 0:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(pp.proxies[0].in_flight, 0)
+        finally:
+            server.close()
+
+
+class ConcurrencyTests(unittest.TestCase):
+    def test_reports_dont_wait_for_sampling(self):
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://a:1', 'http://b:1'])
+
+        pp = proxypool.ProxyPool(providers=[TestProvider()])
+        p = pp.get_proxy()
+        with pp.lock:
+            # Reporting outcomes must not need the pool lock held by samplers
+            t = threading.Thread(target=lambda: [p.increase_failures() for _ in range(3)])
+            t.start()
+            t.join(5.0)
+            self.assertFalse(t.is_alive())
+        self.assertEqual(p.failures, 3)
+        self.assertEqual(pp.good, 1)
+        for _ in range(20):
+            self.assertIsNot(pp.get_proxy(), p)
+
+
+class LeaseTests(unittest.TestCase):
+    def test_max_concurrency(self):
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://a:1', 'http://b:1'])
+
+        pp = proxypool.ProxyPool(providers=[TestProvider()], max_concurrency=1)
+        a = pp.get_proxy(lease=True)
+        b = pp.get_proxy(lease=True)
+        self.assertIsNot(a, b)
+        self.assertEqual((a.in_flight, b.in_flight), (1, 1))
+        self.assertRaises(Exception, pp.get_proxy, lease=True, timeout=0.1)
+
+        t = threading.Timer(0.1, b.release)
+        t.start()
+        self.assertIs(pp.get_proxy(lease=True, timeout=5.0), b)
+        t.join()
+
+        # Per proxy limits override the default of the pool
+        a.max_concurrency = 2
+        self.assertIs(pp.get_proxy(lease=True, timeout=0.1), a)
+
+
+class RehabilitationTests(TestBase):
+    def test_failrate_decays(self):
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://a:1', 'http://b:1'])
+
+        pp = proxypool.ProxyPool(providers=[TestProvider()], failure_half_life=0.05)
+        p = pp.get_proxy()
+        p.increase_failures()
+        self.assertEqual(pp.good, 1)
+        time.sleep(0.25)
+        # Reconsidered by sampling, without waiting for a re-probe
+        self.assertEqual(set(pp.get_proxy() for _ in range(50)), set(pp.proxies))
+        self.assertEqual(pp.good, 2)
+
+    def test_down_proxy_reprobed(self):
+        self.spawn_servers([(8000, 0.0, 200, True)],
+                           [(9000, 0.0, 200, True), (9001, 0.0, 200, True)])
+
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://localhost:9000', 'http://localhost:9001'])
+
+        validator = proxypool.ProxyValidator(probe_url='http://localhost:8000', timeout=1.0)
+        pp = proxypool.ProxyPool(providers=[TestProvider()], validator=validator,
+                                 reprobe_interval=0.05)
+        pp.get_proxy().set_down()
+        self.assertEqual(pp.good, 1)
+        for _ in range(100):
+            if pp.good == 2:
+                break
+            time.sleep(0.01)
+        pp.close()
+        self.assertEqual(pp.good, 2)
+
+
+class ReputationTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'reputation.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_warm_start(self):
+        class TestProvider(proxypool.ProxyProvider):
+            def update(self):
+                return set(['http://a:1', 'http://b:1', 'http://c:1'])
+
+        store = proxypool.ReputationStore(self.path)
+        pp = proxypool.ProxyPool(providers=[TestProvider()], reputation=store)
+        pp.refresh()
+        a, b, c = sorted(pp.proxies, key=lambda p: p.url)
+        a.set_latency(0.5, 'example.com')
+        a.increase_successes('example.com')
+        b.set_down()
+        pp.cooldown(c, 'example.com', 60.0)
+        pp.close()
+        store.close()
+
+        store = proxypool.ReputationStore(self.path)
+        pp = proxypool.ProxyPool(providers=[TestProvider()], reputation=store)
+        pp.refresh()
+        a, b, c = sorted(pp.proxies, key=lambda p: p.url)
+        self.assertEqual((a.t, a.successes, a.latency_quantile(0.5)), (0.5, 1, 0.5))
+        self.assertEqual(a.hosts['example.com'].t, 0.5)
+        self.assertTrue(b.down)
+        self.assertEqual(pp.good, 2)
+        for _ in range(20):
+            self.assertIs(pp.get_proxy('example.com'), a)
+        store.close()
+
+    def test_stale_entries_dropped(self):
+        store = proxypool.ReputationStore(self.path, max_age=10.0)
+        stats = proxypool.stats.StatsStore(1)
+        stats.add_latency(0, 0.5, 0.3)
+        entry = {'url': 'http://a:1', 'stats': stats.record(0), 'hosts': {},
+                 'cooldowns': {'example.com': (105.0, 2)}}
+        store.save([entry], now=100.0)
+        self.assertEqual(store.load(['http://a:1'], now=101.0)['http://a:1']['cooldowns'],
+                         {'example.com': (105.0, 2)})
+        self.assertEqual(store.load(['http://a:1'], now=106.0)['http://a:1']['cooldowns'], {})
+        self.assertEqual(store.load(['http://a:1'], now=111.0), {})
+        store.close()
+
+
+class ProviderTests(TestBase):
+    class ListProvider(proxypool.ScrapingProvider):
+        pattern = re.compile(r"<tr><td>(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})</td><td>(\d+)</td>")
+        # Small chunks, so that matches are cut by chunk boundaries
+        chunk_size = 7
+        overlap = 64
+
+        def __init__(self, paths):
+            proxypool.ScrapingProvider.__init__(self)
+            self.paths = paths
+
+        def pages(self):
+            return [('GET', 'http://localhost:8000' + path, None) for path in self.paths]
+
+        def proxy(self, m):
+            return 'http://%s:%s' % (m.group(1), m.group(2))
+
+    def setUp(self):
+        TestBase.setUp(self)
+        httpd = MyHTTPServer(('', 8000), ProxyListRequestHandler)
+        t = threading.Thread(target=httpd.serve_forever)
+        t.daemon = True
+        t.start()
+        self.servers.append((t, httpd))
+        del ProxyListRequestHandler.requests[:]
+
+    def test_streaming_parse(self):
+        pr = ProviderTests.ListProvider(['/page/1', '/page/2', '/page/3'])
+        proxies = pr.update()
+        self.assertEqual(len(proxies), 150)
+        self.assertIn('http://10.0.2.49:8049', proxies)
+        self.assertEqual(pr.stats.pages, 3)
+        self.assertEqual(pr.stats.proxies, 150)
+        self.assertGreater(pr.stats.parse_time, 0)
+
+    def test_unchanged_lists(self):
+        pr = ProviderTests.ListProvider(['/etag', '/page/1'])
+        first = pr.update()
+        self.assertEqual(pr.update(), first)
+        self.assertEqual(pr.stats.not_modified, 1)
+        self.assertEqual(pr.stats.unchanged, 1)
+        self.assertEqual(pr.stats.parse_time, 0)
+
+    def test_dedupe_across_providers(self):
+        class TestProvider(proxypool.ProxyProvider):
+            def __init__(self, urls):
+                self.urls = urls
+
+            def update(self):
+                return set(self.urls)
+
+        pp = proxypool.ProxyPool(providers=[
+            TestProvider(['http://10.0.0.1:80', 'socks5://10.0.0.2:1080']),
+            TestProvider(['HTTP://010.0.0.1:080/', 'http://10.0.0.3:80'])])
+        pp.refresh()
+        self.assertEqual(sorted(p.url for p in pp.proxies),
+                         ['http://10.0.0.1:80', 'http://10.0.0.3:80', 'socks5://10.0.0.2:1080'])
+
+
+class RefreshTests(unittest.TestCase):
+    class TestProvider(proxypool.ProxyProvider):
+        def __init__(self, *urls):
+            self.urls = set(urls)
+
+        def update(self):
+            return set(self.urls)
+
+    def test_refresh_keeps_metrics(self):
+        provider = self.TestProvider('http://a:1', 'http://b:1')
+        pp = proxypool.ProxyPool(providers=[provider, self.TestProvider('http://b:1')])
+        pp.refresh()
+        self.assertEqual(len(pp), 2)
+        a = [p for p in pp.proxies if p.url == 'http://a:1'][0]
+        a.set_latency(0.5)
+        a.increase_successes()
+
+        provider.urls = set(['http://a:1', 'http://c:1'])
+        pp.refresh()
+        self.assertEqual(sorted(p.url for p in pp.proxies),
+                         ['http://a:1', 'http://b:1', 'http://c:1'])
+        self.assertIn(a, pp.proxies)
+        self.assertEqual((a.t, a.successes), (0.5, 1))
+
+    def test_refresh_below_watermark(self):
+        provider = self.TestProvider('http://a:1', 'http://b:1')
+        pp = proxypool.ProxyPool(providers=[provider], refresh_watermark=2,
+                                 min_refresh_interval=0)
+        p = pp.get_proxy()
+        self.assertEqual(pp.provider_updates, 1)
+        p.set_down()
+        provider.urls.add('http://c:1')
+        pp.get_proxy()
+        for _ in range(100):
+            if pp.provider_updates > 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(pp.provider_updates, 2)
+        self.assertEqual(pp.good, 2)
+
+
+class CooldownTests(unittest.TestCase):
+    def test_parse_retry_after(self):
+        parse = proxypool.cooldown.parse_retry_after
+        self.assertEqual(parse('120'), 120)
+        self.assertEqual(parse('Wed, 21 Oct 2015 07:28:00 GMT', now=1445412420), 60)
+        self.assertIsNone(parse('soon'))
+        self.assertIsNone(parse(None))
+
+    def test_exponential_backoff(self):
+        now = [0.0]
+        cd = proxypool.cooldown.CooldownScheduler(
+            base_delay=1.0, max_delay=5.0, clock=lambda: now[0])
+        self.assertEqual([cd.penalize('k') for _ in range(5)], [1, 2, 4, 5, 5])
+        self.assertTrue(cd.cooling('k'))
+        now[0] = 5.0
+        cd.expire()
+        self.assertFalse(cd.cooling('k'))
+        self.assertEqual(len(cd), 0)
+        cd.reset('k')
+        self.assertEqual(cd.penalize('k'), 1)
+
+
+class RateLimiterTests(unittest.TestCase):
+    def test_reservations(self):
+        now = [0.0]
+        rl = proxypool.RateLimiter(rates={'a': 2.0}, burst=2, clock=lambda: now[0])
+        self.assertEqual([rl.reserve('a') for _ in range(4)], [0, 0, 0.5, 1.0])
+        self.assertEqual(rl.reserve('b'), 0)
+        rl.cancel('a')
+        self.assertEqual(rl.delay('a'), 1.0)
+        now[0] = 1.0
+        self.assertEqual(rl.delay('a'), 0)
+
+    def test_proxy_rates(self):
+        now = [0.0]
+        rl = proxypool.RateLimiter(proxy_default_rate=1.0, clock=lambda: now[0])
+        self.assertTrue(rl.proxy_ready('p', 'a'))
+        rl.take('p', 'a')
+        self.assertFalse(rl.proxy_ready('p', 'a'))
+        self.assertTrue(rl.proxy_ready('p', 'b'))
+        self.assertEqual(rl.next_ready('a'), 1.0)
+        now[0] = 1.0
+        self.assertTrue(rl.proxy_ready('p', 'a'))
+
+    def test_auto_tune(self):
+        now = [0.0]
+        rl = proxypool.RateLimiter(rates={'a': 10.0}, auto_tune=True, probe_after=3,
+                                   probe_step=0.1, clock=lambda: now[0])
+        rl.on_rate_limited('a')
+        # Rate limits of requests sent at the old rate don't count
+        rl.on_rate_limited('a')
+        self.assertEqual(rl.rate('a'), 5.0)
+        now[0] = 1.0
+        rl.on_rate_limited('a')
+        self.assertEqual(rl.rate('a'), 2.5)
+        for _ in range(6):
+            rl.on_success('a')
+        self.assertAlmostEqual(rl.rate('a'), 4.5)
+        self.assertIsNone(rl.rate('b'))
+
+
+class CacheTests(unittest.TestCase):
+    def send(self, kwargs, cache_control='max-age=60', body=b'x' * 100):
+        self.sent.append(kwargs)
+        r = requests.Response()
+        r.status_code = 200
+        r.headers['Cache-Control'] = cache_control
+        r._content = body
+        return r
+
+    def setUp(self):
+        self.sent = []
+
+    def test_freshness(self):
+        freshness = proxypool.cache._freshness
+        self.assertEqual(freshness({'Cache-Control': 'public, max-age=60'}, 0), 60)
+        self.assertEqual(freshness({'Cache-Control': 'max-age=60', 'Age': '50'}, 0), 10)
+        self.assertEqual(freshness({'Cache-Control': 'no-cache, max-age=60'}, 0), 0)
+        self.assertIsNone(freshness({'Cache-Control': 'no-store'}, 0))
+        self.assertEqual(freshness({'Expires': 'Wed, 21 Oct 2015 07:29:00 GMT',
+                                    'Date': 'Wed, 21 Oct 2015 07:28:00 GMT'}, 0), 60)
+        self.assertEqual(freshness({}, 0), 0)
+
+    def test_eviction(self):
+        cache = proxypool.ResponseCache(max_bytes=400)
+        for url in ['http://a/1', 'http://a/2', 'http://a/3', 'http://a/1', 'http://a/4']:
+            cache.request('GET', url, {}, self.send)
+        # Above 3 responses the least recently used one is evicted
+        self.assertEqual(len(self.sent), 4)
+        self.assertEqual(len(cache), 3)
+        cache.request('GET', 'http://a/2', {}, self.send)
+        self.assertEqual(len(self.sent), 5)
+
+        cache.request('GET', 'http://a/5', {}, lambda kw: self.send(kw, 'no-store'))
+        cache.request('GET', 'http://a/5', {}, lambda kw: self.send(kw, 'no-store'))
+        cache.request('GET', 'http://a/1', {'stream': True}, self.send)
+        self.assertEqual(len(self.sent), 8)
+
+    def test_credentials(self):
+        cache = proxypool.ResponseCache()
+        # Responses to requests with credentials aren't served to others
+        cache.request('GET', 'http://a/1', {'auth': ('u', 'p')}, self.send)
+        cache.request('GET', 'http://a/1', {'cookies': {'session': 'x'}}, self.send)
+        self.assertEqual(len(cache), 0)
+        auth = {'headers': {'Authorization': 'Basic dTpw'}}
+        cache.request('GET', 'http://a/1', auth, self.send)
+        cache.request('GET', 'http://a/1', {'headers': {'Cookie': 'session=x'}}, self.send)
+        cache.request('GET', 'http://a/1', {'headers': {'Proxy-Authorization': 'Basic dTpw'}},
+                      self.send)
+        self.assertEqual(len(cache), 0)
+        cache.request('GET', 'http://a/1', {}, self.send)
+        self.assertEqual(len(self.sent), 6)
+        # unless they are public
+        cache.request('GET', 'http://a/2', auth, lambda kw: self.send(kw, 'public, max-age=60'))
+        self.assertTrue(cache.request('GET', 'http://a/2', {}, self.send).from_cache)
+        self.assertEqual(len(self.sent), 7)
+
+    def test_redirects(self):
+        cache = proxypool.ResponseCache()
+        cache.request('GET', 'http://a/1', {}, self.send)
+        r = cache.request('GET', 'http://a/1', {'allow_redirects': False}, self.send)
+        self.assertFalse(r.from_cache)
+        self.assertTrue(cache.request('GET', 'http://a/1', {}, self.send).from_cache)
+        self.assertTrue(cache.request('GET', 'http://a/1', {'allow_redirects': False},
+                                      self.send).from_cache)
+        self.assertEqual(len(self.sent), 2)
+
+
+class SimulatorTests(unittest.TestCase):
+    def test_synthetic_population(self):
+        proxies = proxypool.simulation.synthetic_proxies(200, seed=0)
+        sim = proxypool.Simulator(proxies, concurrency=16, seed=0)
+        result = sim.run(5000)
+        self.assertEqual(result['requests'], 5000)
+        self.assertGreater(result['success_rate'], 0.99)
+        self.assertLess(result['p50'], result['p99'])
+        # Same seed, same simulation
+        self.assertEqual(sim.run(5000)['virtual_time'], result['virtual_time'])
+        # Tighter timeouts give up on slow proxies sooner
+        self.assertLess(sim.run(5000, default_timeout=1.0)['p99'], result['p99'])
+
+
+class StatsTests(unittest.TestCase):
+    def test_latency_window(self):
+        w = proxypool.stats.LatencyWindow(size=10)
+        self.assertIsNone(w.quantile(0.5))
+        for t in range(100):
+            w.add(float(t))
+        self.assertEqual(len(w), 10)
+        self.assertEqual(w.quantile(0.0), 90)
+        self.assertEqual(w.quantile(0.5), 95)
+        self.assertEqual(w.quantile(1.0), 99)
+
+    def test_decaying_rate(self):
+        s = proxypool.stats.StatsStore(1)
+        self.assertEqual(s.failrate(0, 0.0, 10.0), 0)
+        s.add_outcome(0, True, 0.0, 10.0)
+        self.assertAlmostEqual(s.failrate(0, 0.0, 10.0), 0.5)
+        self.assertAlmostEqual(s.failrate(0, 10.0, 10.0), 0.5 / 1.5)
+        s.add_outcome(0, False, 10.0, 10.0)
+        self.assertAlmostEqual(s.failrate(0, 10.0, 10.0), 0.5 / 2.5)
+        self.assertEqual((s.successes[0], s.failures[0]), (1, 1))
+
+    def test_store_weights(self):
+        s = proxypool.stats.StatsStore(3)
+        for i, t in enumerate([0.5, 1.0, 2.0]):
+            s.add_latency(i, t, 0.3)
+        s.down[1] = 1
+        s.add_outcome(2, True, 0.0, 10.0)
+        self.assertEqual(s.weights(0.1, 0.0, 10.0), [2.0, 0.0, 0.0])
+        self.assertEqual(s.weights(0.9, 0.0, 10.0), [2.0, 0.0, 0.5])
+
+        other = proxypool.stats.StatsStore(1)
+        other.copy_row(0, s, 0)
+        self.assertEqual((other.t[0], other.latency_quantile(0, 0.5)), (0.5, 0.5))
+
+
+class ThreadPoolTests(unittest.TestCase):
+    def test_futures(self):
+        def div(a, b):
+            return a / b
+
+        with proxypool.ThreadPool(2) as tp:
+            handled = []
+            futures = tp.map(div, [((4, 2), {}), ((1, 0), {})],
+                             result_handler=handled.append)
+            self.assertEqual(futures[0].result(), 2)
+            self.assertRaises(ZeroDivisionError, futures[1].result)
+            self.assertEqual(handled, [2])
+
+    def test_imap(self):
+        def slow_square(x):
+            time.sleep(0.001 * (x % 3))
+            return x * x
+
+        with proxypool.ThreadPool(4, queue_size=2) as tp:
+            args_list = [((x,), {}) for x in range(100)]
+            self.assertEqual(list(tp.imap(slow_square, args_list)),
+                             [x * x for x in range(100)])
+            self.assertEqual(sorted(tp.imap_unordered(slow_square, args_list)),
+                             [x * x for x in range(100)])
+
+    def test_backpressure(self):
+        consumed = []
+
+        def args_list():
+            for x in range(1000):
+                consumed.append(x)
+                yield (x,), {}
+
+        tp = proxypool.ThreadPool(2, queue_size=2)
+        results = tp.imap(lambda x: x, args_list())
+        next(results)
+        self.assertLess(len(consumed), 10)
+        results.close()
+        tp.shutdown(cancel_futures=True)
+        self.assertFalse(any(w.is_alive() for w in tp.workers))
+        self.assertRaises(RuntimeError, tp.put, len, ([],), {})
+
+
+class FenwickTreeTests(unittest.TestCase):
+    def test_find_matches_linear_scan(self):
+        import random
+        weights = [random.choice([0.0, random.uniform(0, 10)]) for _ in range(257)]
+        tree = proxypool.fenwick.FenwickTree(weights)
+        for i in range(0, len(weights), 16):
+            tree.update(i, random.uniform(0, 10))
+            weights[i] = tree.weights[i]
+
+        self.assertAlmostEqual(tree.total(), sum(weights))
+        for _ in range(1000):
+            r = random.uniform(0, sum(weights))
+            s = 0.0
+            for expected, w in enumerate(weights):
+                s += w
+                if s > r:
+                    break
+            self.assertEqual(tree.find(r), expected)
+
 
 if __name__ == "__main__":
     unittest.main()